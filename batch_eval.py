@@ -0,0 +1,168 @@
+# vectorized evaluation of many packed programs (see packed_dsl) on many inputs at once, with the semantics of
+# RV64: all values are 64 bit, division truncates, division by zero returns -1 and remainder by zero the dividend,
+# shift amounts are masked to 6 bits, and lui shifts its immediate by 12. with smt, division by zero and shifts follow
+# the bit-vector semantics of z3 instead: x / 0 is 1 for negative x, and shift amounts outside of 0 - 63 shift out all
+# bits
+import numpy as np
+from typing import Callable, List, Tuple
+from riscv_dsl import *
+from packed_dsl import ops, imm_ops, num_regs, RETURN, ZERO, encode
+
+INT_MIN = np.iinfo(np.int64).min
+_overflow_bound = float(2 ** 62)
+
+
+def _apply(name: str, x: np.ndarray, y: np.ndarray, smt: bool = False) -> np.ndarray:
+    match name:
+        case "add" | "addi":
+            return x + y
+        case "sub" | "subi":
+            return x - y
+        case "mul":
+            return x * y
+        case "slli":
+            if smt:
+                return np.where((y < 0) | (y > 63), 0, np.left_shift(x, y & 63))
+            return np.left_shift(x, y & 63)
+        case "srai":
+            if smt:
+                return np.where((y < 0) | (y > 63), np.where(x < 0, -1, 0), np.right_shift(x, y & 63))
+            return np.right_shift(x, y & 63)
+        case "div" | "rem":
+            special = (y == 0) | ((x == INT_MIN) & (y == -1))
+            y_safe = np.where(special, 1, y)
+            r = np.fmod(x, y_safe)  # sign of the dividend, like rem
+            if name == "rem":
+                return np.where(y == 0, x, r)
+            by_zero = np.where(x < 0, 1, -1) if smt else -1
+            return np.where(y == 0, by_zero, (x - r) // y_safe)  # exact division, so floor and truncation agree
+        case "and" | "andi":
+            return x & y
+        case "or":
+            return x | y
+        case "xor":
+            return x ^ y
+        case "sltu":
+            return (x.view(np.uint64) < y.view(np.uint64)).astype(np.int64)
+        case "mulh":
+            return _mulh(x, y)
+        case "lui":
+            return np.left_shift(y, 12)
+        case _:
+            raise Exception("Could not match Instruction Operator")
+
+
+# upper 64 bits of the signed 128 bit products: the unsigned ones from 32 bit halves, corrected for negative factors
+def _mulh(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    a, b = x.view(np.uint64), y.view(np.uint64)
+    low = np.uint64(0xffffffff)
+    a_lo, a_hi, b_lo, b_hi = a & low, a >> np.uint64(32), b & low, b >> np.uint64(32)
+    t = a_hi * b_lo + ((a_lo * b_lo) >> np.uint64(32))
+    w = (t & low) + a_lo * b_hi
+    high = a_hi * b_hi + (t >> np.uint64(32)) + (w >> np.uint64(32))
+    return (high - np.where(x < 0, b, 0) - np.where(y < 0, a, 0)).view(np.int64)
+
+
+# if the result of the operation might not fit into 63 bits, computed on floats
+def _may_overflow(name: str, x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    fx = np.abs(x.astype(np.float64))
+    fy = np.abs(y.astype(np.float64))
+    match name:
+        case "add" | "addi" | "sub" | "subi":
+            return fx + fy >= _overflow_bound
+        case "mul":
+            return fx * fy >= _overflow_bound
+        case "slli":
+            return fx * np.exp2((y & 63).astype(np.float64)) >= _overflow_bound
+        case _:
+            return np.zeros(x.shape, dtype=bool)
+
+
+# programs: uint32 array of shape (N, L), N packed programs of the same length.
+# inputs: int64 array of shape (M, A), the values of a1, ..., aA for M examples.
+# consts: int64 array of shape (N, S) or (S,), the immediates by constant index. not needed without immediate ops
+# returns the value of a0 for every program and example, shape (N, M). with overflow, also returns for every program
+# if an intermediate value might have left the range of 63 bits on one of the examples, shape (N,)
+def run_batch(programs: np.ndarray, inputs: np.ndarray, consts: None | np.ndarray = None,
+              overflow: bool = False, smt: bool = False) -> np.ndarray | Tuple[np.ndarray, np.ndarray]:
+    programs = np.asarray(programs, dtype=np.uint32)
+    inputs = np.asarray(inputs, dtype=np.int64).reshape(len(inputs), -1)
+    n, length = programs.shape
+    m, a = inputs.shape
+    rows = np.arange(n)
+    if consts is not None:
+        consts = np.broadcast_to(np.asarray(consts, dtype=np.int64), (n, np.shape(consts)[-1]))
+
+    regs = np.zeros((num_regs, n, m), dtype=np.int64)
+    regs[1:a + 1] = inputs.T[:, None, :]
+    overflowed = np.zeros(n, dtype=bool)
+    with np.errstate(over='ignore'):
+        for step in range(length):
+            instr = programs[:, step]
+            opcode = (instr >> 24).astype(np.intp)
+            dest = ((instr >> 16) & 0xff).astype(np.intp)
+            src1 = ((instr >> 8) & 0xff).astype(np.intp)
+            src2 = (instr & 0xff).astype(np.intp)
+            is_imm = opcode < imm_ops
+            left = regs[src1, rows]
+            right = regs[np.where(is_imm, ZERO, src2), rows]
+            if is_imm.any():
+                right[is_imm] = consts[rows[is_imm], src2[is_imm]][:, None]
+            result = np.empty_like(left)
+            for code in np.unique(opcode):
+                sel = opcode == code
+                result[sel] = _apply(ops[code], left[sel], right[sel], smt)
+                if overflow:
+                    overflowed[sel] |= _may_overflow(ops[code], left[sel], right[sel]).any(axis=1)
+            regs[dest, rows] = result
+            regs[ZERO] = 0  # writes to x0 are discarded
+    if overflow:
+        return regs[RETURN], overflowed
+    return regs[RETURN]
+
+
+# packs a program with integer immediates for run_batch. the immediates get constant indices in the order of the
+# immediate instructions, which have to fit into the 8 bit src2 field
+def pack_program(instrs: List[Instr]) -> Tuple[np.ndarray, np.ndarray]:
+    row = []
+    consts = []
+    for instr in only_arith_instrs(instrs):
+        dest, src1, src2 = instr.args
+        if type(src2) is int:
+            if len(consts) > 0xff:
+                raise ValueError("program has more than 256 immediates")
+            row.append(encode(instr.op, dest, src1, len(consts)))
+            consts.append(src2)
+        else:
+            row.append(encode(instr.op, dest, src1, src2))
+    return np.array([row], dtype=np.uint32), np.array(consts or [0], dtype=np.int64)
+
+
+# compares a program with the goal function on random arguments in the range used by the synthesis.
+# arguments are bound to the registers of the same name in the program; inputs where the goal function divides by
+# zero are skipped. returns the arguments the program gets wrong
+def mismatches(instrs: List[Instr], goal_func: Callable[..., int], args: List[str], samples: int = 1000,
+               seed: int = 0) -> List[List[int]]:
+    programs, consts = pack_program(instrs)
+    reg_of = {}
+    for instr in instrs:
+        for reg in instr.args:
+            if type(reg) is Regvar:
+                reg_of[reg.name] = reg.num
+    rng = np.random.default_rng(seed)
+    arg_values = rng.integers(-256, 256, size=(samples, len(args)))
+    inputs = np.zeros((samples, len(Regvar.var_regs)), dtype=np.int64)
+    for i, name in enumerate(args):
+        if name in reg_of:
+            inputs[:, reg_of[name] - 1] = arg_values[:, i]
+    results = run_batch(programs, inputs, consts)[0]
+
+    wrong = []
+    for values, result in zip(arg_values.tolist(), results.tolist()):
+        try:
+            expected = goal_func(*values)
+        except ZeroDivisionError:
+            continue
+        if (expected - result) % (1 << 64) != 0:
+            wrong.append(values)
+    return wrong
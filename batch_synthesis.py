@@ -0,0 +1,110 @@
+# non-interactive synthesis of many goals at once. a batch file has one goal per line: an arithmetic expression or
+# the name of a RISC-V assembly file (ending in .s). empty lines and lines starting with # are skipped.
+# the goals are distributed over a pool of processes, every goal has its own timeout, and every program found is
+# written with ast_to_output. the results are summarized in manifest.json in the output directory
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import re
+import time
+from typing import Any, List
+from riscv_dsl import *
+from synthesis import RiscvGen
+from cegis_verify import Verifier
+from cancellation import CancelToken, PartialResult
+from dsl_input_output import ast_to_output, input_to_ast
+from dsl_to_func import to_func
+from python_ast_to_func import user_to_func
+
+__all__ = ["read_batch", "synthesize_batch"]
+
+prebuild_depth: int = 3  # the dp tables up to this length are built before the workers are started
+
+
+def read_batch(path: str) -> List[str]:
+    with open(path) as f:
+        lines = [line.strip() for line in f]
+    return [line for line in lines if line != "" and not line.startswith("#")]
+
+
+def _is_file(goal: str) -> bool:
+    return goal.endswith(".s")
+
+
+# None if the goal can not be read, the worker reports the error then
+def _goal_args(goal: str) -> None | List[str]:
+    try:
+        if _is_file(goal):
+            return to_func(input_to_ast(goal))[1]
+        return user_to_func(goal)[1]
+    except Exception:
+        return None
+
+
+# the entry of the manifest for goal. cancel is used instead of a token with the timeout, if it is given
+def _synthesize(goal: str, method: str, timeout: None | float, cancel: None | CancelToken = None) -> dict[str, Any]:
+    result = {"goal": goal, "kind": "file" if _is_file(goal) else "expression", "status": "error", "program": None,
+              "length": None, "time": None, "iterations": None, "error": None}
+    if cancel is None and timeout is not None:
+        cancel = CancelToken(timeout)
+    start = time.perf_counter()
+    try:
+        synth = Verifier.fromRiscv(input_to_ast(goal)) if _is_file(goal) else Verifier.fromStr(goal)
+        res = getattr(synth, method)(cancel=cancel)
+        result["iterations"] = synth.stats["iterations"]
+        if isinstance(res, PartialResult):
+            result["status"] = "timeout"
+            result["length"] = res.min_len + 1  # lower bound
+        elif res is None:
+            result["status"] = "not_found"
+        else:
+            result["status"] = "ok"
+            result["program"] = res
+            result["length"] = len(res)
+    except Exception as e:
+        result["error"] = str(e)
+    result["time"] = time.perf_counter() - start
+    return result
+
+
+def _init_worker():
+    RiscvGen.share_tables = True
+
+
+# synthesizes the goals with the given Verifier method and writes the programs to out_dir as <number>_<goal>.s.
+# the dp tables for every number of arguments in the batch are built once, before the workers are forked, and the
+# workers share them with all of their jobs. returns the entries of the manifest
+def synthesize_batch(goals: List[str], out_dir: str, workers: int = 1, timeout: None | float = None,
+                     method: str = "cegis_2", verbose: bool = True) -> List[dict[str, Any]]:
+    os.makedirs(out_dir, exist_ok=True)
+    RiscvGen.share_tables = True
+    arg_counts = {len(args) for args in map(_goal_args, goals) if args is not None}
+    for n in sorted(arg_counts):
+        RiscvGen(["v" + str(i) for i in range(n)]).dp_tables(prebuild_depth)
+
+    ctx = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+    results = [None] * len(goals)
+    with concurrent.futures.ProcessPoolExecutor(workers, mp_context=ctx, initializer=_init_worker) as pool:
+        futures = {pool.submit(_synthesize, goal, method, timeout): i for i, goal in enumerate(goals)}
+        for f in concurrent.futures.as_completed(futures):
+            i = futures[f]
+            try:
+                result = f.result()
+            except Exception as e:  # e.g. the worker process died, which also fails the goals after it
+                result = {"goal": goals[i], "kind": "file" if _is_file(goals[i]) else "expression", "status": "error",
+                          "program": None, "length": None, "time": None, "iterations": None, "error": str(e)}
+            result["output"] = None
+            if result["program"] is not None:
+                name = f"{i:04d}_{re.sub(r'[^A-Za-z0-9]+', '_', os.path.basename(result['goal'])).strip('_')}.s"
+                result["output"] = os.path.join(out_dir, name)
+                ast_to_output(result["program"], f_name=result["output"])
+                result["program"] = [repr(instr) for instr in result["program"]]
+            results[i] = result
+            if verbose:
+                print(f"[{sum(r is not None for r in results)}/{len(goals)}] {result['goal']}: {result['status']}",
+                      flush=True)
+
+    with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+        json.dump({"method": method, "timeout": timeout, "results": results}, f, indent=1)
+    return results
@@ -0,0 +1,204 @@
+# headless benchmark runner: runs suites of goal expressions against the synthesis methods of Verifier and writes one
+# record per run as JSON and/or CSV. every run happens in a process of its own, which is killed at the timeout, so the
+# peak memory of a record belongs to that run alone. a run can be compared against a stored one to flag regressions
+import argparse
+import csv
+import json
+import multiprocessing
+import platform
+import resource
+import statistics
+import sys
+import time
+from typing import Any, List, Tuple
+from cegis_verify import Verifier
+from synthesis_cache import encode_program
+from batch_eval import mismatches
+from profiling import Profile
+
+ex1_add = ["3", "x + 10 - 5", "x * 1"]
+ex1_shift = ["x * 4", "x % y", "x / 4"]
+ex2 = ["(x + 2) * 4", "x * 2 + 20", "x + y + 1"]
+ex3 = ["(((x + 3)* 4) - 1) * 2", "x % 3", "x / 3"]
+ex4 = ["x * y * z", "(x / 3) + 3"]
+
+suites: dict[str, List[str]] = {"ex1_add": ex1_add, "ex1_shift": ex1_shift, "ex2": ex2, "ex3": ex3, "ex4": ex4}
+methods: List[str] = ["cegis_0", "cegis_1", "cegis_2", "bottom_up"]
+fields: List[str] = ["suite", "expr", "method", "run", "status", "time", "peak_rss_kb", "iterations", "sketches",
+                     "z3_checks", "program", "error"]
+
+
+# runs in the child process and sends the record without suite and run back. status is ok, wrong (the program
+# failed the random sanity check), not_found or error. with profile, the export of a Profile of the run is added
+def _run_one(expr: str, method: str, conn, profile: bool = False):
+    record = {"expr": expr, "method": method, "status": "error", "time": None, "program": None, "error": None}
+    synth = Verifier.fromStr(expr)
+    synth.profiler = Profile() if profile else None
+    start = time.perf_counter()
+    try:
+        prog = getattr(synth, method)()
+        record["time"] = time.perf_counter() - start
+        if prog is None:
+            record["status"] = "not_found"
+        else:
+            record["program"] = encode_program(prog)
+            record["status"] = "wrong" if mismatches(prog, synth.goal_func, synth.args) else "ok"
+    except Exception as e:
+        record["error"] = str(e)
+    record.update(synth.stats)
+    if synth.profiler is not None:
+        record["profile"] = synth.profiler.export(synth.stats)
+    record["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss  # kilobytes on linux
+    conn.send(record)
+    conn.close()
+
+
+# runs one synthesis in a fresh process. a run that does not finish within timeout seconds is killed and recorded
+# with status timeout, a run whose process dies with status crashed
+def run_once(expr: str, method: str, timeout: float, profile: bool = False) -> dict[str, Any]:
+    ctx = multiprocessing.get_context("spawn")
+    recv, send = ctx.Pipe(duplex=False)
+    process = ctx.Process(target=_run_one, args=(expr, method, send, profile))
+    process.start()
+    send.close()
+    record = {"expr": expr, "method": method, "time": None, "peak_rss_kb": None, "iterations": None,
+              "sketches": None, "z3_checks": None, "program": None, "error": None}
+    try:
+        if recv.poll(timeout):
+            record = recv.recv()
+        else:
+            record["status"] = "timeout"
+    except EOFError:
+        record["status"] = "crashed"
+        record["error"] = "exit code " + str(process.exitcode)
+    finally:
+        if process.is_alive():
+            process.kill()
+        process.join()
+        recv.close()
+    return record
+
+
+def run_suites(selected: dict[str, List[str]], used_methods: List[str], repeat: int = 1, timeout: float = 600,
+               verbose: bool = True, profile: bool = False) -> List[dict[str, Any]]:
+    records = []
+    for suite, exprs in selected.items():
+        for expr in exprs:
+            for method in used_methods:
+                for run in range(repeat):
+                    record = {"suite": suite, "run": run, **run_once(expr, method, timeout, profile)}
+                    records.append(record)
+                    if verbose:
+                        print(suite, repr(expr), method, run, record["status"], _fmt(record["time"]), flush=True)
+    return records
+
+
+def _fmt(value) -> str:
+    return "-" if value is None else f"{value:.3f}"
+
+
+# one entry per suite, expression and method: median time, highest peak memory and the worst status of the runs
+def summarize(records: List[dict[str, Any]]) -> dict[Tuple[str, str, str], dict[str, Any]]:
+    grouped = {}
+    for record in records:
+        grouped.setdefault((record["suite"], record["expr"], record["method"]), []).append(record)
+    summary = {}
+    for key, runs in grouped.items():
+        failed = [r["status"] for r in runs if r["status"] != "ok"]
+        times = [r["time"] for r in runs if r["status"] == "ok"]
+        rss = [r["peak_rss_kb"] for r in runs if r["peak_rss_kb"] is not None]
+        summary[key] = {"status": failed[0] if failed else "ok",
+                        "time": statistics.median(times) if times else None,
+                        "peak_rss_kb": max(rss) if rss else None}
+    return summary
+
+
+# compares with the records of an earlier run. a regression is a run that no longer succeeds, or whose median time
+# or peak memory grew by more than the tolerance (and, for the time, by more than min_delta seconds)
+def compare(records: List[dict[str, Any]], baseline: List[dict[str, Any]], tolerance: float = 0.25,
+            min_delta: float = 0.1) -> List[str]:
+    current = summarize(records)
+    old = summarize(baseline)
+    regressions = []
+    for key, new in current.items():
+        if key not in old:
+            continue
+        before = old[key]
+        name = "/".join(key)
+        if before["status"] == "ok" and new["status"] != "ok":
+            regressions.append(f"{name}: {new['status']} (was ok)")
+            continue
+        if new["status"] != "ok" or before["status"] != "ok":
+            continue
+        if new["time"] > before["time"] * (1 + tolerance) and new["time"] - before["time"] > min_delta:
+            regressions.append(f"{name}: time {before['time']:.3f}s -> {new['time']:.3f}s")
+        if (new["peak_rss_kb"] is not None and before["peak_rss_kb"] is not None
+                and new["peak_rss_kb"] > before["peak_rss_kb"] * (1 + tolerance)):
+            regressions.append(f"{name}: peak memory {before['peak_rss_kb']}kB -> {new['peak_rss_kb']}kB")
+    return regressions
+
+
+def write_json(path: str, records: List[dict[str, Any]], meta: dict[str, Any]):
+    with open(path, "w") as f:
+        json.dump({"meta": meta, "records": records}, f, indent=1)
+
+
+def write_csv(path: str, records: List[dict[str, Any]]):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fields, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(records)
+
+
+def read_records(path: str) -> List[dict[str, Any]]:
+    with open(path) as f:
+        return json.load(f)["records"]
+
+
+# user suites are JSON files with an object of suite names and lists of expressions
+def main(argv: None | List[str] = None) -> int:
+    parser = argparse.ArgumentParser(description="Runs the synthesis benchmarks without a display")
+    parser.add_argument("--suite-file", action="append", default=[], help="JSON file with additional suites")
+    parser.add_argument("--suites", nargs="+", help="names of the suites to run (default: all)")
+    parser.add_argument("--methods", nargs="+", default=methods, help="Verifier methods to run")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per expression and method")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds until a run is stopped")
+    parser.add_argument("--json", help="file to write the records to, as JSON")
+    parser.add_argument("--csv", help="file to write the records to, as CSV")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown before flagging")
+    parser.add_argument("--profile", action="store_true", help="add counters and phase times to the JSON records")
+    cli_args = parser.parse_args(argv)
+
+    available = dict(suites)
+    for path in cli_args.suite_file:
+        with open(path) as f:
+            available.update(json.load(f))
+    names = cli_args.suites if cli_args.suites is not None else list(available)
+    for name in names:
+        if name not in available:
+            parser.error("unknown suite " + name)
+
+    meta = {"started": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "machine": platform.machine(), "timeout": cli_args.timeout, "repeat": cli_args.repeat,
+            "profile": cli_args.profile}
+    records = run_suites({name: available[name] for name in names}, cli_args.methods, cli_args.repeat,
+                         cli_args.timeout, profile=cli_args.profile)
+    if cli_args.json:
+        write_json(cli_args.json, records, meta)
+    if cli_args.csv:
+        write_csv(cli_args.csv, records)
+
+    failed = [r for r in records if r["status"] != "ok"]
+    print(f"{len(records)} runs, {len(failed)} not ok")
+    if cli_args.baseline:
+        regressions = compare(records, read_records(cli_args.baseline), cli_args.tolerance)
+        for regression in regressions:
+            print("REGRESSION", regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,23 +1,38 @@
-import signal
 import timeit
 from memory_profiler import memory_usage
 import matplotlib.pyplot as plt
 from cegis_verify import Verifier
+from cancellation import CancelToken, PartialResult
+from batch_eval import mismatches
+from benchmark_runner import ex1_add, ex1_shift, ex2, ex3, ex4  # headless runs with JSON/CSV output: benchmark_runner.py
 
 divideprint = lambda x: print("\n" + 3 * "-" + x + 3 * "-")
 
+# runs the synthesized program on random inputs to catch wrong results
+def sanity_check(synth, prog):
+    wrong = mismatches(prog, synth.goal_func, synth.args)
+    if len(wrong) > 0:
+        print("Result does not match the goal function, e.g. for arguments", wrong[0])
+
 def runall_takeaverage(name, f, l):
     res = []
     for input_func in l:
         synth = Verifier.fromStr(input_func)
         divideprint(input_func)
-        signal.alarm(600)
+        progs = []
         try:
-            single_res = timeit.timeit(lambda: f(synth), number=1)
-            res.append(single_res)
+            single_res = timeit.timeit(lambda: progs.append(f(synth, cancel=CancelToken(600))), number=1)
         except Exception as e:
-            res.append(600)
+            single_res = None
+        # timeouts, errors and searches that end without a program all count as 600 seconds
+        found = single_res is not None and progs[0] is not None and not isinstance(progs[0], PartialResult)
+        res.append(single_res if found else 600)
         print(name, res[-1])
+        if found:
+            try:
+                sanity_check(synth, progs[0])
+            except Exception as e:
+                print("Sanity check failed:", e)
     return (sum(res) / len(res))
 
 def runall_memory(name, f, l):
@@ -25,9 +40,8 @@ def runall_memory(name, f, l):
     for input_func in l:
         synth = Verifier.fromStr(input_func)
         divideprint(input_func)
-        signal.alarm(600)
         try:
-            single_res = max(memory_usage(lambda: f(synth)))
+            single_res = max(memory_usage(lambda: f(synth, cancel=CancelToken(600))))
             res.append(single_res)
         except Exception as e:
             res.append(600)
@@ -35,22 +49,11 @@ def runall_memory(name, f, l):
     return (sum(res) / len(res))
 
 
-def signal_handler(signum, frame):
-    raise Exception('Timeout')
-
-signal.signal(signal.SIGALRM, signal_handler)
-    
-ex1_add = ["3", "x + 10 - 5", "x * 1"]
-ex1_shift = ["x * 4", "x % y", "x / 4"]
-ex2 = ["(x + 2) * 4", "x * 2 + 20", "x + y + 1"]
-ex3 = ["(((x + 3)* 4) - 1) * 2", "x % 3", "x / 3"]
-ex4 = ["x * y * z", "(x / 3) + 3"]
 
 def run_benchmarking():
     make_two_time_bar_graph(*run_time_benchmarking(ex1_add, ex1_shift, ex2, ex3))
 
 
-# due to signal function, this is unfortunately linux-only. different approaches to timeout lead to segfaults
 def run_time_benchmarking(*args) -> tuple[list, list]:
     enum_time_results = []
     cegis_time_results = []
@@ -131,6 +134,25 @@ def compare_cegis_variants():
     print(f"(x / 3) + 3\ncegis 1: {time_cegis1}, cegis final: {time_cegis2}")
 
 
+# dp_gen against the single symbolic query per program length
+def compare_symbolic():
+    width=0.25
+    res_dp = []
+    res_sym = []
+    for arg in [ex1_add, ex1_shift, ex2, ex3, ex4]:
+        res_dp.append(runall_takeaverage('Cegis2', Verifier.cegis_2, arg))
+        res_sym.append(runall_takeaverage('Cegis4', Verifier.cegis_4, arg))
+    plt.bar([0, 1, 2, 3, 4], res_dp, color = 'b', width=width, edgecolor='black', label='Sketches')
+    plt.bar([width, 1 + width, 2 + width, 3 + width, 4 + width], res_sym, color = 'r', width=width, edgecolor='black', label='Symbolic')
+
+    plt.title("Time Analysis")
+    plt.xlabel('Number of Lines in Solution')
+    plt.ylabel('Time in seconds')
+    plt.xticks([width/2, 1+width/2, 2+width/2, 3+width/2, 4+width/2], ["1, Simple", "1, Complex", "2, Simple", "2, Complex", "3"])
+    plt.legend()
+    plt.show()
+
+
 if __name__ == "__main__":
     run_benchmarking()
     compare_cegis_variants()
@@ -0,0 +1,88 @@
+# deadlines and cancellation for the synthesis, without signals: the generators poll a CancelToken in their loops and
+# run their z3 checks through it, so the checks are bounded by the time that is left
+from riscv_dsl import *
+from typing import List, Tuple
+from z3 import Solver, CheckSatResult, unknown
+import threading
+import time
+
+__all__ = ["CancelToken", "SynthesisCancelled", "PartialResult"]
+
+
+class SynthesisCancelled(Exception):
+    pass
+
+
+# cancel() may be called from another thread; a z3 check that is running at that moment is interrupted.
+# timeout is in seconds for the whole synthesis, check_timeout in milliseconds and rlimit in z3 resource units for
+# a single check of a candidate. a check stopped by these limits counts as a candidate that was not found
+class CancelToken:
+    deadline: None | float  # time.monotonic() at which the synthesis stops
+    check_timeout: None | int
+    rlimit: None | int
+    event: threading.Event
+    running: None | Solver  # solver of the check in progress
+
+    def __init__(self, timeout: None | float = None, check_timeout: None | int = None, rlimit: None | int = None):
+        self.deadline = None if timeout is None else time.monotonic() + timeout
+        self.check_timeout = check_timeout
+        self.rlimit = rlimit
+        self.event = threading.Event()
+        self.running = None
+
+    def cancel(self):
+        self.event.set()
+        solver = self.running
+        if solver is not None:
+            solver.ctx.interrupt()
+
+    def cancelled(self) -> bool:
+        return self.event.is_set() or (self.deadline is not None and time.monotonic() >= self.deadline)
+
+    def raise_if_cancelled(self):
+        if self.cancelled():
+            raise SynthesisCancelled()
+
+    # seconds until the deadline, None without one
+    def remaining(self) -> None | float:
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+
+    # s.check() with the limits of the token. bounded is False for checks that must not be cut short by check_timeout
+    # and rlimit, like the search for counterexamples; those are only bounded by the deadline
+    def check(self, s: Solver, bounded: bool = True) -> CheckSatResult:
+        self.raise_if_cancelled()
+        ms = self.check_timeout if bounded else None
+        remaining = self.remaining()
+        if remaining is not None:
+            ms = int(remaining * 1000) + 1 if ms is None else min(ms, int(remaining * 1000) + 1)
+        s.set("timeout", ms if ms is not None else 4294967295)  # the default of z3, no timeout
+        if self.rlimit is not None:
+            s.set("rlimit", self.rlimit if bounded else 0)
+        self.running = s
+        try:
+            r = s.check()
+        finally:
+            self.running = None
+        if r == unknown:
+            self.raise_if_cancelled()
+        return r
+
+
+# what is known when a synthesis was cancelled: programs shorter than min_len + 1 instructions were ruled out by the
+# examples, and candidate is the last program proposed by the generator, which was not verified
+class PartialResult:
+    candidate: None | List[Instr]
+    min_len: int
+    examples: List[Tuple[List[int], int]]
+    iterations: int
+
+    def __init__(self, candidate: None | List[Instr], min_len: int, examples: List[Tuple[List[int], int]], iterations: int):
+        self.candidate = candidate
+        self.min_len = min_len
+        self.examples = examples
+        self.iterations = iterations
+
+    def __repr__(self) -> str:
+        return f"PartialResult(min_len={self.min_len}, examples={len(self.examples)}, candidate={self.candidate})"
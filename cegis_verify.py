@@ -1,12 +1,25 @@
 from z3 import *
 from riscv_dsl import *
 from synthesis import *
-from typing import Callable, List
-from python_ast_to_func import user_to_func
+from typing import Any, Callable, List, Tuple
+from python_ast_to_func import user_to_func, canonical_expr
+from synthesis_cache import SynthesisCache
+from cancellation import CancelToken, SynthesisCancelled, PartialResult
+from cost_model import CostModel
+from profiling import Profile
 from dsl_to_func import to_func
 from memory_profiler import profile
 from python_ast_to_dsl import Compiler
 import ast as ast
+import time
+import os
+import json
+import random
+import itertools
+import numpy as np
+from packed_dsl import ops, imm_ops, const_slots, decode_sketch, run_packed_smt
+from batch_eval import run_batch
+from magic_division import constant_division, lower_division
 
 
 class Verifier:
@@ -14,10 +27,27 @@ class Verifier:
     args: List[str]  # list of function arguments
     to_analyze: List[str]
     z3args: dict[str, BitVecRef]
-
-    def __init__(self, f: Callable[..., int], args: List[str]):
+    workers: int  # number of processes used by cegis_2
+    cache: None | SynthesisCache  # stored results of earlier synthesis runs
+    expr_key: None | str  # canonical form of the goal expression, if it is known
+    cancel: None | CancelToken  # token of the running synthesis, also bounds the search for counterexamples
+    stats: dict[str, int]  # cegis iterations, sketches tried and z3 checks of the last synthesis
+    max_brute_slots: int = 2  # bottom_up tries all values for up to this many constants of a sketch with numpy
+    use_tiers: bool = True  # cegis_2 and cegis_cost start from the program of division_tier, if there is one
+    terms: dict[tuple, Any]  # z3 terms of symbolic_result by op and operands, shared between programs
+    max_terms: int = 1 << 16  # terms is cleared when it grows larger
+    tier_search_len: int = 2  # cegis_cost only searches programs up to this long for cheaper ones than the tier's
+    profiler: None | Profile = None  # counters and timers of the search, handed on to the generators, see profiling
+
+    def __init__(self, f: Callable[..., int], args: List[str], workers: int = 1, cache: None | SynthesisCache = None):
         self.goal_func = f
         self.args = args
+        self.workers = workers
+        self.cache = cache
+        self.expr_key = None
+        self.stats = {"iterations": 0, "sketches": 0, "z3_checks": 0}
+        self.cancel = None
+        self.terms = {}
         self.z3args = {repr(Zero()): BitVec("Zero", 64)}
         self.to_analyze = [repr(ReturnReg())] + [repr(Reg(x)) for x in [5, 6, 7, 28, 29, 30, 31]]
         # hack to force usage of remainder instead of python modulo in Z3
@@ -25,74 +55,96 @@ class Verifier:
         BitVecRef.__rmod__ = lambda self, other: SRem(self, other)
 
     @classmethod
-    def fromStr(cls, s: str) -> "Verifier":
+    def fromStr(cls, s: str, workers: int = 1, cache: None | SynthesisCache = None) -> "Verifier":
         f, args = user_to_func(s)
-        return cls(f, args)
+        verifier = cls(f, args, workers, cache)
+        verifier.expr_key = canonical_expr(ast.parse(s, mode='eval'))
+        return verifier
     
     @classmethod
-    def fromRiscv(cls, instrs: List[Instr]) -> "Verifier":
+    def fromRiscv(cls, instrs: List[Instr], workers: int = 1) -> "Verifier":
         f, args = to_func(instrs)
-        return cls(f, args)
+        return cls(f, args, workers)
 
 
-    # we cannot easily convert a list of instructions directly to z3 because registers may have different values at different points in the program
-    # instead we traverse the instruction list bottom-up, resolving registers to values when possible.
-    # a expression is returned
+    # we cannot easily convert a list of instructions directly to z3 because registers may have different values at
+    # different points in the program. instrlist is in reverse order (the last instruction first), like the lists of
+    # the generators reversed; see symbolic_result. returns None if goaldest is not written
     def match_instr(self, instrlist: List[Instr], goaldest: Reg, s):
-        to_var = lambda x: self.z3args[py_name(x)]  # helper
-
-        for instr in instrlist:
+        return self.symbolic_result(instrlist[::-1], goaldest, s)
+
+    # z3 term of the value of goaldest after instrs, None if it is not written. the instructions are executed forward
+    # and every value is built once, but only for the instructions the result depends on: only their div and rem add
+    # the side condition right != 0 to s, and registers other instructions read need not be defined.
+    # identical terms are shared through self.terms
+    def symbolic_result(self, instrs: List[Instr], goaldest: Reg, s):
+        producer = {}  # register -> index of the instruction that wrote its current value
+        operands = []  # per instruction: op, registers and immediate read, producers of the registers
+        for i, instr in enumerate(instrs):
             match instr:
-                case Instr(op, (dest, Reg() as arg, int(imm))) if repr(dest) == repr(goaldest):
-                    left = self.match_instr(instrlist[1:], arg, s)
-                    if left is None:
-                        left = to_var(arg)
-                    return match_op(op)(left, imm)
-
-                case Instr(op, (dest, Reg() as arg1, Reg() as arg2)) if repr(dest) == repr(goaldest):
-                    left = self.match_instr(instrlist[1:], arg1, s)
-                    if left is None:
-                        left = to_var(arg1)
-
-                    right = self.match_instr(instrlist[1:], arg2, s)
-                    if right is None:
-                        right = to_var(arg2)
-                    if op == 'div' or op == 'rem':
-                        s.add(right != 0)
-                    return match_op(op)(left, right)
-
+                case Instr(op, (dest, Reg() as arg, int(imm))):
+                    operands.append((op, [arg], imm, [producer.get(arg.key)]))
+                    producer[dest.key] = i
+                case Instr(op, (dest, Reg() as arg1, Reg() as arg2)):
+                    operands.append((op, [arg1, arg2], None, [producer.get(arg1.key), producer.get(arg2.key)]))
+                    producer[dest.key] = i
                 case Instr(_):
-                    return self.match_instr(instrlist[1:], goaldest, s)
-
+                    operands.append(None)
                 case _:
                     raise Exception("Not a valid RISC-V instruction")
-
-    # verifies if guess matches goal function or not. Prints result
-    def verify(self, guess: list[Instr]):
+        if goaldest.key not in producer:
+            return None
+
+        needed = set()
+        stack = [producer[goaldest.key]]
+        while stack:
+            i = stack.pop()
+            if i not in needed:
+                needed.add(i)
+                stack += [p for p in operands[i][3] if p is not None]
+
+        if len(self.terms) > self.max_terms:
+            self.terms = {}
+        values = {}
+        for i in sorted(needed):
+            op, regs, imm, producers = operands[i]
+            args = [self.z3args[py_name(r)] if p is None else values[p] for r, p in zip(regs, producers)]
+            if imm is not None:
+                args.append(imm)
+            elif op == 'div' or op == 'rem':
+                s.add(args[1] != 0)
+            key = (op,) + tuple(a.get_id() if isinstance(a, ExprRef) else ("imm", a) for a in args)
+            if key not in self.terms:
+                self.terms[key] = match_op(op)(*args)
+            values[i] = self.terms[key]
+        return values[producer[goaldest.key]]
+
+    # verifies if guess matches goal function or not, for arguments in the range used by the synthesis. Prints result
+    def verify(self, guess: list[Instr]) -> bool:
         s = Solver()
 
         for arg in self.args:
             self.z3args[arg] = BitVec(arg, 64)
-            # s.add(self.z3args[arg] < 256)
-            # s.add(self.z3args[arg] > -256)
+            s.add(self.z3args[arg] < 256)
+            s.add(self.z3args[arg] >= -256)
 
         s.add(self.z3args[repr(Zero())] == 0)
 
-        guess.reverse()
-
         try:
-            unrolled_expr = self.match_instr(guess, ReturnReg(), s)
-            s.add(unrolled_expr == self.goal_func(*[self.z3args[x] for x in self.args]))
+            unrolled_expr = self.symbolic_result(guess, ReturnReg(), s)
+            goal_f_result = self.goal_func(*[self.z3args[x] for x in self.args])
+            self._avoid_zero_div(s, goal_f_result)
+            s.add(unrolled_expr != goal_f_result)  # look for a counterexample
         except Exception as e:
             print("Tried to verify a program that was not valid")
             return False
 
-        if s.check() == sat:
+        if s.check() == unsat:
             print("Instrction sequence matches goal function")
-            print(s.model())
             return True
         else:
             print("Instruction sequence did not match goal function")
+            print(s.model())
             return False
 
     def avoid_overflow(self, s, expr):
@@ -130,23 +182,46 @@ class Verifier:
     # provides a counter example if the guess wasn't correct, or just returns true if the guess matched the specification
     def cegis_counter(self, guess:list[Instr], s: Solver) -> Tuple[List[Instr], bool]:
 
-        guess.reverse()
-
-        unrolled_expr = self.match_instr(guess, ReturnReg(), s)
+        start = time.perf_counter() if self.profiler is not None else 0.0
+        s.push()  # the constraints of this guess must not restrict the counterexamples for later guesses
+        unrolled_expr = self.symbolic_result(guess, ReturnReg(), s)
         goal_f_result = self.goal_func(*[self.z3args[x] for x in self.args])
         self._avoid_zero_div(s, goal_f_result)
         s.add(unrolled_expr != goal_f_result)
 
-        if s.check() == sat:
+        self.stats["z3_checks"] += 1
+        r = s.check() if self.cancel is None else self.cancel.check(s, bounded=False)
+        if self.profiler is not None:
+            self.profiler.check("verify", r, time.perf_counter() - start)
+        if r == sat:
             del self.z3args[repr(Zero())]
             new_args = [int(s.model().eval(x).as_signed_long()) for x in self.z3args.values()]
             self.z3args[repr(Zero())] = BitVec("Zero", 64)
+            s.pop()
             return new_args, False
         else:
-            guess.reverse()
+            s.pop()
             return [], True
 
-    def cegis_general(self, generator_used: Callable):
+    # examples and min_len continue an earlier search, e.g. from a checkpoint of dp_gen. if the cancel token is
+    # cancelled or its deadline passes, the search stops and a PartialResult is returned instead of a program
+    def cegis_general(self, generator_used: Callable, examples: None | List[Tuple[List[int], int]] = None,
+                      min_len: int = 0, cancel: None | CancelToken = None) -> List[Instr] | PartialResult:
+        method = generator_used.__name__
+        gen = generator_used.__self__
+        params = gen.params()
+        self.stats = {"iterations": 0, "sketches": 0, "z3_checks": 0}
+        self.cancel = cancel
+        gen.cancel = cancel
+        gen.profiler = self.profiler
+        if self.cache is not None and self.expr_key is not None:
+            hit = self.cache.lookup(self.expr_key, method, params, self.args)
+            if hit is not None and self.verify(hit[0]):
+                if self.profiler is not None:
+                    self.profiler.count("cache_hits")
+                return hit[0]
+        start = time.perf_counter()
+
         s = Solver()
 
         s.add(self.z3args[repr(Zero())] == 0)
@@ -156,76 +231,320 @@ class Verifier:
             s.add(self.z3args[arg] < 256)
             s.add(self.z3args[arg] >= -256)
 
+        if examples is None:
+            examples = self.first_examples()
+
+        guess = None
+        try:
+            while(True):
+                self.stats["iterations"] += 1
+                phase_start = time.perf_counter() if self.profiler is not None else 0.0
+                if generator_used.__func__ == RiscvGen.naive_gen:
+                    guess = generator_used(examples)
+                else:
+                    guess, min_len = generator_used(examples, min_len)
+                if self.profiler is not None:
+                    self.profiler.add_time("generate", time.perf_counter() - phase_start)
+                    self.profiler.per_length("iterations", len(guess))
+
+                example_args, success = self.cegis_counter(guess, s)
+                if self.profiler is not None:
+                    self.profiler.event("iteration", method=method, iteration=self.stats["iterations"],
+                                       length=len(guess), examples=len(examples), success=success)
+                if success:
+                    if self.cache is not None and self.expr_key is not None:
+                        self.cache.store(self.expr_key, method, params, guess, min_len, time.perf_counter() - start)
+                    return guess
+                examples += [(example_args, self.goal_func(*example_args))]
+        except SynthesisCancelled:
+            if self.profiler is not None:
+                self.profiler.event("cancelled", method=method, iteration=self.stats["iterations"])
+            return PartialResult(guess, max(min_len, gen.last_min), examples, self.stats["iterations"])
+        finally:
+            self.cancel = None
+            self.stats["sketches"] += gen.stats["sketches"]
+            self.stats["z3_checks"] += gen.stats["z3_checks"]
+
+
+    # the examples cegis starts with: all arguments 0, or 1 if the goal can not be computed for 0
+    def first_examples(self) -> List[Tuple[List[int], int]]:
         example_args = [0 for x in self.args]
-        min_len = 0
         try:
-            examples = [(example_args, self.goal_func(*example_args))]
+            return [(example_args, self.goal_func(*example_args))]
         except:
             example_args = [1 for x in self.args]
-            examples = [(example_args, self.goal_func(*example_args))]
-
-        while(True):
-            if generator_used.__func__ == RiscvGen.naive_gen:
-                guess = generator_used(examples)
-            else:
-                guess, min_len = generator_used(examples, min_len)
-
-            example_args, success = self.cegis_counter(guess, s)
-            if success:
-                return guess
-            examples += [(example_args, self.goal_func(*example_args))]
-
+            return [(example_args, self.goal_func(*example_args))]
 
     # uses naive generator for guesses
-    def cegis_0(self):
+    def cegis_0(self, cancel: None | CancelToken = None):
         gen = RiscvGen(self.args)
-        return self.cegis_general(gen.naive_gen)
+        return self.cegis_general(gen.naive_gen, cancel=cancel)
 
     # uses generator with pruned search space
-    def cegis_1(self):
+    def cegis_1(self, cancel: None | CancelToken = None):
         gen = RiscvGen(self.args)
-        return self.cegis_general(gen.smart_gen)
-
-    # uses generator and dynamic programming
-    def cegis_2(self):
+        return self.cegis_general(gen.smart_gen, cancel=cancel)
+
+    # rewrites that are known without a search: division and remainder of the only argument by a constant d are
+    # lowered to a multiplication with a magic number (see magic_division). returns the verified program, or None
+    # if the goal has no such form
+    def division_tier(self) -> None | List[Instr]:
+        prog = self.division_program()
+        return prog if prog is not None and self.verify(prog) else None
+
+    # the program of division_tier before it is verified
+    def division_program(self) -> None | List[Instr]:
+        if self.expr_key is None or len(self.args) != 1:
+            return None
+        division = constant_division(self.expr_key)
+        if division is None:
+            return None
+        kind, d = division
+        return lower_division(kind, Regvar(ReturnReg().var_regs[0], self.args[0]), d)
+
+    # uses generator and dynamic programming. with more than one worker, the sketches are checked in parallel
+    # with a checkpoint file, the search writes its position there and continues from it if the file exists.
+    # the file is removed once a program was found. with a program of division_tier that is shorter than the longest
+    # programs the search gets to (RiscvGen.max_depth), only shorter ones are searched for, and the tier's program is
+    # returned if there is none. the tier's program is also the candidate if cancelled. it is only verified when it is
+    # returned. with max_len, only programs of up to max_len instructions are searched, and None is returned if there
+    # is none
+    def cegis_2(self, checkpoint: None | str = None, cancel: None | CancelToken = None, max_len: None | int = None):
+        gen = RiscvGen(self.args, self.workers)
+        gen.max_len = max_len
+        examples, min_len = None, 0
+        if checkpoint is not None:
+            gen.checkpoint = checkpoint
+            if os.path.exists(checkpoint):
+                examples, min_len = gen.resume_checkpoint(checkpoint)
+        tier = self.division_program() if self.use_tiers else None
+        if tier is not None and len(tier) - 1 < gen.max_depth:
+            gen.max_len = len(tier) - 1 if max_len is None else min(max_len, len(tier) - 1)
+        try:
+            prog = self.cegis_general(gen.dp_gen, examples, min_len, cancel)
+        except SearchExhausted:
+            prog = tier if tier is not None and self.verify(tier) else None
+        except BaseException:
+            gen.write_checkpoint()  # e.g. interrupted by a signal
+            raise
+        finally:
+            gen.close()
+        if isinstance(prog, PartialResult):
+            gen.write_checkpoint()
+            if tier is not None and self.verify(tier):
+                prog.candidate = tier
+        elif checkpoint is not None and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        return prog
+
+    # uses bottom up enumeration with observational equivalence as generator
+    def cegis_3(self, cancel: None | CancelToken = None):
         gen = RiscvGen(self.args)
-        return self.cegis_general(gen.dp_gen)
+        return self.cegis_general(gen.oe_gen, cancel=cancel)
 
-    # does not use cegis but just bottom up enumeration
-    def bottom_up(self):
+    # uses one symbolic query per program length as generator
+    def cegis_4(self, cancel: None | CancelToken = None):
         gen = RiscvGen(self.args)
-        s = Solver()
+        return self.cegis_general(gen.sym_gen, cancel=cancel)
+
+    # searches for the cheapest program under the cost model (cycles of a core, see cost_model) instead of the
+    # shortest one, with cost_gen as generator. every verified program lowers the bound, and the search goes on with
+    # the examples found so far until no cheaper sketch of at most extra_len more instructions than the first program
+    # is left. a program of division_tier is the first bound, and then only programs of up to tier_search_len
+    # instructions are searched. returns the cheapest program, or a PartialResult with it as candidate if cancelled
+    def cegis_cost(self, cost_model: None | CostModel = None, extra_len: int = 1,
+                   cancel: None | CancelToken = None) -> List[Instr] | PartialResult:
+        gen = RiscvGen(self.args)
+        if cost_model is not None:
+            gen.cost_model = cost_model
+        gen.cost_extra_len = extra_len
+        params = json.dumps({"gen": gen.params(), "costs": gen.cost_model.costs, "extra_len": extra_len})
+        if self.cache is not None and self.expr_key is not None:
+            hit = self.cache.lookup(self.expr_key, "cost_gen", params, self.args)
+            if hit is not None and self.verify(hit[0]):
+                return hit[0]
+        start = time.perf_counter()
+        cache, self.cache = self.cache, None  # only the final program is stored
+        examples = self.first_examples()  # extended by every cegis_general call
+        best = self.division_tier() if self.use_tiers else None
+        if best is not None:
+            gen.cost_found(best)
+            gen.cost_max_len = min(len(best), self.tier_search_len)
+        stats = {"iterations": 0, "sketches": 0, "z3_checks": 0}
+        try:
+            while True:
+                gen.stats = {"sketches": 0, "z3_checks": 0}
+                try:
+                    prog = self.cegis_general(gen.cost_gen, examples, cancel=cancel)
+                except SearchExhausted:
+                    break
+                finally:
+                    for key in stats:
+                        stats[key] += self.stats[key]
+                if isinstance(prog, PartialResult):
+                    return PartialResult(best, prog.min_len, prog.examples, stats["iterations"])
+                best = prog
+                gen.cost_found(prog)
+        finally:
+            self.cache = cache
+            self.stats = stats
+        if best is None:
+            raise Exception("No posssible program was found!")
+        if self.cache is not None and self.expr_key is not None:
+            self.cache.store(self.expr_key, "cost_gen", params, best, len(best) - 1, time.perf_counter() - start)
+        return best
+
+    # does not use cegis but just bottom up enumeration: the first sketch for which constants exist that make it equal
+    # to the goal function on all inputs is returned. candidates are first run on a pool of concrete inputs, those
+    # without immediates with numpy, and constants are solved for on the pool and checked on all inputs. inputs found
+    # by these checks are added to the pool. only the remaining candidates get the quantified query.
+    # returns a PartialResult with the depth reached if the cancel token is cancelled or expires
+    def bottom_up(self, cancel: None | CancelToken = None) -> None | List[Instr] | PartialResult:
+        gen = RiscvGen(self.args)
+        gen.cancel = cancel
+        gen.profiler = self.profiler
+        self.stats = {"iterations": 0, "sketches": 0, "z3_checks": 0}
 
         max_depth = 5
         sym_args = {}
-
-        s.add(self.z3args[repr(Zero())] == 0)
         for arg in self.args:
             sym_args[arg] = BitVec(arg, 64)
             self.z3args[arg] = sym_args[arg]
-            s.add(self.z3args[arg] < 256)
-            s.add(self.z3args[arg] >= -256)
+        goal_sym = self.goal_func(*[sym_args[x] for x in self.args])
+        pool = self._test_inputs()
+        expected = [self._goal_value(x) for x in pool]
+
+        def pool_filtered(sketches: Iterable[Tuple[int, ...]]) -> Iterable[Tuple[int, ...]]:
+            while True:
+                batch = list(itertools.islice(sketches, gen.batch_size))
+                if len(batch) == 0:
+                    return
+                free = [i for i, p in enumerate(batch) if all(instr >> 24 >= imm_ops for instr in p)]
+                dropped = set()
+                if len(free) > 0:
+                    inputs = np.array(pool, dtype=np.int64).reshape(len(pool), len(self.args))
+                    outputs = run_batch(np.array([batch[i] for i in free], dtype=np.uint32), inputs, smt=True)
+                    keep = (outputs == np.array(expected, dtype=np.int64)).all(axis=1)
+                    dropped = {free[i] for i in np.flatnonzero(~keep)}
+                    if self.profiler is not None:
+                        self.profiler.count("pruned_batch", len(dropped), len(batch[0]))
+                gen.stats["sketches"] += len(dropped)
+                yield from (p for i, p in enumerate(batch) if i not in dropped)
 
-        for i in range(max_depth):
-            if len(self.args) == 2:
-                x = self.goal_func(2, 3)
-            for candidate in gen.dp_sketches_yield(i):
-                s = gen.s
-                s.push()
-                cand_res = run_riscv(candidate, sym_args, s)
-                func_res = self.goal_func(*[self.z3args[x] for x in self.args])
-                self._avoid_zero_div(s, func_res)
-                forall_args = [val for key, val in self.z3args.items() if key != repr(Zero())]
-                if forall_args != []:
-                    s.add(ForAll(forall_args, cand_res == func_res))
-                else:
-                    s.add(cand_res == func_res)
-                if s.check() == sat:
-                    new_cand = gen.replace_consts(candidate)
-                    return new_cand
-                s.pop()
-                gen.s = s
+        try:
+            for i in range(max_depth):
+                for p in pool_filtered(gen.dp_sketches_packed(i)):
+                    gen.tried(p)
+                    if not self._consts_on_pool(gen, p, pool, expected, goal_sym, sym_args):
+                        continue
+                    candidate = decode_sketch(p, self.args, gen.consts)
+                    s = gen.s
+                    s.push()
+                    cand_res = run_riscv(candidate, sym_args, s)
+                    func_res = self.goal_func(*[self.z3args[x] for x in self.args])
+                    self._avoid_zero_div(s, func_res)
+                    forall_args = [val for key, val in self.z3args.items() if key != repr(Zero())]
+                    if forall_args != []:
+                        s.add(ForAll(forall_args, cand_res == func_res))
+                    else:
+                        s.add(cand_res == func_res)
+                    if gen.check(s) == sat:
+                        new_cand = gen.replace_consts(candidate)
+                        return new_cand
+                    s.pop()
+        except SynthesisCancelled:
+            return PartialResult(None, i, [], 0)
+        finally:
+            self.stats["sketches"] += gen.stats["sketches"]
+            self.stats["z3_checks"] += gen.stats["z3_checks"]
+
+    # initial pool of bottom_up: small values, values at the ends of the 64 bit range and random ones
+    def _test_inputs(self, count: int = 16) -> List[List[int]]:
+        rng = random.Random(0)
+        interesting = [0, 1, -1, 2, 3, -7, 12, 63, 64, 255, -256, 1 << 40, (1 << 63) - 1, -(1 << 63)]
+        pool = [[0] * len(self.args)]
+        while len(pool) < count:
+            pool.append([rng.choice(interesting) if rng.random() < 0.5 else rng.randint(-(1 << 63), (1 << 63) - 1)
+                         for _ in self.args])
+        return pool
+
+    # value of the goal function with the semantics of z3, as signed 64 bit integer
+    def _goal_value(self, inputs: List[int]) -> int:
+        r = self.goal_func(*[BitVecVal(x, 64) for x in inputs])
+        return to_signed64(r) if type(r) is int else simplify(r).as_signed_long()
+
+    # False if no constants make sketch p agree with the goal on the pool, which rules it out for bottom_up. otherwise,
+    # the constants found are checked on all inputs, and a mismatch is added to the pool before solving again.
+    # the constraints on the constants are the ones of the quantified query. with few constants, all of their values
+    # are tried with numpy, otherwise z3 solves for them
+    def _consts_on_pool(self, gen: RiscvGen, p: Tuple[int, ...], pool: List[List[int]], expected: List[int],
+                        goal_sym, sym_args: dict[str, BitVecRef]) -> bool:
+        slots = const_slots(p)
+        if len(slots) <= self.max_brute_slots:
+            combos = self._brute_consts(gen, p, slots, pool, expected)
+            while len(combos) > 0:
+                mismatch = self._find_mismatch(gen, p, {i: int(combos[0, i]) for i in slots}, goal_sym, sym_args)
+                if mismatch is None:
+                    return True
+                pool.append(mismatch)
+                expected.append(self._goal_value(mismatch))
+                combos = self._brute_consts(gen, p, slots, pool[-1:], expected[-1:], combos)
+            return False
 
+        s = gen.s
+        s.push()
+        for instr in p:
+            if ops[instr >> 24] in ('slli', 'srai'):
+                s.add(gen.consts[instr & 0xff] > 0)
+        for inputs, output in zip(pool, expected):
+            s.add(run_packed_smt(p, inputs, gen.consts) == output)
+        try:
+            while True:
+                r = gen.check(s)
+                if r != sat:
+                    return r == unknown
+                model = s.model()
+                consts = {i: model.eval(gen.consts[i], model_completion=True).as_signed_long() for i in slots}
+                mismatch = self._find_mismatch(gen, p, consts, goal_sym, sym_args)
+                if mismatch is None:
+                    return True
+                pool.append(mismatch)
+                expected.append(self._goal_value(mismatch))
+                s.add(run_packed_smt(p, mismatch, gen.consts) == expected[-1])
+        finally:
+            s.pop()
+
+    # the rows of combos (all values of the constants if None) with which p computes the expected outputs on the
+    # inputs. rows are indexed by constant index
+    def _brute_consts(self, gen: RiscvGen, p: Tuple[int, ...], slots: List[int], inputs: List[List[int]],
+                      expected: List[int], combos: None | np.ndarray = None) -> np.ndarray:
+        if combos is None:
+            domains = []
+            for slot in slots:
+                shifted = any(ops[instr >> 24] in ('slli', 'srai') and instr & 0xff == slot for instr in p)
+                lui = any(ops[instr >> 24] == 'lui' and instr & 0xff == slot for instr in p)
+                low = max(gen.c_min, 1 if shifted else lui_min if lui else gen.c_min)
+                domains.append(np.arange(low, min(gen.c_max, lui_max) + 1 if lui else gen.c_max + 1))
+            combos = np.zeros((int(np.prod([len(d) for d in domains])), max(slots, default=0) + 1), dtype=np.int64)
+            for slot, values in zip(slots, np.meshgrid(*domains, indexing='ij')):
+                combos[:, slot] = values.ravel()
+        for x, output in zip(inputs, expected):  # one input at a time, the rows left get fewer quickly
+            if len(combos) == 0:
+                break
+            programs = np.broadcast_to(np.array(p, dtype=np.uint32), (len(combos), len(p)))
+            results = run_batch(programs, np.array([x], dtype=np.int64).reshape(1, len(self.args)), combos, smt=True)
+            combos = combos[results[:, 0] == output]
+        return combos
+
+    # inputs on which p with the given constants differs from the goal, None if there are none
+    def _find_mismatch(self, gen: RiscvGen, p: Tuple[int, ...], consts: dict[int, int], goal_sym,
+                       sym_args: dict[str, BitVecRef]) -> None | List[int]:
+        s = Solver()
+        s.add(run_packed_smt(p, [sym_args[x] for x in self.args], consts) != goal_sym)
+        if gen.check(s) != sat:
+            return None
+        model = s.model()
+        return [model.eval(sym_args[x], model_completion=True).as_signed_long() for x in self.args]
 
 
 if __name__ == "__main__":
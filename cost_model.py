@@ -0,0 +1,56 @@
+# cost of programs in cycles of a target core instead of their number of instructions. a cost model is a table of
+# integer costs per op, used by RiscvGen.cost_gen to search for the cheapest program
+import json
+from typing import List, Sequence
+from riscv_dsl import Instr
+
+__all__ = ["CostModel", "cost_models", "load_cost_model"]
+
+
+class CostModel:
+    name: str
+    costs: dict[str, int]  # cost of every op, at least 1
+    packed: List[int]  # costs by opcode of packed_dsl
+
+    def __init__(self, costs: dict[str, int], name: str = "custom"):
+        missing = [op for op in Instr.arith_ops if op not in costs]
+        if missing:
+            raise Exception("Cost model has no cost for " + ", ".join(missing))
+        if any(type(c) is not int or c < 1 for c in costs.values()):
+            raise Exception("Costs must be positive integers")
+        self.name = name
+        self.costs = dict(costs)
+        self.packed = [costs[op] for op in Instr.arith_ops]
+
+    def op_cost(self, op: str) -> int:
+        return self.costs[op]
+
+    def cost(self, instrs: List[Instr]) -> int:
+        return sum(self.costs[instr.op] for instr in instrs)
+
+    def packed_cost(self, sketch: Sequence[int]) -> int:
+        return sum(self.packed[instr >> 24] for instr in sketch)
+
+    def cheapest(self) -> int:
+        return min(self.costs.values())
+
+    def __repr__(self) -> str:
+        return f"CostModel({self.name})"
+
+
+# count: every instruction costs the same, i.e. the shortest program is the cheapest.
+# in_order: rough latencies of a small in-order RV64 core with a pipelined multiplier and an iterative divider
+cost_models: dict[str, CostModel] = {
+    "count": CostModel({op: 1 for op in Instr.arith_ops}, "count"),
+    "in_order": CostModel({"addi": 1, "subi": 1, "slli": 1, "srai": 1, "andi": 1, "lui": 1, "add": 1, "sub": 1,
+                           "and": 1, "or": 1, "xor": 1, "sltu": 1, "mul": 3, "mulh": 3, "div": 20, "rem": 20},
+                          "in_order"),
+}
+
+
+# name of one of cost_models, or a JSON file with an object of op names and costs
+def load_cost_model(name: str) -> CostModel:
+    if name in cost_models:
+        return cost_models[name]
+    with open(name) as f:
+        return CostModel(json.load(f), name)
@@ -0,0 +1,165 @@
+# synthesis of expressions that are too large for a single search: the expression is split into chunks of at most
+# max_ops operations, every chunk is synthesized on its own (the values of other chunks are arguments t0, t1, ...),
+# and the programs of the chunks are joined with new registers. the windows across the joins are synthesized again
+# with the peephole rules, and the whole program is verified
+import ast
+import concurrent.futures
+import multiprocessing
+import time
+from typing import List, Tuple
+from riscv_dsl import *
+from cegis_verify import Verifier
+from cancellation import CancelToken, PartialResult
+from peephole import RewriteDB, mine, peephole
+from python_ast_to_func import canonical_expr
+
+__all__ = ["split_expr", "join_programs", "divide_and_conquer"]
+
+
+def _operands(node: ast.AST) -> List[ast.AST]:
+    match node:
+        case ast.BinOp(left, _, right):
+            return [left, right]
+        case ast.Call(args=args):
+            return args
+        case ast.UnaryOp(ast.USub(), ast.Constant()):
+            return []  # a negative constant
+        case ast.UnaryOp(_, operand):
+            return [operand]
+    return []
+
+
+# the number of instructions of node without its operands: constant operands of mul, div and rem are loaded first
+def _own_size(node: ast.AST) -> int:
+    match node:
+        case ast.BinOp(left, ast.Mult() | ast.Div() | ast.FloorDiv() | ast.Mod(), right) | ast.Call(args=[left, right]):
+            return 1 + sum(len(_operands(o)) == 0 and not isinstance(o, ast.Name) for o in [left, right])
+    return 1
+
+
+def _replace_operand(node: ast.AST, old: ast.AST, new: ast.AST):
+    match node:
+        case ast.BinOp():
+            if node.left is old:
+                node.left = new
+            else:
+                node.right = new
+        case ast.Call():
+            node.args = [new if a is old else a for a in node.args]
+        case ast.UnaryOp():
+            node.operand = new
+
+
+# chunks of the expression (in the canonical form of canonical_expr, arguments v0, v1, ...) in the order they have
+# to be computed: names t0, t1, ... and expressions of at most max_ops operations (see _own_size). the last chunk is
+# the result
+def split_expr(expr_key: str, max_ops: int = 2) -> List[Tuple[str, str]]:
+    chunks = []
+
+    # returns the operations of node that are not cut off into chunks yet
+    def split(node: ast.AST) -> int:
+        operands = _operands(node)
+        if len(operands) == 0:
+            return 0
+        ops = {id(operand): split(operand) for operand in operands}
+        total = _own_size(node) + sum(ops.values())
+        for operand in sorted(operands, key=lambda o: -ops[id(o)]):
+            if total <= max_ops or ops[id(operand)] == 0:
+                break
+            name = "t" + str(len(chunks))
+            chunks.append((name, ast.unparse(operand)))
+            _replace_operand(node, operand, ast.Name(id=name, ctx=ast.Load()))
+            total -= ops[id(operand)]
+        return total
+
+    tree = ast.parse(expr_key, mode='eval')
+    split(tree.body)
+    chunks.append(("t" + str(len(chunks)), ast.unparse(tree.body)))
+    return chunks
+
+
+# joins the programs of the chunks (name, arguments of the chunk program, program) to one program with its result in
+# a0. every value written by a chunk gets a register of its own while it is used; the arguments of the expression
+# start in a1, a2, ... and their registers are used for other values once they are no longer needed.
+# returns the program and the positions at which the chunks start
+def join_programs(chunks: List[Tuple[str, List[str], List[Instr]]], args: List[str]) -> Tuple[List[Instr], List[int]]:
+    value_of = {"v" + str(i): i for i in range(len(args))}
+    reg_of = {i: Regvar(i + 1, a) for i, a in enumerate(args)}
+    values = len(args)
+    program = []  # op, value written, values read (None for x0) and immediate
+    starts = []
+    for name, chunk_args, prog in chunks:
+        starts.append(len(program))
+        current = {Regvar(i + 1, a): value_of[a] for i, a in enumerate(chunk_args)}
+        for instr in prog:
+            srcs = [None if isinstance(a, Zero) else current[a] for a in instr.args[1:] if isinstance(a, Reg)]
+            imm = instr.args[-1] if not isinstance(instr.args[-1], Reg) else None
+            program.append((instr.op, values, srcs, imm))
+            current[instr.args[0]] = values
+            values += 1
+        value_of[name] = current[ReturnReg()]
+    result = value_of[chunks[-1][0]]
+
+    last_use = {result: len(program)}
+    for i, (_, _, srcs, _) in enumerate(program):
+        for s in srcs:
+            if s is not None:
+                last_use[s] = max(last_use.get(s, -1), i)
+    free = [Reg(r) for r in reversed(Reg.const_regs)]
+    instrs = []
+    for i, (op, value, srcs, imm) in enumerate(program):
+        operands = [Zero() if s is None else reg_of[s] for s in srcs]
+        for s in set(srcs):
+            if s is not None and last_use[s] == i:
+                free.append(reg_of[s])  # the result may be written to the same register
+        if value == result:
+            reg_of[value] = ReturnReg()
+        elif len(free) == 0:
+            raise Exception("ran out of temporary registers!")
+        else:
+            reg_of[value] = free.pop()
+        if value not in last_use and value != result:
+            free.append(reg_of[value])
+        instrs.append(Instr(op, reg_of[value], *operands, *([] if imm is None else [imm])))
+    return instrs, starts
+
+
+# deadline is a time.monotonic() for all chunks, so a chunk that waited for a worker only gets the time that is left
+def _synthesize_chunk(expr: str, deadline: None | float) -> Tuple[List[str], List[Instr] | PartialResult]:
+    verifier = Verifier.fromStr(expr)
+    cancel = None if deadline is None else CancelToken(max(0.0, deadline - time.monotonic()))
+    return verifier.args, verifier.cegis_2(cancel=cancel)
+
+
+# synthesizes expr chunk by chunk, with a pool of workers processes if workers > 1. the windows of up to
+# max_window instructions across the joins are synthesized and rewritten with rules (by default kept in memory).
+# returns the verified program, or a PartialResult without candidate if a chunk was not found within timeout seconds
+def divide_and_conquer(expr: str, workers: int = 1, timeout: None | float = None, max_ops: int = 2,
+                       max_window: int = 3, rules: None | RewriteDB = None) -> List[Instr] | PartialResult:
+    verifier = Verifier.fromStr(expr)
+    chunks = split_expr(canonical_expr(ast.parse(expr, mode='eval')), max_ops)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    remaining = lambda: None if deadline is None else max(0.0, deadline - time.monotonic())
+    if workers > 1 and len(chunks) > 1:
+        ctx = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+        with concurrent.futures.ProcessPoolExecutor(workers, mp_context=ctx) as pool:
+            results = list(pool.map(_synthesize_chunk, [c for _, c in chunks], [deadline] * len(chunks)))
+    else:
+        results = [_synthesize_chunk(c, deadline) for _, c in chunks]
+    if any(isinstance(prog, PartialResult) for _, prog in results):
+        return PartialResult(None, 0, [], 0)
+
+    joined, starts = join_programs([(name, args, prog) for (name, _), (args, prog) in zip(chunks, results)],
+                                   verifier.args)
+    rules = RewriteDB(":memory:") if rules is None else rules
+    for start in starts[1:]:
+        if deadline is not None and time.monotonic() >= deadline:
+            break
+        mine(rules, joined[max(0, start - max_window + 1):start + max_window - 1], max_window,
+             10.0 if deadline is None else max(0.1, min(10.0, remaining())))
+    optimized = peephole(joined, rules, max_window=max_window)
+    if verifier.verify(optimized):
+        return optimized
+    if verifier.verify(joined):
+        return joined
+    raise Exception("The joined program does not match the expression")
@@ -46,6 +46,9 @@ def input_to_ast(f_name: str) -> List[Instr]:
             if len(words) >= 1 and words[0] in Instr.arith_ops:
                 try:
                     dest = words[1][:-1]  # erase comma
+                    if words[0] == 'lui':  # only destination and immediate
+                        r += [Instr(words[0], identify_reg(dest), Zero(), lui_signed(int(words[2])))]
+                        continue
                     arg1 = words[2][:-1]
                     arg2 = words[3]
                     if words[0][-1] == 'i':  # immediate op
@@ -36,10 +36,22 @@ def _to_ast(operator: str, arg1: str | BinOp | Call, arg2: str | int | BinOp | C
             return Call(func=Name(id='pydiv', ctx=Load()), args=[leftval, rightval], keywords=[])
         case "rem":
             return Call(func=Name(id='pymod', ctx=Load()), args=[leftval, rightval], keywords=[])
-        case "slli":
+        case "slli" | "sll":
             opval = LShift()
-        case "srai":
+        case "srai" | "sra":
             opval = RShift()
+        case "and" | "andi":
+            opval = BitAnd()
+        case "or":
+            opval = BitOr()
+        case "xor":
+            opval = BitXor()
+        case "sltu":
+            return Call(func=Name(id='pysltu', ctx=Load()), args=[leftval, rightval], keywords=[])
+        case "mulh":
+            return Call(func=Name(id='pymulh', ctx=Load()), args=[leftval, rightval], keywords=[])
+        case "lui":
+            return BinOp(left=rightval, op=LShift(), right=Constant(value=12))
 
     return BinOp(left=leftval, op=opval, right=rightval)
 
@@ -0,0 +1,116 @@
+# division and remainder by a constant without div and rem: the quotient is computed with a multiplication by a
+# "magic" constant and a shift (Granlund and Montgomery, as in Hacker's Delight, chapter 10), plus a correction for
+# negative results. used by Verifier.division_tier before the search, the results are checked with the verifier
+from ast import *
+from typing import List, Tuple
+from riscv_dsl import *
+from run_riscv import to_signed64
+
+__all__ = ["magic_signed", "load_const", "lower_division", "constant_division"]
+
+
+# magic number and shift for signed 64 bit division by d, |d| >= 2: x / d is (mulh(x, M) (+/- x)) >> s, rounded
+# towards zero
+def magic_signed(d: int) -> Tuple[int, int]:
+    two63 = 1 << 63
+    ad = abs(d)
+    t = two63 + (1 if d < 0 else 0)
+    anc = t - 1 - t % ad  # absolute value of nc
+    p = 63
+    q1, r1 = divmod(two63, anc)
+    q2, r2 = divmod(two63, ad)
+    while True:
+        p += 1
+        q1, r1 = 2 * q1, 2 * r1
+        if r1 >= anc:
+            q1, r1 = q1 + 1, r1 - anc
+        q2, r2 = 2 * q2, 2 * r2
+        if r2 >= ad:
+            q2, r2 = q2 + 1, r2 - ad
+        delta = ad - r2
+        if not (q1 < delta or (q1 == delta and r1 == 0)):
+            break
+    m = q2 + 1
+    return to_signed64(-m if d < 0 else m), p - 64
+
+
+# instructions that load a 64 bit value into reg, with 20 bit lui and 12 bit addi immediates like the li pseudo
+# instruction: the low 12 bits are added last, and the rest is loaded the same way and shifted into place. the lui
+# immediate is kept signed (lui_min..lui_max) and written as its 20 bits, e.g. lui x5, 1048575 for -4096
+def load_const(reg: Reg, value: int) -> List[Instr]:
+    value = to_signed64(value)
+    if -2048 <= value < 2048:
+        return [Instr("addi", reg, Zero(), value)]
+    if -(1 << 31) <= value < (1 << 31) - 2048:
+        hi = (value + 0x800) >> 12  # in lui_min..lui_max
+        lo = value - (hi << 12)
+        return [Instr("lui", reg, Zero(), hi)] + ([Instr("addi", reg, reg, lo)] if lo != 0 else [])
+    lo = ((value & 0xfff) ^ 0x800) - 0x800  # sign extended, like the immediate of addi
+    rest = (value - lo) >> 12
+    shift = 12
+    while rest & 1 == 0:
+        rest >>= 1
+        shift += 1
+    return load_const(reg, rest) + [Instr("slli", reg, reg, shift)] + ([Instr("addi", reg, reg, lo)] if lo != 0 else [])
+
+
+# program computing x / d (kind "div") or x % d (kind "rem") into a0, for the argument in register x, rounded towards
+# zero like div and rem. temporary registers are taken from Reg.const_regs
+def lower_division(kind: str, x: Reg, d: int) -> List[Instr]:
+    if d == 0:
+        raise Exception("division by zero")
+    m_reg, q, t = Reg(Reg.const_regs[0]), Reg(Reg.const_regs[1]), Reg(Reg.const_regs[2])
+    ad = abs(d)
+    if ad == 1 and kind == "rem":
+        return [Instr("addi", ReturnReg(), Zero(), 0)]
+    if ad == 1:
+        prog = [Instr("addi", q, x, 0) if d == 1 else Instr("sub", q, Zero(), x)]
+    elif ad & (ad - 1) == 0:  # power of two: add 2^k - 1 to negative dividends before the shift
+        k = ad.bit_length() - 1
+        prog = [Instr("srai", t, x, 63)]
+        if ad - 1 < 2048:
+            prog += [Instr("andi", t, t, ad - 1)]
+        else:
+            prog += load_const(m_reg, ad - 1) + [Instr("and", t, t, m_reg)]
+        prog += [Instr("add", t, x, t), Instr("srai", q, t, k)]
+        if d < 0:
+            prog += [Instr("sub", q, Zero(), q)]
+    else:
+        m, s = magic_signed(d)
+        prog = load_const(m_reg, m) + [Instr("mulh", q, x, m_reg)]
+        if d > 0 and m < 0:
+            prog += [Instr("add", q, q, x)]
+        elif d < 0 and m > 0:
+            prog += [Instr("sub", q, q, x)]
+        if s > 0:
+            prog += [Instr("srai", q, q, s)]
+        prog += [Instr("srai", t, q, 63), Instr("sub", q, q, t)]  # adds 1 to negative quotients
+    if kind == "div":
+        return prog[:-1] + [Instr(prog[-1].op, ReturnReg(), *prog[-1].args[1:])]
+    # x - q * d
+    if ad & (ad - 1) == 0:
+        k = ad.bit_length() - 1
+        prog += [Instr("slli", t, q, k)] if d > 0 else [Instr("slli", t, q, k), Instr("sub", t, Zero(), t)]
+    else:
+        prog += load_const(m_reg, d) + [Instr("mul", t, q, m_reg)]
+    return prog + [Instr("sub", ReturnReg(), x, t)]
+
+
+# ("div" or "rem", d) if the goal expression, in the canonical form of python_ast_to_func.canonical_expr, is the
+# division or remainder of its only argument by the constant d
+def constant_division(expr_key: str) -> None | Tuple[str, int]:
+    match parse(expr_key, mode='eval').body:
+        case Call(func=Name(id='pydiv' | 'pymod' as f), args=[Name(id='v0'), divisor]):
+            pass
+        case _:
+            return None
+    match divisor:
+        case Constant(value=int(d)):
+            pass
+        case UnaryOp(op=USub(), operand=Constant(value=int(d))):
+            d = -d
+        case _:
+            return None
+    if d == 0:
+        return None
+    return ("div" if f == "pydiv" else "rem"), d
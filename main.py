@@ -6,9 +6,17 @@ from cegis_verify import *
 from synthesis import *
 from dsl_input_output import *
 from dsl_to_func import to_func
+from cancellation import CancelToken, PartialResult
+from batch_synthesis import synthesize_batch, read_batch
+from cost_model import load_cost_model
+from peephole import RewriteDB, peephole
+from divide_conquer import divide_and_conquer
+import argparse
+import os
+import sys
 
 
-def input_to_naive_riscv():
+def input_to_naive_riscv(rules: None | str = None):
     choice_for_input_type = input("Do you wish to enter an arithmetic expression (1) or use a RISC-V assembly file as input (2)? ")
     if int(choice_for_input_type) == 2:
         in_file = input("Please enter the name of the input file: ")
@@ -21,26 +29,44 @@ def input_to_naive_riscv():
     print("\n======================================\n")
     c = Compiler()
     res = c.compile_input(in_expr)
+    if rules is not None:
+        db = RewriteDB(rules)
+        try:
+            res = peephole(res, db)
+        finally:
+            db.close()
     ast_to_output(res, f_name="out.s")
     ast_to_output(res)
     print("\n======================================\n")
     print("output with all arguments set to 1, 2, ... , n:", run_riscv(res, example_dict))
 
 
-def input_to_synthesized_riscv():
+def input_to_synthesized_riscv(workers: int = 1, checkpoint: None | str = None, timeout: None | float = None,
+                                cost: bool = False, split: bool = False):
     choice_for_input_type = input("Do you wish to enter an arithmetic expression (1) or use a RISC-V assembly file as input (2)? ")
     if int(choice_for_input_type) == 2:
         in_file = input("Please enter the name of the input file: ")
         in_func, in_args = to_func(input_to_ast(in_file))
-        synth = Verifier.fromRiscv(input_to_ast(in_file))
+        synth = Verifier.fromRiscv(input_to_ast(in_file), workers)
     else:
         in_expr = input("Please enter an arithmetic expression: ")
         in_expr_tree = parse(in_expr, mode='eval')
         in_func, in_args = expr_to_func(in_expr_tree)  # convert input to python lambda with variables as args
-        synth = Verifier.fromStr(in_expr)
+        synth = Verifier.fromStr(in_expr, workers)
     example_dict = {in_args[x]: (x + 1) for x in range(len(in_args))}  # for testing purposes
     print("\n======================================\n")
-    res = synth.cegis_2()
+    cancel = None if timeout is None else CancelToken(timeout)
+    if split and int(choice_for_input_type) != 2:
+        res = divide_and_conquer(in_expr, workers, timeout)
+    else:
+        res = synth.cegis_cost(cancel=cancel) if cost else synth.cegis_2(checkpoint, cancel)
+    if isinstance(res, PartialResult) and res.candidate is not None:
+        print(f"Stopped after {timeout} seconds, the cheapest program found so far is used.")
+        res = res.candidate
+    elif isinstance(res, PartialResult):
+        print(f"No program found within {timeout} seconds; programs with less than {res.min_len + 1} instructions "
+              f"were ruled out by {len(res.examples)} examples.")
+        return
     ast_to_output(res, f_name="out.s")
     print(res, "\n")
     ast_to_output(res)
@@ -62,7 +88,7 @@ def output_example_riscv_file():
 
 def output_help_text():
     print("This is a tool for synthesizing RISC-V assembly code from an arithmetic expression.\n" \
-    "Supported operators are +, -, <<, >>, *, /, %. You may use variables of any name.\n" \
+    "Supported operators are +, -, <<, >>, *, /, %, &, |, ^. You may use variables of any name.\n" \
     "In Option (1) or (2) you will be prompted to either input a supported arithmetic expression directly,\n" \
     "or enter the name of a RISC-V assembly file that describes a supported arithmetic expression.\n" \
     "A solution will be computed and shown in the terminal and saved in out.s.\n"\
@@ -72,6 +98,39 @@ def output_help_text():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthesis of RISC-V assembly for arithmetic expressions")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes used for the synthesis")
+    parser.add_argument("--checkpoint", help="file to save the progress of the synthesis in, and to resume it from")
+    parser.add_argument("--timeout", type=float, help="seconds after which the synthesis stops")
+    parser.add_argument("--batch", help="file with one expression or RISC-V file per line, synthesized without prompts")
+    parser.add_argument("--out", default="batch_out", help="directory for the results of --batch")
+    parser.add_argument("--tables", help="directory to store the sketch tables in, and to load them from")
+    parser.add_argument("--cost", help="search for the cheapest program under a cost model instead of the shortest "
+                                       "one: in_order, count or a JSON file of costs per op")
+    parser.add_argument("--extended", action="store_true",
+                        help="also search with andi, lui, and, or, xor, sltu and mulh (larger search space)")
+    parser.add_argument("--split", action="store_true",
+                        help="synthesize large expressions in parts of two operations and join them (option 2)")
+    parser.add_argument("--rules", help="database of rewrite rules (see peephole.py) applied to the naive compilation")
+    cli_args = parser.parse_args()
+    if cli_args.rules is not None and not os.path.exists(cli_args.rules):
+        parser.error("rules database " + cli_args.rules + " does not exist")
+    RiscvGen.table_dir = cli_args.tables
+    if cli_args.extended:
+        RiscvGen.arith_ops_imm = RiscvGen.extended_ops_imm
+        RiscvGen.arith_ops = RiscvGen.extended_ops
+    if cli_args.cost is not None:
+        RiscvGen.cost_model = load_cost_model(cli_args.cost)
+
+    if cli_args.batch is not None:
+        results = synthesize_batch(read_batch(cli_args.batch), cli_args.out, cli_args.workers, cli_args.timeout,
+                                   "cegis_2" if cli_args.cost is None else "cegis_cost")
+        counts = {}
+        for result in results:
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+        print(", ".join(f"{n} {status}" for status, n in counts.items()), "- see", os.path.join(cli_args.out, "manifest.json"))
+        sys.exit(0 if counts.get("ok", 0) == len(results) else 1)
+
     print("Available functions:")
     choice = int(input("User Input to Naive RISC-V (1)\n" \
                        "User Input to Synthesized RISC-V (2)\n" \
@@ -80,9 +139,10 @@ if __name__ == "__main__":
     print("\n======================================\n")
     match choice:
         case 1:
-            input_to_naive_riscv()
+            input_to_naive_riscv(cli_args.rules)
         case 2:
-            input_to_synthesized_riscv()
+            input_to_synthesized_riscv(cli_args.workers, cli_args.checkpoint, cli_args.timeout, cli_args.cost is not None,
+                                       cli_args.split)
         case 3:
             output_help_text()
         case 4:
@@ -0,0 +1,277 @@
+# compact encoding of instructions for the sketch generators. an instruction is a single int
+# (opcode << 24 | dest << 16 | src1 << 8 | src2) that fits into an uint32, and a sketch is a tuple of these ints.
+# for immediate instructions, src2 is the index of the z3 constant used as immediate instead of a register.
+# Instr objects are only created when a sketch is decoded
+from riscv_dsl import *
+from run_riscv import to_signed64, s64_op, InvalidSample
+from typing import List, Tuple, Sequence
+from z3 import BitVecRef, BitVecVal, Solver
+
+ops: List[str] = Instr.arith_ops
+imm_ops: int = 6  # opcodes below this one take an immediate
+assert all(op[-1] == 'i' for op in ops[:imm_ops]) and all(op[-1] != 'i' for op in ops[imm_ops:])
+
+# register numbering: x0, a1 - a7, a0, then the temporary registers in the order of Reg.const_regs
+ZERO: int = 0
+RETURN: int = 8
+num_regs: int = 9 + len(Reg.const_regs)
+
+
+def reg_code(r: Reg) -> int:
+    if isinstance(r, Zero):
+        return ZERO
+    if isinstance(r, ReturnReg):
+        return RETURN
+    if isinstance(r, Regvar):
+        return r.num
+    return 9 + Reg.const_regs.index(r.num)
+
+
+# args are the names of the function arguments, which are bound to a1, a2, ...
+def code_reg(code: int, args: List[str]) -> Reg:
+    if code == ZERO:
+        return Zero()
+    if code == RETURN:
+        return ReturnReg()
+    if code < RETURN:
+        return Regvar(code, args[code - 1])
+    return Reg(Reg.const_regs[code - 9])
+
+
+# src2 is a register or, for immediate ops, the index of the constant
+def encode(op: str, dest: Reg, src1: Reg, src2: Reg | int) -> int:
+    last = src2 if type(src2) is int else reg_code(src2)
+    assert 0 <= last <= 0xff, "constant index does not fit into the src2 field"
+    return ops.index(op) << 24 | reg_code(dest) << 16 | reg_code(src1) << 8 | last
+
+
+def fields(instr: int) -> Tuple[int, int, int, int]:
+    return instr >> 24, (instr >> 16) & 0xff, (instr >> 8) & 0xff, instr & 0xff
+
+
+def const_slots(sketch: Sequence[int]) -> List[int]:
+    return list(dict.fromkeys(instr & 0xff for instr in sketch if instr >> 24 < imm_ops))
+
+
+# builds the Instr objects for a sketch. consts maps the constant indices to the immediates to use (ints or z3 constants)
+def decode_sketch(sketch: Sequence[int], args: List[str], consts: Sequence[int | BitVecRef] | dict[int, int]) -> List[Instr]:
+    result = []
+    for instr in sketch:
+        op, dest, src1, src2 = fields(instr)
+        last = consts[src2] if op < imm_ops else code_reg(src2, args)
+        result.append(Instr(ops[op], code_reg(dest, args), code_reg(src1, args), last))
+    return result
+
+
+# packed counterpart of run_riscv: inputs are the values of a1, a2, ..., consts the z3 constants for the immediates
+def run_packed(sketch: Sequence[int], inputs: Sequence[int | BitVecRef], consts: Sequence[BitVecRef], s: Solver) -> int | BitVecRef:
+    regs: List = [None] * num_regs
+    regs[ZERO] = 0
+    regs[1:len(inputs) + 1] = inputs
+    for instr in sketch:
+        op, dest, src1, src2 = instr >> 24, (instr >> 16) & 0xff, (instr >> 8) & 0xff, instr & 0xff
+        name = ops[op]
+        left = regs[src1]
+        if left is None:
+            raise Exception("register read before it was written")
+        if op < imm_ops:
+            right = consts[src2]
+            if name == 'slli' or name == 'srai':
+                s.add(right > 0)
+            if name == 'lui':
+                s.add(right >= lui_min, right <= lui_max)
+        else:
+            right = regs[src2]
+            if right is None:
+                raise Exception("register read before it was written")
+            if name == 'div' or name == 'rem':
+                s.add(right != 0)
+        regs[dest] = match_op(name)(left, right)
+    return regs[RETURN]
+
+
+# packed counterpart of run_riscv_concrete. consts maps the constant indices to integers
+def run_packed_concrete(sketch: Sequence[int], inputs: Sequence[int], consts: dict[int, int]) -> Tuple[int, bool]:
+    regs: List = [None] * num_regs
+    deps = [False] * num_regs
+    regs[ZERO] = 0
+    regs[1:len(inputs) + 1] = inputs
+    for instr in sketch:
+        op, dest, src1, src2 = instr >> 24, (instr >> 16) & 0xff, (instr >> 8) & 0xff, instr & 0xff
+        name = ops[op]
+        left = regs[src1]
+        if left is None:
+            raise Exception("register read before it was written")
+        if op < imm_ops:
+            imm = consts[src2]
+            if (name == 'slli' or name == 'srai') and imm <= 0 or name == 'lui' and not lui_min <= imm <= lui_max:
+                raise InvalidSample()
+            regs[dest] = s64_op(name, left, imm)
+            deps[dest] = True
+            continue
+        right = regs[src2]
+        if right is None:
+            raise Exception("register read before it was written")
+        if not deps[src1] and not deps[src2]:
+            regs[dest] = match_op(name)(left, right)  # raises on division by zero, like run_riscv
+            deps[dest] = False
+            continue
+        if (name == 'div' or name == 'rem') and to_signed64(right) == 0:
+            if not deps[src2]:
+                raise ZeroDivisionError("division by zero")
+            raise InvalidSample()
+        regs[dest] = s64_op(name, left, right)
+        deps[dest] = True
+    return regs[RETURN], deps[RETURN]
+
+
+# the value of a0 as z3 expression, without any side conditions: division by zero and large shifts have the
+# semantics of z3. inputs and consts may be z3 expressions or ints, which are taken as 64 bit values
+def run_packed_smt(sketch: Sequence[int], inputs: Sequence[int | BitVecRef], consts: Sequence[int | BitVecRef] | dict[int, int]) -> BitVecRef:
+    regs: List = [None] * num_regs
+    regs[ZERO] = BitVecVal(0, 64)
+    regs[1:len(inputs) + 1] = [x if isinstance(x, BitVecRef) else BitVecVal(x, 64) for x in inputs]
+    for instr in sketch:
+        op, dest, src1, src2 = instr >> 24, (instr >> 16) & 0xff, (instr >> 8) & 0xff, instr & 0xff
+        left = regs[src1]
+        right = consts[src2] if op < imm_ops else regs[src2]
+        if left is None or right is None:
+            raise Exception("register read before it was written")
+        if not isinstance(right, BitVecRef):
+            right = BitVecVal(right, 64)
+        regs[dest] = match_op(ops[op])(left, right)
+    return regs[RETURN]
+
+
+# if a sketch of the dp generator is in canonical form. the generator only fixes the order in which the temporary
+# registers are introduced, this also rules out
+# - dead code: every value but the last one has to be read before its register is written again. the program
+#   without the instruction (and with its temporaries renamed) is a shorter sketch of the generator. immediates of
+#   instructions (but the last one) that introduce the same number of temporaries share a constant, so it is only
+#   ruled out if the shorter sketch does not need two immediates to be equal that were not before
+# - the order of independent instructions: of two adjacent instructions without immediates that neither read nor
+#   write the register of the other, the one with the smaller encoding comes first. if both introduce a temporary,
+#   the second one is compared as if it introduced the first temporary. swapping the two (and renaming the
+#   temporaries after them) gives another sketch of the generator, so the lexicographically smallest sketch of all
+#   the orders is always kept
+def canonical_sketch(sketch: Sequence[int]) -> bool:
+    decoded = [fields(instr) for instr in sketch]
+    introduced = []  # number of temporaries introduced before each instruction
+    temps = 0
+    for _, dest, _, _ in decoded:
+        introduced.append(temps)
+        temps += dest == 9 + temps
+    for i, (_, dest, _, _) in enumerate(decoded[:-1]):
+        read = False
+        for op_k, dest_k, src1_k, src2_k in decoded[i + 1:]:
+            read = src1_k == dest or (op_k >= imm_ops and src2_k == dest)
+            if read or dest_k == dest:
+                break
+        if read:
+            continue
+        shared = {introduced[k] for k, (op_k, _, _, _) in enumerate(decoded[:-1]) if op_k < imm_ops and k != i}
+        if not (dest == 9 + introduced[i] and introduced[i] in shared and introduced[i] + 1 in shared):
+            return False
+    for i in range(len(decoded) - 2):
+        (op_a, dest_a, src1_a, src2_a), (op_b, dest_b, src1_b, src2_b) = decoded[i], decoded[i + 1]
+        if op_a < imm_ops or op_b < imm_ops:
+            continue
+        if dest_a == dest_b or dest_a in (src1_b, src2_b) or dest_b in (src1_a, src2_a):
+            continue
+        both_new = dest_a == 9 + introduced[i] and dest_b == 9 + introduced[i + 1]
+        if sketch[i] > sketch[i + 1] - (1 << 16 if both_new else 0):
+            return False
+    return True
+
+
+# the values of the only immediate of a sketch for which it returns output on inputs, solved backwards from the
+# output instead of searched for. the operations after the immediate may combine its value with values that do not
+# depend on it by add, sub, xor and mul, so the output is a linear function of it modulo 2^64. inverting these gives
+# the value the immediate instruction has to write modulo 2^bits (a multiplication by 2^k loses k bits), from which
+# the immediates of addi and subi follow directly. for lui, slli and srai the few possible immediates are tried (all
+# shift amounts from 64 on have the same result). returns all the immediates in [c_min, c_max], the smallest first,
+# or None if the sketch has another form and z3 has to decide
+def solve_const(sketch: Sequence[int], inputs: Sequence[int], output: int, c_min: int, c_max: int) -> None | List[int]:
+    imm = [k for k, instr in enumerate(sketch) if instr >> 24 < imm_ops]
+    if len(imm) != 1:
+        return None
+    k = imm[0]
+    regs: List = [None] * num_regs
+    regs[ZERO] = 0
+    regs[1:len(inputs) + 1] = inputs
+    steps: List = [None] * num_regs  # for the registers depending on the immediate: how their value was computed
+    for i, instr in enumerate(sketch):
+        op, dest, src1, src2 = fields(instr)
+        name = ops[op]
+        if i == k:
+            source = regs[src1]
+            steps[dest] = []
+            continue
+        if steps[src1] is None and steps[src2] is None:
+            try:
+                regs[dest] = match_op(name)(regs[src1], regs[src2])
+            except Exception:  # e.g. division by zero, invalid for every value of the immediate like in run_packed
+                return []
+            steps[dest] = None
+        elif src1 == src2 and name == "add":
+            steps[dest] = steps[src1] + [("mul", 2, True)]
+        elif steps[src1] is not None and steps[src2] is not None or name not in ("add", "sub", "xor", "mul"):
+            return None
+        else:
+            dep, other = (src1, src2) if steps[src1] is not None else (src2, src1)
+            steps[dest] = steps[dep] + [(name, regs[other] % (1 << 64), dep == src1)]
+    if steps[RETURN] is None:
+        return None  # the output does not depend on the immediate
+    bits = 64
+    target = output % (1 << 64)
+    for name, value, left in reversed(steps[RETURN]):
+        mask = (1 << bits) - 1
+        match name:
+            case "add":
+                target = (target - value) & mask
+            case "sub":
+                target = (target + value if left else value - target) & mask
+            case "xor":
+                target = (target ^ value) & mask
+            case "mul":
+                zeros = (value & -value).bit_length() - 1 if value != 0 else 64
+                if target & ((1 << min(zeros, bits)) - 1) != 0:
+                    return []
+                if zeros >= bits:
+                    bits, target = 0, 0
+                else:
+                    bits -= zeros
+                    target = ((target >> zeros) * pow(value >> zeros, -1, 1 << bits)) & ((1 << bits) - 1)
+    step = 1 << bits
+    name = ops[sketch[k] >> 24]
+    match name:
+        case "addi" | "subi":
+            first = (target - source if name == "addi" else source - target) % step
+            first = c_min + (first - c_min) % step
+            values = list(range(first, c_max + 1, step))
+        case "lui" | "slli" | "srai":
+            amounts = range(max(lui_min, c_min), min(c_max, lui_max) + 1) if name == "lui" \
+                else range(max(1, c_min), min(c_max, 64) + 1)
+            values = [c for c in amounts if (s64_op(name, source, c) - target) % step == 0]
+        case _:
+            return None
+    return sorted(values, key=lambda c: (abs(c), c))
+
+
+# the same values as solve_const for sketches it can not solve, by running the sketch for every immediate in
+# [c_min, c_max]. still much faster than a z3 query for the range of the dp generator
+def scan_const(sketch: Sequence[int], inputs: Sequence[int], output: int, c_min: int, c_max: int) -> List[int]:
+    slot = const_slots(sketch)[0]
+    values = []
+    for c in sorted(range(c_min, c_max + 1), key=lambda c: (abs(c), c)):
+        try:
+            r, dep = run_packed_concrete(sketch, inputs, {slot: c})
+        except InvalidSample:
+            continue
+        except Exception:  # invalid independently of the immediate
+            return []
+        if not dep and r != output:
+            return []
+        if not dep or r == to_signed64(output):
+            values.append(c)
+    return values
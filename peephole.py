@@ -0,0 +1,200 @@
+# peephole optimization of straight-line code (e.g. the output of Compiler) with rewrite rules learned from
+# synthesis. a rule maps a window of a few instructions to a verified shorter program. windows are stored in a
+# canonical form: the registers read before they are written are renamed a1, a2, ... in order of first use, every
+# other value gets its own temporary register and the value of the last instruction is written to a0. the rules are
+# kept in a sqlite database indexed by a hash of that form, so a program is rewritten with one lookup per window
+import hashlib
+import sqlite3
+import sys
+from typing import Iterable, List, Tuple
+from riscv_dsl import *
+from cegis_verify import Verifier
+from cancellation import CancelToken, PartialResult
+from python_ast_to_dsl import Compiler
+from python_ast_to_func import user_to_func
+from synthesis_cache import SynthesisCache, encode_program, decode_program
+
+__all__ = ["RewriteDB", "canonical_window", "pattern_hash", "mine", "learn_cache", "peephole"]
+
+
+# canonical form of a window, its registers that are read before they are written (in the order of a1, a2, ...)
+# and the destination of its last instruction. None if the window has instructions the synthesis does not support
+def canonical_window(window: List[Instr]) -> None | Tuple[List[Instr], List[Reg], Reg]:
+    if any(instr.op not in Instr.arith_ops for instr in window):
+        return None
+    inputs = []
+    values = {}  # register of the window -> canonical register holding its value
+    temps = iter(Reg.const_regs)
+    canonical = []
+    for k, instr in enumerate(window):
+        dest, srcs = instr.args[0], []
+        for a in instr.args[1:]:
+            if isinstance(a, Reg) and not isinstance(a, Zero) and a not in values:
+                if len(inputs) == len(Regvar.var_regs):
+                    return None
+                inputs.append(a)
+                values[a] = Regvar(len(inputs), "v" + str(len(inputs) - 1))
+            srcs.append(values[a] if isinstance(a, Reg) and not isinstance(a, Zero) else a)
+        if isinstance(dest, Zero):
+            return None
+        values[dest] = ReturnReg() if k == len(window) - 1 else Reg(next(temps))
+        canonical.append(Instr(instr.op, values[dest], *srcs))
+    return canonical, inputs, window[-1].args[0]
+
+
+def pattern_hash(canonical: List[Instr]) -> str:
+    return hashlib.sha1(encode_program(canonical).encode()).hexdigest()
+
+
+# rewrite rules by pattern hash. windows that were synthesized without finding a shorter program are stored
+# without replacement, so they are not synthesized again
+class RewriteDB:
+    path: str
+    db: sqlite3.Connection
+
+    def __init__(self, path: str = "rewrite_rules.db"):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS rules ("
+                        "hash TEXT PRIMARY KEY, pattern TEXT, replacement TEXT, length INTEGER, inputs INTEGER)")
+        self.db.commit()
+
+    def _row(self, canonical: List[Instr]) -> None | Tuple[str, None | str, int]:
+        row = self.db.execute("SELECT pattern, replacement, inputs FROM rules WHERE hash = ?",
+                              (pattern_hash(canonical),)).fetchone()
+        if row is None or row[0] != encode_program(canonical):
+            return None
+        return row
+
+    def known(self, canonical: List[Instr]) -> bool:
+        return self._row(canonical) is not None
+
+    # the replacement of a canonical window, in the same registers
+    def lookup(self, canonical: List[Instr]) -> None | List[Instr]:
+        row = self._row(canonical)
+        if row is None or row[1] is None:
+            return None
+        return decode_program(row[1], ["v" + str(i) for i in range(row[2])])
+
+    def store(self, canonical: List[Instr], replacement: None | List[Instr], inputs: int):
+        self.db.execute("INSERT OR REPLACE INTO rules VALUES (?, ?, ?, ?, ?)",
+                        (pattern_hash(canonical), encode_program(canonical),
+                         None if replacement is None else encode_program(replacement), len(canonical), inputs))
+        self.db.commit()
+
+    # length of the longest pattern with a replacement, 0 if there is none
+    def max_window(self) -> int:
+        return self.db.execute("SELECT MAX(length) FROM rules WHERE replacement IS NOT NULL").fetchone()[0] or 0
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM rules WHERE replacement IS NOT NULL").fetchone()[0]
+
+    def close(self):
+        self.db.close()
+
+
+# synthesizes every window of 2 to max_window instructions of instrs that is not in the database yet, with at most
+# timeout seconds per window, and stores the shorter programs found. returns the number of new rules
+def mine(db: RewriteDB, instrs: List[Instr], max_window: int = 3, timeout: float = 10.0) -> int:
+    found = 0
+    for w in range(2, max_window + 1):
+        for i in range(len(instrs) - w + 1):
+            window = canonical_window(instrs[i:i + w])
+            if window is None or len(window[1]) == 0 or db.known(window[0]):
+                continue
+            prog = Verifier.fromRiscv(window[0]).cegis_2(cancel=CancelToken(timeout), max_len=w - 1)
+            if isinstance(prog, PartialResult):
+                continue  # unknown, tried again next time
+            db.store(window[0], prog, len(window[1]))
+            found += prog is not None
+    return found
+
+
+# turns the programs of a SynthesisCache into rules for the Compiler output of their goal expressions. the rules are
+# verified again before they are stored. returns the number of new rules
+def learn_cache(db: RewriteDB, cache: SynthesisCache) -> int:
+    found = 0
+    for expr, text in cache.programs():
+        try:
+            compiler = Compiler()
+            window = canonical_window(compiler.compile_input(expr))
+            args = user_to_func(expr)[1]
+        except Exception:
+            continue
+        if window is None or db.known(window[0]):
+            continue
+        canonical, inputs, dest = window
+        if any(compiler.used_var.get(a) not in inputs for a in args):
+            continue
+        position = [inputs.index(compiler.used_var[a]) for a in args]
+        regs = {Regvar(i + 1, a): Regvar(p + 1, "v" + str(p)) for i, (a, p) in enumerate(zip(args, position))}
+        prog = [Instr(instr.op, *[regs.get(a, a) if isinstance(a, Reg) else a for a in instr.args])
+                for instr in decode_program(text, args)]
+        if len(prog) < len(canonical) and Verifier.fromRiscv(canonical).verify(prog):
+            db.store(canonical, prog, len(inputs))
+            found += 1
+    return found
+
+
+def _live_before(instr: Instr, live: set[Reg]) -> set[Reg]:
+    if len(instr.args) == 0:
+        return live
+    return (live - {instr.args[0]}) | {a for a in instr.args[1:] if isinstance(a, Reg) and not isinstance(a, Zero)}
+
+
+# the replacement of window with its registers, if there is a rule for it and the values the window leaves in other
+# registers than its destination are not used afterwards (not in live). temporaries of the rule are mapped to
+# registers of Reg.const_regs that are not live
+def _rewrite(window: List[Instr], db: RewriteDB, live: set[Reg]) -> None | List[Instr]:
+    canonical = canonical_window(window)
+    if canonical is None:
+        return None
+    canonical, inputs, dest = canonical
+    if any(instr.args[0] in live and instr.args[0] != dest for instr in window):
+        return None
+    rule = db.lookup(canonical)
+    if rule is None or rule[-1].args[0] != ReturnReg() or any(instr.args[0] == ReturnReg() for instr in rule[:-1]):
+        return None
+    regs = {ReturnReg(): dest} | {Regvar(i + 1, "v" + str(i)): reg for i, reg in enumerate(inputs)}
+    free = [Reg(r) for r in Reg.const_regs if Reg(r) not in live and Reg(r) not in inputs and Reg(r) != dest]
+    for instr in rule:
+        for a in instr.args:
+            if isinstance(a, Reg) and not isinstance(a, Zero) and a not in regs:
+                if len(free) == 0:
+                    return None
+                regs[a] = free.pop(0)
+    if any(regs[instr.args[0]] in live and regs[instr.args[0]] != dest for instr in rule[:-1]):
+        return None  # the rule overwrites an input that is still needed
+    return [Instr(instr.op, *[regs.get(a, a) if isinstance(a, Reg) else a for a in instr.args]) for instr in rule]
+
+
+# rewrites instrs with the rules of db in one pass from the end, trying the longest window first. the instructions of
+# a replacement are tried again as the end of the windows before it, every rewrite makes the program shorter.
+# live_out are the registers whose values are used after the program, by default a0
+def peephole(instrs: List[Instr], db: RewriteDB, live_out: None | Iterable[Reg] = None,
+             max_window: None | int = None) -> List[Instr]:
+    max_window = db.max_window() if max_window is None else max_window
+    live = {ReturnReg()} if live_out is None else set(live_out)
+    pending = list(instrs)
+    done = []
+    while pending:
+        for w in range(min(max_window, len(pending)), 1, -1):
+            new = _rewrite(pending[-w:], db, live)
+            if new is not None:
+                pending[-w:] = new
+                break
+        else:
+            instr = pending.pop()
+            live = _live_before(instr, live)
+            done.append(instr)
+    return done[::-1]
+
+
+# python peephole.py rules.db "(x + 2) * 4" ...: mines the Compiler output of the expressions and prints it rewritten
+if __name__ == "__main__":
+    rules = RewriteDB(sys.argv[1])
+    for expr in sys.argv[2:]:
+        naive = Compiler().compile_input(expr)
+        print(expr, "- new rules:", mine(rules, naive))
+        print(naive, "->", peephole(naive, rules))
+    rules.close()
@@ -0,0 +1,80 @@
+# opt-in instrumentation of the synthesis: a Profile set as Verifier.profiler (which hands it on to its RiscvGen) adds
+# to the totals of sketches, z3 checks and cegis iterations in Verifier.stats their counts by program length, pruned
+# sketches (pruned_canonical, pruned_batch, pruned_prefilter), invalid ones, sketches whose constants were computed
+# concretely (solved_concrete) and z3 checks by outcome, and times the phases of the search, in total and by program
+# length. without a profile, the hooks are a check for None.
+# phases: generate (the calls of the generator, including the phases below), batch (numpy pass of batch_filtered),
+# prefilter (concrete_check), encode (building the z3 constraints of a sketch), z3 (checks of the generators),
+# replace_consts (reading the constants from the model) and verify (the search for a counterexample). the time of
+# generate that is in none of its phases is exported as enumerate. the workers of dp_gen_parallel are not profiled
+import time
+from typing import Any, Callable
+
+__all__ = ["Profile"]
+
+
+class Profile:
+    counters: dict[str, int]
+    timers: dict[str, float]  # seconds by phase
+    by_length: dict[int, dict[str, int | float]]  # counters and timers by length of the programs searched
+    length: int  # length of the last sketch, counts without a length of their own go there
+    on_event: None | Callable[[str, dict[str, Any]], None]  # called with the kind of event and its data
+    progress_interval: float = 1.0  # seconds between progress events during the search of a length
+    start: float
+    last_progress: float
+
+    generate_phases = ["batch", "prefilter", "encode", "z3", "replace_consts"]
+
+    def __init__(self, on_event: None | Callable[[str, dict[str, Any]], None] = None):
+        self.counters = {}
+        self.timers = {}
+        self.by_length = {}
+        self.length = 0
+        self.on_event = on_event
+        self.start = time.perf_counter()
+        self.last_progress = self.start
+
+    def count(self, name: str, n: int = 1, length: None | int = None):
+        self.counters[name] = self.counters.get(name, 0) + n
+        self.per_length(name, self.length if length is None else length, n)
+
+    # counts only by length, for what stats has the total of
+    def per_length(self, name: str, length: int, n: int = 1):
+        entry = self.by_length.setdefault(length, {})
+        entry[name] = entry.get(name, 0) + n
+
+    def add_time(self, phase: str, seconds: float, length: None | int = None):
+        self.timers[phase] = self.timers.get(phase, 0.0) + seconds
+        entry = self.by_length.setdefault(self.length if length is None else length, {})
+        entry[phase + "_time"] = entry.get(phase + "_time", 0.0) + seconds
+
+    # a sketch of the given length is tried, total is the number of sketches in the stats of the generator. fires a
+    # length event when the search moves on to another length, and a progress event every progress_interval seconds
+    def sketch(self, length: int, total: int):
+        if length != self.length:
+            self.length = length
+            self.event("length", length=length)
+        self.per_length("sketches", length)
+        if self.on_event is not None and total % 1024 == 0:
+            now = time.perf_counter()
+            if now - self.last_progress >= self.progress_interval:
+                self.last_progress = now
+                self.event("progress", length=length, sketches=total)
+
+    # a z3 check of the phase (z3 or verify) with its result, counted as <phase>_sat, <phase>_unsat or <phase>_unknown
+    def check(self, phase: str, result, seconds: float):
+        self.count(phase + "_" + str(result))
+        self.add_time(phase, seconds)
+
+    def event(self, kind: str, **data):
+        if self.on_event is not None:
+            self.on_event(kind, {"elapsed": time.perf_counter() - self.start, **data})
+
+    # the counters, with the totals of stats (of the Verifier after the synthesis), and timers as a dict that can be
+    # written as JSON, e.g. into the records of benchmark_runner
+    def export(self, stats: dict[str, int]) -> dict[str, Any]:
+        timers = dict(self.timers)
+        if "generate" in timers:
+            timers["enumerate"] = max(0.0, timers["generate"] - sum(timers.get(p, 0.0) for p in self.generate_phases))
+        return {"elapsed": time.perf_counter() - self.start, "counters": {**stats, **self.counters}, "timers": timers,
+                "by_length": {str(length): dict(entry) for length, entry in sorted(self.by_length.items())}}
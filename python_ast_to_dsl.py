@@ -1,103 +1,136 @@
 from ast import *
 from riscv_dsl import *
 from typing import List
+from magic_division import load_const
 
 
+# naive compilation of an expression, without search. the operands are evaluated in Sethi-Ullman order (the operand
+# that needs more registers first), so an expression of n operations needs at most log2(n) + 1 temporary registers.
+# the variables stay in a1, a2, ... (in sorted order, like the arguments of user_to_func) and are never overwritten.
+# temporaries are taken from avail_const, then from the argument registers without variable, and are reused as soon
+# as their value was read for the last time. the result is written to a0
 class Compiler:
-    temp_res: Reg = TempRes()
     avail_const: List[Reg] = [Reg(x) for x in [5, 6, 7, 28, 29, 30, 31]]
-    avail_var: List[int] = list(range(7, 1, -1))
-    used_var: dict[str, Reg] = {}
+    used_var: dict[str, Reg]  # register of every variable
+    free: List[Reg]  # temporary registers that are not in use, the last one is taken first
     result: List[Instr]
 
+    binary_ops: dict[type, str] = {Add: "add", Sub: "sub", Mult: "mul", Div: "div", FloorDiv: "div", Mod: "rem",
+                                   LShift: "sll", RShift: "sra", BitAnd: "and", BitOr: "or", BitXor: "xor"}
+    shift_imm_ops: dict[type, str] = {LShift: "slli", RShift: "srai"}
+    call_ops: dict[str, str] = {"pydiv": "div", "pymod": "rem"}
+
     def __init__(self):
         self.result = []
+        self.used_var = {}
+        self.free = []
         return
 
     def compile(self, e: AST):
+        self.result = []
+        names = sorted({node.id for node in walk(e) if type(node) is Name and node.id not in self.call_ops})
+        if len(names) > len(Regvar.var_regs):
+            raise Exception("ran out of argument registers!")
+        self.used_var = {name: Regvar(num, name) for num, name in zip(Regvar.var_regs, names)}
+        # argument registers without variable are spilled to last. their names are not identifiers, so they can not
+        # be mistaken for a variable
+        self.free = [Regvar(num, "temp a" + str(num)) for num in reversed(Regvar.var_regs[len(names):])] \
+            + list(self.avail_const)
         last = self._transform_expr(e)  # final result, equals exit code of program
-        self.result += [Instr("addi", ReturnReg(), last, 0)]
+        if last != ReturnReg():
+            self.result += [Instr("addi", ReturnReg(), last, 0)]
         return self.result
 
     def compile_input(self, input: str):
         in_ast = parse(input, mode='eval')
         return self.compile(in_ast.body)
 
-    def _transform_const(self, val: int) -> Reg:
-        if len(self.avail_const) > 1:
-            reg = self.avail_const.pop()
-            self.result.append(Regassign(reg, val))
-            return reg
-        else:
-            raise Exception("ran out of temporary registers!")  # TODO: free up operations in this case?
+    def _alloc(self) -> Reg:
+        if len(self.free) == 0:
+            raise Exception("ran out of temporary registers!")
+        return self.free.pop()
 
-    def _transform_var(self, val: str) -> Reg:
-        if val in self.used_var.keys():
-            return self.used_var[val]
-        if len(self.avail_var) > 1:
-            free_num = self.avail_var.pop()
-            self.used_var[val] = Regvar(free_num, val)
-            return self.used_var[val]
-        else:
-            raise Exception("ran out of argument registers!")
+    def _check_free(self, reg: Reg):  # frees reg for reuse if it was a temporary
+        if reg not in self.used_var.values():
+            self.free.append(reg)
 
-    def _check_free(self, reg: Reg):  # frees reg for reuse if it was a constant
-        if type(reg) == Regvar:
-            return
-        self.avail_const.append(reg)
+    # the value of a constant leaf, None for other nodes
+    def _constant(self, e: AST) -> None | int:
+        match e:
+            case Constant(value=int(val)):
+                return val
+            case UnaryOp(USub(), Constant(value=int(val))):
+                return -val
+        return None
 
-    def _transform_expr(self, e: AST) -> Reg:
+    # operands of e that are computed into registers, in the order of the expression
+    def _operands(self, e: AST) -> List[AST]:
         match e:
-            case BinOp(left, Add(), right):
-                reg1 = self._transform_expr(left)  # problem: expr of type (1 + (2 + (3 + (4 + ...))))
-                reg2 = self._transform_expr(right)
-                self.result.append((Instr("add", self.temp_res, reg1, reg2)))
-                self._check_free(reg2)
-                return self.temp_res
-            case BinOp(left, Sub(), right):
-                reg1 = self._transform_expr(left)
-                reg2 = self._transform_expr(right)
-                self.result.append((Instr("sub", self.temp_res, reg1, reg2)))
-                self._check_free(reg2)
-                return self.temp_res
-            case BinOp(left, Mult(), right):
-                reg1 = self._transform_expr(left)
-                reg2 = self._transform_expr(right)
-                self.result.append((Instr("mul", self.temp_res, reg1, reg2)))
-                self._check_free(reg2)
-                return self.temp_res
-            case BinOp(left, Div(), right) | BinOp(left, FloorDiv(), right):
-                reg1 = self._transform_expr(left)
-                reg2 = self._transform_expr(right)
-                self.result.append((Instr("div", self.temp_res, reg1, reg2)))
-                self._check_free(reg2)
-                return self.temp_res
-            case BinOp(left, Mod(), right):
-                reg1 = self._transform_expr(left)
-                reg2 = self._transform_expr(right)
-                self.result.append((Instr("rem", self.temp_res, reg1, reg2)))
-                self._check_free(reg2)
-                return self.temp_res
-            case BinOp(left, LShift(), right):
-                reg1 = self._transform_expr(left)
-                reg2 = self._transform_expr(right)
-                self.result.append((Instr("sll", self.temp_res, reg1, reg2)))
-                self._check_free(reg2)
-                return self.temp_res
-            case BinOp(left, RShift(), right):
-                reg1 = self._transform_expr(left)
-                reg2 = self._transform_expr(right)
-                self.result.append((Instr("sra", self.temp_res, reg1, reg2)))
-                self._check_free(reg2)
-                return self.temp_res
-            case UnaryOp(USub(), rest):
-                reg = self._transform_expr(rest)
-                self.result.append((Instr("Sub", reg, Zero(), reg)))
-                return reg
-            case Name(id=val):
-                return self._transform_var(val)
-            case Constant(val):
-                return self._transform_const(val)
+            case BinOp(left, LShift() | RShift(), right) if 0 < (self._constant(right) or 0) < 64:
+                return [left]  # shift by an immediate
+            case BinOp(left, op, right) if type(op) in self.binary_ops:
+                return [left, right]
+            case Call(func=Name(id=f), args=[left, right]) if f in self.call_ops:
+                return [left, right]
+            case UnaryOp(USub(), rest) if self._constant(e) is None:
+                return [rest]
+            case Name():
+                return []
+            case _ if self._constant(e) is not None:
+                return []
             case _:
                 raise Exception("could not parse " + dump(e))
 
+    # Sethi-Ullman numbers: how many temporary registers computing each node needs
+    def _labels(self, root: AST) -> dict[int, int]:
+        labels = {}
+        stack = [(root, False)]
+        while stack:
+            e, expanded = stack.pop()
+            operands = self._operands(e)
+            if not expanded and operands:
+                stack += [(e, True)] + [(o, False) for o in operands]
+                continue
+            if type(e) is Name:
+                labels[id(e)] = 0  # already in its register
+            elif len(operands) == 2 and labels[id(operands[0])] == labels[id(operands[1])]:
+                labels[id(e)] = labels[id(operands[0])] + 1
+            else:
+                labels[id(e)] = max([1] + [labels[id(o)] for o in operands])
+        return labels
+
+    # emits the code of e and returns the register of its value. iterative, so long chains of operations do not
+    # exceed the recursion limit
+    def _transform_expr(self, root: AST) -> Reg:
+        labels = self._labels(root)
+        regs = {}
+        stack = [(root, False)]
+        while stack:
+            e, expanded = stack.pop()
+            operands = self._operands(e)
+            if not expanded and operands:
+                order = sorted(operands, key=lambda o: -labels[id(o)])  # stable, left first on ties
+                stack += [(e, True)] + [(o, False) for o in reversed(order)]
+                continue
+            regs[id(e)] = self._emit(e, [regs[id(o)] for o in operands], e is root)
+        return regs[id(root)]
+
+    # code of e with its operands in the given registers, which are freed. the value of the root is written to a0
+    def _emit(self, e: AST, operands: List[Reg], is_root: bool) -> Reg:
+        if type(e) is Name:
+            return self.used_var[e.id]
+        for reg in operands:
+            self._check_free(reg)
+        dest = ReturnReg() if is_root else self._alloc()
+        match e:
+            case BinOp(_, op, right) if len(operands) == 1:
+                self.result.append(Instr(self.shift_imm_ops[type(op)], dest, operands[0], self._constant(right)))
+            case BinOp(_, op, _):
+                self.result.append(Instr(self.binary_ops[type(op)], dest, *operands))
+            case Call(func=Name(id=f)):
+                self.result.append(Instr(self.call_ops[f], dest, *operands))
+            case UnaryOp(USub(), _) if len(operands) == 1:
+                self.result.append(Instr("sub", dest, Zero(), operands[0]))
+            case _:
+                self.result += load_const(dest, self._constant(e))
+        return dest
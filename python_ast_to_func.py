@@ -51,8 +51,28 @@ def expr_to_func(ast_in: Expression) -> Tuple[Callable[[List[int]], int], list[s
     return eval(unparse(func)), expr_vars
 
 
+class RenameVars(NodeTransformer):
+    def __init__(self, names: dict[str, str]):
+        self.names = names
+
+    def visit_Name(self, node):
+        if node.id in self.names:
+            return Name(id=self.names[node.id], ctx=node.ctx)
+        return node
+
+
+# normalized form of an expression, used as key for stored synthesis results. division and modulo are replaced like
+# in expr_to_func, and the variables are renamed to v0, v1, ... in their sorted order (the order of the function arguments)
+def canonical_expr(ast_in: Expression) -> str:
+    with_fixed_div_mod = fix_missing_locations(TransformDiv().visit(ast_in))
+    expr_vars = sorted({node.id for node in walk(with_fixed_div_mod) if type(node) is Name and node.id not in ['pymod', 'pydiv']})
+    renamed = RenameVars({name: "v" + str(i) for i, name in enumerate(expr_vars)}).visit(with_fixed_div_mod)
+    return unparse(renamed)
+
+
 if __name__ == "__main__":
     ast_in = parse("x / 2 + 1", mode='eval')
     print(dump(fix_missing_locations(TransformDiv().visit(ast_in))))
     f, vars = user_to_func('x % 3')
     print(f(2))
+    print(canonical_expr(parse("y * 4 + x % 3", mode='eval')))
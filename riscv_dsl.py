@@ -1,10 +1,36 @@
 # base class for arithmetic RISC V assembly instructions
-from typing import List, Callable, Any
-from z3 import BitVecRef, BV2Int, SRem
+from typing import List, Callable, Any, Tuple
+from z3 import BitVecRef, BitVecVal, BV2Int, SRem, ULT, If, Extract, SignExt
 
 
 pydiv =  lambda x, y: int(x / y) if type(x) is int and type(y) is int else x / y
 pymod = lambda x, y: (x - (y * int(x / y))) if type(x) is int and type(y) is int else SRem(x, y)
+_mask64 = (1 << 64) - 1
+
+# the immediate of lui is a signed 20 bit value (its result is sign extended from 32 bits). the assembler only takes
+# its 20 bits, 0..1048575, so it is written that way and read back with lui_signed
+lui_min, lui_max = -(1 << 19), (1 << 19) - 1
+
+
+def lui_signed(imm: int) -> int:
+    return ((imm & 0xfffff) ^ 0x80000) - 0x80000
+
+
+# set if less than, unsigned: compares the 64 bit representations
+def pysltu(x, y):
+    if type(x) is int and type(y) is int:
+        return int(x & _mask64 < y & _mask64)
+    return If(ULT(x, y), BitVecVal(1, 64), BitVecVal(0, 64))
+
+
+# upper 64 bits of the signed 128 bit product
+def pymulh(x, y):
+    if type(x) is int and type(y) is int:
+        signed = lambda v: ((v + (1 << 63)) & _mask64) - (1 << 63)
+        return (signed(x) * signed(y)) >> 64
+    x = x if isinstance(x, BitVecRef) else BitVecVal(x, 64)
+    y = y if isinstance(y, BitVecRef) else BitVecVal(y, 64)
+    return Extract(127, 64, SignExt(64, x) * SignExt(64, y))
 
 def match_op(op: str) -> Callable[[Any, Any], Any]:
     match op:
@@ -12,66 +38,117 @@ def match_op(op: str) -> Callable[[Any, Any], Any]:
             return lambda x, y: x + y
         case "sub" | "subi":
             return lambda x, y: x - y
-        case "slli":  # left shift (logical = arithmetic)
+        case "slli" | "sll":  # left shift (logical = arithmetic)
             return lambda x, y: x << y
-        case "srai":  # right shift (arithmetic)
+        case "srai" | "sra":  # right shift (arithmetic)
             return lambda x, y: x >> y
-        case "mul":  # for this case and following, immediate values are not supported
+        case "mul":  # for mul, div and rem, immediate values are not supported
             return lambda x, y: x * y
         case "div":
             return lambda x, y: pydiv(x, y)
         case "rem":  # remainder, signed
             return lambda x, y: pymod(x, y)
+        case "and" | "andi":
+            return lambda x, y: x & y
+        case "or":
+            return lambda x, y: x | y
+        case "xor":
+            return lambda x, y: x ^ y
+        case "sltu":
+            return lambda x, y: pysltu(x, y)
+        case "mulh":
+            return lambda x, y: pymulh(x, y)
+        case "lui":  # the source register is always x0 and ignored
+            return lambda x, y: y << 12
         case _:
             raise Exception("Could not match Instruction Operator")
 
 
-# Representation for Registers in RISC V. Does not consider floating point registers because we never use those
+# Representation for Registers in RISC V. Does not consider floating point registers because we never use those.
+# registers are interned: constructing the same register twice returns the same object
 class Reg:
+    __slots__ = ("num", "key")
     num: int
+    key: Tuple[str, int]  # what the register is compared and hashed by, like its representation in assembly
     const_regs: List[int] = [5, 6, 7, 28, 29, 30, 31]
+    interned: dict[tuple, "Reg"] = {}
+
+    def __new__(cls, *args):
+        reg = Reg.interned.get((cls,) + args)
+        if reg is None:
+            reg = super().__new__(cls)
+            Reg.interned[(cls,) + args] = reg
+        return reg
 
     def __init__(self, num: int):
         self.num = num
+        self.key = ("x", num)
         assert num in self.const_regs
 
+    # needed to intern unpickled registers as well
+    def __getnewargs__(self):
+        return (self.num,)
+
     # the same as corresponding representation in actual risc-v assembly
     def __repr__(self):
-        return "x" + str(self.num)
+        return self.key[0] + str(self.num)
 
-    # define equality on repr
+    # define equality on the assembly name
     def __eq__(self, other):
-        return repr(self) == repr(other)
+        return isinstance(other, Reg) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
 
 
 class Regvar(Reg):
+    __slots__ = ("name",)
     var_regs: List[int] = list(range(1, 8))
     name: str
 
     def __init__(self, num: int, name: str):
         self.num = num
+        self.key = ("a", num)
         self.name = name
         assert num in self.var_regs
 
+    def __getnewargs__(self):
+        return (self.num, self.name)
+
     def py_name(self) -> str:
         return self.name
 
-    def __repr__(self):
-        return "a" + str(self.num)
-
 
 class Zero(Reg):
+    __slots__ = ()
+
     def __init__(self):
         self.num = 0
+        self.key = ("x", 0)
+
+    def __getnewargs__(self):
+        return ()
 
 
 class ReturnReg(Regvar):
+    __slots__ = ()
+
     def __init__(self):
         self.num = 0
+        self.key = ("a", 0)
+
+    def __getnewargs__(self):
+        return ()
 
 class TempRes(Regvar):
+    __slots__ = ()
+
     def __init__(self):
         self.num = 1
+        self.key = ("a", 1)
+
+    def __getnewargs__(self):
+        return ()
 
 def py_name(r: Reg) -> str:
     return r.py_name() if type(r) == Regvar else repr(r)
@@ -79,9 +156,11 @@ def py_name(r: Reg) -> str:
 
 # Representation of instructions with a variable number of arguments. Only represents instructions with a destination
 class Instr:
+    __slots__ = ("op", "args")
     __match_args__ = ("op", "args")
     
-    arith_ops = ['addi', 'subi', 'slli', 'srai', 'add', 'sub', 'mul', 'div', 'rem']
+    arith_ops = ['addi', 'subi', 'slli', 'srai', 'andi', 'lui', 'add', 'sub', 'mul', 'div', 'rem', 'and', 'or', 'xor',
+                 'sltu', 'mulh']
     op: str
     # args: Tuple[Reg | int]  # register or immediate
 
@@ -90,6 +169,9 @@ class Instr:
         self.args = args
 
     def __repr__(self):
+        if self.op == "lui":  # lui dest, x0, imm is written as lui dest, imm, with the 20 bits of imm
+            imm = self.args[2] & 0xfffff if type(self.args[2]) is int else self.args[2]
+            return self.op + " " + repr(self.args[0]) + ", " + repr(imm)
         return self.op + " " + ", ".join(repr(a) for a in self.args)
 
     # define equality on components instead of object identity
@@ -102,11 +184,19 @@ class Instr:
 
 
 class Regassign(Instr):
+    __slots__ = ()
+
     def __init__(self, reg: Reg, num: int):
         self.op = "addi"
         self.args = (reg, Zero(), num)
 
 
+# the sketch generators only produce one order of the operands of commutative ops, and no instructions with the same
+# register as both operands for ops in same_operand_ops, whose result is then trivial
+commutative_ops: List[str] = ['add', 'mul', 'and', 'or', 'xor', 'mulh']
+same_operand_ops: List[str] = ['sub', 'div', 'rem', 'and', 'or', 'xor', 'sltu']
+
+
 def only_arith_instrs(instrs: List[Instr]) -> List[Instr]:
     r = []
     for instr in instrs:
@@ -1,5 +1,5 @@
 from riscv_dsl import *
-from typing import List
+from typing import List, Tuple
 from z3 import *
 
 # optional argument for z3 solver, because rule to avoid division/modulo by zero might need to be added
@@ -19,8 +19,74 @@ def run_riscv(riscv: List[Instr], args: dict[str, int | BitVecRef], s = Solver()
                 left = regs[py_name(arg)]
                 if op == 'slli' or op == 'srai':
                     s.add(imm > 0)
+                if op == 'lui':
+                    s.add(imm >= lui_min, imm <= lui_max)
                 regs[py_name(dest)] = match_op(op)(left, imm)
             case _:  # ignore invalid code
                 continue
         # lookup args if necessary (now add associated var name to Regvar in ast)
-    return regs[py_name(ReturnReg())]
\ No newline at end of file
+    return regs[py_name(ReturnReg())]
+
+# raised by run_riscv_concrete if the chosen constants violate a side condition (like division by zero)
+class InvalidSample(Exception):
+    pass
+
+to_signed64 = lambda x: ((x + (1 << 63)) & ((1 << 64) - 1)) - (1 << 63)
+
+def _s64_div(x: int, y: int) -> int:
+    q = abs(x) // abs(y)
+    return to_signed64(q if (x < 0) == (y < 0) else -q)
+
+def s64_op(op: str, x: int, y: int) -> int:
+    x, y = to_signed64(x), to_signed64(y)
+    match op:
+        case "div":
+            return _s64_div(x, y)
+        case "rem":
+            return to_signed64(x - y * _s64_div(x, y))
+        case "slli":
+            return to_signed64(x << y) if y < 64 else 0
+        case "srai":
+            return x >> min(y, 63)
+        case _:
+            return to_signed64(match_op(op)(x, y))
+
+
+# concrete counterpart of run_riscv for sketches. consts maps the ids of the z3 constants used as immediates to integers.
+# values depending on a constant are computed on 64 bit like z3 would, everything else with python ints.
+# returns the result and if it depends on a constant
+def run_riscv_concrete(riscv: List[Instr], args: dict[str, int], consts: dict[str, int] = {}) -> Tuple[int, bool]:
+    regs = {name: (val, False) for name, val in args.items()}
+    regs[py_name(Zero())] = (0, False)
+    for i in riscv:
+        match i:
+            case Instr(op, (Reg() as dest, Reg() as arg1, Reg() as arg2)):
+                left, dep1 = regs[py_name(arg1)]
+                right, dep2 = regs[py_name(arg2)]
+                if not dep1 and not dep2:
+                    regs[py_name(dest)] = (match_op(op)(left, right), False)  # raises on division by zero, like run_riscv
+                    continue
+                if (op == 'div' or op == 'rem') and to_signed64(right) == 0:
+                    if not dep2:
+                        raise ZeroDivisionError("division by zero")
+                    raise InvalidSample()
+                regs[py_name(dest)] = (s64_op(op, left, right), True)
+            case Instr(op, (Reg() as dest, Reg() as arg, imm)):
+                left, dep = regs[py_name(arg)]
+                if isinstance(imm, BitVecRef):
+                    imm = consts[imm.get_id()]
+                    if (op == 'slli' or op == 'srai') and imm <= 0 or op == 'lui' and not lui_min <= imm <= lui_max:
+                        raise InvalidSample()
+                    regs[py_name(dest)] = (s64_op(op, left, imm), True)
+                    continue
+                if (op == 'slli' or op == 'srai') and imm <= 0:
+                    raise ValueError("shift amount has to be positive")
+                if op == 'lui' and not lui_min <= imm <= lui_max:
+                    raise ValueError("immediate of lui out of range")
+                if dep:
+                    regs[py_name(dest)] = (s64_op(op, left, imm), True)
+                else:
+                    regs[py_name(dest)] = (match_op(op)(left, imm), False)
+            case _:
+                continue
+    return regs[py_name(ReturnReg())]
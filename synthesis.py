@@ -1,8 +1,42 @@
 from z3 import *
 from riscv_dsl import *
 from run_riscv import *
-from typing import Tuple
+from typing import Tuple, Sequence
 import itertools
+import concurrent.futures
+import multiprocessing
+import json
+import os
+import time
+from array import array
+from packed_dsl import encode, decode_sketch, const_slots, run_packed, run_packed_concrete, imm_ops, canonical_sketch, \
+    solve_const, scan_const
+from batch_eval import run_batch
+from cancellation import CancelToken, SynthesisCancelled
+from table_store import table_path, save_tables, load_tables
+from cost_model import CostModel, cost_models
+from profiling import Profile
+import numpy as np
+
+_shared_tables: dict[Tuple[int, Tuple[str, ...], Tuple[str, ...]], Tuple[dict, dict, dict, dict]] = {}
+
+
+# lui always reads x0, and andi of x0 is 0
+def _redundant_imm(op: str, arg) -> bool:
+    return (op == "lui") != isinstance(arg, Zero) if op in ("lui", "andi") else False
+
+
+# operand pairs for the last instruction of a sketch. both orders of add and mul are kept there, as they always were,
+# so that the order of the sketches of dp_gen (and with it checkpoints and stored tables) stays the same
+def _last_operands(op: str, regs: List[Reg]) -> List[Tuple[Reg, Reg]]:
+    return [(arg1, arg2) for arg1, arg2 in itertools.product(regs, regs)
+            if not (op in same_operand_ops and repr(arg1) == repr(arg2))
+            and not (op in commutative_ops and op not in ("add", "mul") and repr(arg1) > repr(arg2))]
+
+
+# raised by generators that have proposed every candidate they have
+class SearchExhausted(Exception):
+    pass
 
 
 class RiscvGen():
@@ -13,26 +47,105 @@ class RiscvGen():
     all_regs: List[Reg]
     arith_ops_imm: List[str] = ["addi", "subi", "slli", "srai"]
     arith_ops: List[str] = ["add", "sub", "mul", "div", "rem"]  # prefer easier operations, first
+    # larger vocabulary with the logical, compare and mulh ops, used instead of the two lists above with main.py --extended
+    extended_ops_imm: List[str] = ["addi", "subi", "slli", "srai", "andi", "lui"]
+    extended_ops: List[str] = ["add", "sub", "and", "or", "xor", "sltu", "mul", "mulh", "div", "rem"]
     arg_regs: List[Reg]
     cache: dict[Tuple[int, int], List[List[Instr]]]
-    cache_p: dict[int, List[Tuple[Instr, bool]]]
-    sketch_gen: None | Iterable  # for higher depths, we don't want to restart the sketch generator and instead save it between cegis turns
+    cache_p: dict[int, Tuple[array | memoryview, array | memoryview]]  # packed instructions and if they introduce a new temporary register
+    end_p: dict[int, array | memoryview]  # packed last instructions, by number of temporary registers introduced before
+    dp_ones: dict[int, array | memoryview]  # number of instructions of cache_p introducing a register, before each index
+    dp_counts: dict[Tuple[int, int], int]  # memo of dp_count
+    sketch_gen: None | Iterable[Tuple[int, Tuple[int, ...]]]  # for higher depths, we don't want to restart the sketch generator and instead save it between cegis turns
     last_min: int
     s: Solver
+    prefilter: bool = True  # run candidates concretely before handing them to z3
+    const_samples: List[int] = [1, 2, -1, 3, 4, 8]  # constants tried for immediates before asking z3
+    max_samples: int = 16
+    solve_consts: bool = True  # compute single immediates concretely instead of asking z3, see concrete_check
+    batch_size: int = 4096  # sketches run at once with numpy before the checks of dp_gen, 0 to disable
+    canonical: bool = True  # skip the sketches of dp_gen and cost_gen that are not in the form of canonical_sketch
+    batch_examples: List[Tuple[List[int], int]]
+    retry_sketch: None | Tuple[int, Tuple[int, ...]]  # sketch with immediates that is proposed again, with its rank
+    retry_prog: None | List[Instr]  # the program last proposed for retry_sketch
+    next_rank: int  # rank of the next sketch dp_gen checks
+    checkpoint: None | str = None  # file the position of dp_gen is written to, for resume_checkpoint
+    checkpoint_interval: float = 60.0  # seconds between checkpoints written during a search
+    checkpoint_time: float
+    resume_pos: None | Tuple[int, int]  # length and rank dp_gen continues at, read from a checkpoint
+    smart_state: None | Tuple[int, Iterable, List[Instr], int]  # length, sketch generator, last candidate and number of its examples
+    sym_state: None | Tuple[int, Solver, List[Tuple[ArithRef, ArithRef, ArithRef, BitVecRef]], int]  # length, query, selectors and number of its examples
+    workers: int  # number of processes used by dp_gen
+    pool: None | concurrent.futures.ProcessPoolExecutor
+    par_pos: Tuple[int, int, int, bool]  # length, shard, offset and retry flag of the next sketch in dp_gen_parallel
+    stats: dict[str, int]  # sketches (or terms of oe_gen) tried and z3 checks, for benchmarking
+    cancel: None | CancelToken  # deadline and cancellation of the current synthesis
+    share_tables: bool = False  # use the dp tables of other generators, see table_dicts
+    table_dir: None | str = None  # directory of the table_store files for the dp tables
+    poll_interval: float = 0.1  # seconds between checks of the token while waiting for the workers of dp_gen_parallel
+    # attributes the workers of dp_gen_parallel take over, so that they check the same sketches in the same way
+    worker_attrs: List[str] = ["c_min", "c_max", "arith_ops_imm", "arith_ops", "prefilter", "const_samples",
+                               "max_samples", "solve_consts", "canonical"]
+    oe_consts: List[int] = list(range(-8, 17))  # immediates tried by oe_gen below the last instruction
+    oe_classes: dict[Tuple[int, ...], List[Tuple[int, Any]]]  # outputs on the examples -> (cost, term), cheapest first
+    oe_inputs: List[List[int]]
+    oe_built: int  # programs up to this length are contained in oe_classes
+    oe_fresh: set[int]  # ids of representatives that were not yet combined with the others
+    max_len: None | int = None  # dp_gen raises SearchExhausted instead of proposing longer programs
+    cost_model: CostModel = cost_models["in_order"]  # what cost_gen minimizes
+    cost_extra_len: int = 1  # cost_gen searches up to this many instructions more than the first program found has
+    cost_bound: float  # cost_gen only proposes programs cheaper than this, see cost_found
+    cost_max_len: None | int  # longest programs cost_gen proposes, set by cost_found
+    cost_runs: dict[Tuple[str, int], List[Tuple[int, int, int]]]  # memo of _op_runs
+    profiler: None | Profile = None  # counters and timers of the search, see profiling
 
-    def __init__(self, args: List[str]):
+    def __init__(self, args: List[str], workers: int = 1):
         self.args = args
+        self.workers = workers
+        self.pool = None
+        self.par_pos = (-1, 0, 0, False)
         self.arg_regs = [Regvar(i, x) for i, x in zip(ReturnReg().var_regs, args)]
         self.s = Solver()
         self.all_regs = [Reg(x) for x in Reg.const_regs] + [Zero(), ReturnReg()]
         self.consts = []
         self.cache = {}
-        self.cache_p = {}
+        self.cache_p, self.end_p, self.dp_ones, self.dp_counts = self.table_dicts()
         self.sketch_gen = None
         self.last_min = -1
+        self.retry_sketch = None
+        self.retry_prog = None
+        self.next_rank = 0
+        self.checkpoint_time = 0.0
+        self.resume_pos = None
+        self.smart_state = None
+        self.sym_state = None
+        self.stats = {"sketches": 0, "z3_checks": 0}
+        self.cancel = None
+        self.oe_classes = {}
+        self.oe_inputs = []
+        self.oe_built = -1
+        self.oe_fresh = set()
+        self.cost_bound = float("inf")
+        self.cost_max_len = None
+        self.cost_runs = {}
+
+    # the dicts holding the dp tables. the packed tables only depend on the number of arguments and the op lists, so
+    # with share_tables or a table_dir all generators with the same ones use the same dicts, and extend them together
+    def table_dicts(self) -> Tuple[dict, dict, dict, dict]:
+        if not self.share_tables and self.table_dir is None:
+            return {}, {}, {}, {}
+        key = (len(self.args), tuple(self.arith_ops_imm), tuple(self.arith_ops))
+        if key not in _shared_tables:
+            _shared_tables[key] = ({}, {}, {}, {})
+        return _shared_tables[key]
 
+    # parameters that influence which programs are found, used to invalidate stored results
+    def params(self) -> str:
+        return json.dumps({"c_min": self.c_min, "c_max": self.c_max, "arith_ops_imm": self.arith_ops_imm,
+                           "arith_ops": self.arith_ops, "oe_consts": self.oe_consts})
 
     def replace_consts(self, instrs: List[Instr]):
+        start = time.perf_counter() if self.profiler is not None else 0.0
         result = []
         for instr in instrs:
             match instr:
@@ -41,6 +154,8 @@ class RiscvGen():
                     result += [Instr(op, dest, arg1, int(c_eval.as_signed_long()))]
                 case i:
                     result += [i]
+        if self.profiler is not None:
+            self.profiler.add_time("replace_consts", time.perf_counter() - start)
         return result
 
 
@@ -49,6 +164,7 @@ class RiscvGen():
         count = 0
         possibilities = self.code_sketches()
         for p in possibilities:
+            self.tried(p)
             self.s.push()
             for (inputs, output) in examples:  # note that there needs to always be at least one example
                 success = True
@@ -62,15 +178,16 @@ class RiscvGen():
                 self.s.pop()
                 continue
             count += 1
-            if self.s.check() == sat:
+            if self.check(self.s) == sat:
                 return self.replace_consts(p)
             self.s.pop()
 
         raise Exception("No posssible program was found!")
 
-    def code_sketches(self) -> List[List[Instr]]:
+    # streams the sketches of naive_gen: all programs of one instruction, then every instruction followed by each of
+    # the shorter programs, without keeping the sketches in memory
+    def code_sketches(self) -> Iterable[List[Instr]]:
         max_len = 2
-        possibilities = []
         self.s = Solver()
         for i in range(max_len):
             c = BitVec('c' + str(i), 64)
@@ -78,57 +195,78 @@ class RiscvGen():
             self.s.add(c <= self.c_max)
             self.consts += [c]
 
-        # Important: start list with simple solutions and get more complex later on
-        # all one-liner possibilties:
-        for op in self.arith_ops_imm:
-            for arg in self.all_regs + self.arg_regs:
-                possibilities.append([Instr(op, ReturnReg(), arg, self.consts[0])])
-        for op in self.arith_ops:
-            for arg1 in self.all_regs + self.arg_regs:
-                for arg2 in self.all_regs + self.arg_regs:
-                    possibilities.append([Instr(op, ReturnReg(), arg1, arg2)])
-
-        # combine with each previous possibilty
-        for i in range(1, max_len) :
-            copy = possibilities.copy()
+        def firsts(i: int) -> Iterable[Instr]:
             for op in self.arith_ops_imm:
                 for dest in self.all_regs:
                     for arg in self.all_regs + self.arg_regs:
-                        possibilities += [[Instr(op, dest, arg, self.consts[i])] + x for x in copy]
+                        yield Instr(op, dest, arg, self.consts[i])
             for op in self.arith_ops:
                 for dest in self.all_regs:
                     for arg1 in self.all_regs + self.arg_regs:
                         for arg2 in self.all_regs + self.arg_regs:
-                            possibilities += [[Instr(op, dest, arg1, arg2)] + x for x in copy]
-        return possibilities
-    
+                            yield Instr(op, dest, arg1, arg2)
 
+        def sketches(i: int) -> Iterable[List[Instr]]:
+            if i == 0:
+                # Important: start list with simple solutions and get more complex later on
+                # all one-liner possibilties:
+                for op in self.arith_ops_imm:
+                    for arg in self.all_regs + self.arg_regs:
+                        yield [Instr(op, ReturnReg(), arg, self.consts[0])]
+                for op in self.arith_ops:
+                    for arg1 in self.all_regs + self.arg_regs:
+                        for arg2 in self.all_regs + self.arg_regs:
+                            yield [Instr(op, ReturnReg(), arg1, arg2)]
+                return
+            # combine with each previous possibilty
+            yield from sketches(i - 1)
+            for instr in firsts(i):
+                for x in sketches(i - 1):
+                    yield [instr] + x
+
+        return sketches(max_len - 1)
+
+    # the search is resumed between cegis turns: sketches refuted by earlier examples stay refuted, and the last
+    # candidate keeps its solver frame, so that only the new examples have to be asserted for it
     def smart_gen(self, examples: List[Tuple[List[int], int]], min_prog_length: int) -> Tuple[List[Instr], int]:
-        count = 0
-        possibilities = self.smart_sketches(min_prog_length)
+        if self.smart_state is not None and self.smart_state[0] == min_prog_length:
+            _, possibilities, p, asserted = self.smart_state
+            if self.assert_examples(p, examples[asserted:]) and self.check(self.s) == sat:
+                self.smart_state = (min_prog_length, possibilities, p, len(examples))
+                return self.replace_consts(p), min_prog_length
+            self.s.pop()
+        else:
+            possibilities = self.smart_sketches(min_prog_length)
+        self.smart_state = None
+
         for p in possibilities:
+            self.tried(p)
             self.s.push()
-            for (inputs, output) in examples:  # note that there needs to always be at least one example
-                success = True
-                try:
-                    r = run_riscv(p, {self.args[i]: inputs[i] for i in range(len(self.args))}, self.s)
-                    self.s.add(r == output)
-                except Exception as ex:  # this means the code was invalid. skip to the next one
-                    success = False
-                    break
-            if not success:
-                self.s.pop()
-                continue
-            if self.s.check() == sat:
-                # print("Number of invalid programs checked:", count)
+            if self.assert_examples(p, examples) and self.check(self.s) == sat:
+                self.smart_state = (min_prog_length, possibilities, p, len(examples))
                 return self.replace_consts(p), min_prog_length
-            count += 1
             self.s.pop()
 
         if min_prog_length < 10:
             return self.smart_gen(examples, min_prog_length + 1)
         raise Exception("No posssible program was found!")
 
+    # adds the constraints of the examples for sketch p to the solver. returns False if the code was invalid
+    def assert_examples(self, p: List[Instr], examples: List[Tuple[List[int], int]]) -> bool:
+        start = time.perf_counter() if self.profiler is not None else 0.0
+        valid = True
+        for (inputs, output) in examples:
+            try:
+                r = run_riscv(p, {self.args[i]: inputs[i] for i in range(len(self.args))}, self.s)
+                self.s.add(r == output)
+            except Exception as ex:
+                valid = False
+                break
+        if self.profiler is not None:
+            self.profiler.add_time("encode", time.perf_counter() - start)
+            if not valid:
+                self.profiler.count("invalid")
+        return valid
 
     # smart meaning: only try valid code. also don't generate duplicates
     def smart_sketches(self, depth: int) -> Iterable:
@@ -137,12 +275,9 @@ class RiscvGen():
             if iter == 0:
                 possibilities = []
                 for op in self.arith_ops_imm:
-                    possibilities += [temp_r + [Instr(op, ReturnReg(), arg, self.consts[iter])] for arg in avail_regs]
+                    possibilities += [temp_r + [Instr(op, ReturnReg(), arg, self.consts[iter])] for arg in avail_regs if not _redundant_imm(op, arg)]
                 for op in self.arith_ops:
-                    if op in ['div', 'sub', 'rem']:
-                        possibilities += [temp_r + [Instr(op, ReturnReg(), arg1, arg2)] for arg1, arg2 in list(itertools.product(avail_regs, avail_regs)) if repr(arg1) != repr(arg2)]
-                    else:
-                        possibilities += [temp_r + [Instr(op, ReturnReg(), arg1, arg2)] for arg1, arg2 in list(itertools.product(avail_regs, avail_regs))]
+                    possibilities += [temp_r + [Instr(op, ReturnReg(), arg1, arg2)] for arg1, arg2 in _last_operands(op, avail_regs)]
                 for p in possibilities:
                     yield p
                 return
@@ -156,6 +291,8 @@ class RiscvGen():
             for op in self.arith_ops_imm:
                 for dest in new_regs:
                     for arg in avail_regs + [Zero()]:
+                        if _redundant_imm(op, arg):
+                            continue
                         new_r += [Instr(op, dest, arg, self.consts[iter])]
                         if dest in diff:
                             yield from helper(iter - 1, reg_iter + 1, new_r, new_regs)
@@ -168,9 +305,9 @@ class RiscvGen():
                     for arg1 in avail_regs + [Zero()]:
                         for arg2 in avail_regs + [Zero()]:
                             # eliminate redundant programs here
-                            if (op == "mul" or op == "add") and repr(arg1) > repr(arg2):
+                            if op in commutative_ops and repr(arg1) > repr(arg2):
                                 continue
-                            if (op in ['div', 'rem', 'sub']) and repr(arg1) == repr(arg2):
+                            if op in same_operand_ops and repr(arg1) == repr(arg2):
                                 continue
 
                             new_r += [Instr(op, dest, arg1, arg2)]
@@ -194,115 +331,331 @@ class RiscvGen():
         return possibilities
 
     def dp_gen(self, examples: List[Tuple[List[int], int]], min_prog_length: int) -> Tuple[List[Instr], int]:
-        count = 0
+        if self.workers > 1 and min_prog_length > 0:
+            return self.dp_gen_parallel(examples, min_prog_length)
         if self.sketch_gen is None or self.last_min != min_prog_length:
-            self.sketch_gen = self.dp_sketches_yield(min_prog_length)
+            self.next_rank = self._resume_rank(min_prog_length)
+            self.sketch_gen = enumerate(self.dp_sketches_packed(min_prog_length, start=self.next_rank), self.next_rank)
+            if self.canonical:
+                self.sketch_gen = self.canonical_filtered(self.sketch_gen)
+            if self.batch_size > 0:
+                self.sketch_gen = self.batch_filtered(self.sketch_gen)
+            self.retry_sketch = None
+        self.batch_examples = examples
         possibilities = self.sketch_gen
         self.last_min = min_prog_length
+        self.write_checkpoint()
 
-        for p in possibilities:
-            self.s.push()
-            for (inputs, output) in examples:  # note that there needs to always be at least one example
-                success = True
-                try:
-                    match p:
-                        case [_, Instr("rem", _)]:
-                            pass
-                    r = run_riscv(p, {self.args[i]: inputs[i] for i in range(len(self.args))}, self.s)
-                    self.s.add(r == output)
-                except Exception as ex:  # this means the code was invalid. skip to the next one
-                    success = False
-                    count += 1
-                    break
-            if not success:
-                self.s.pop()
-                continue
-            if self.s.check() == sat:
-                # print("Number of invalid programs checked:", count)  # for debugging
-                correct_p = self.replace_consts(p)
+        # a sketch with immediates is proposed again, with constants chosen by z3 for the new examples, until they rule
+        # it out: the constants that were proposed need not be the only ones matching the examples
+        if self.retry_sketch is not None:
+            retried, self.retry_sketch = self.retry_sketch, None
+            possibilities = itertools.chain([retried], possibilities)
+        else:
+            retried = None
+
+        for rank, p in possibilities:
+            self.tried(p)
+            self.next_rank = rank
+            if self.checkpoint is not None and time.monotonic() - self.checkpoint_time > self.checkpoint_interval:
+                self.write_checkpoint()
+            prog, sampled = self.check_sketch(p, examples, retried is None or rank != retried[0])
+            if prog is not None and not self._same_retry(rank, prog, retried):
+                if self._has_imm(prog):
+                    self.retry_sketch = (rank, p)
+                    self.retry_prog = prog
+                else:
+                    self.next_rank = rank + 1
+                return prog, min_prog_length
+
+        if self.max_len is not None and min_prog_length + 1 >= self.max_len:
+            raise SearchExhausted()
+        if min_prog_length < 10:
+            return self.dp_gen(examples, min_prog_length + 1)
+        raise Exception("No posssible program was found!")
+
+    def _has_imm(self, prog: List[Instr]) -> bool:
+        return any(instr.op in self.arith_ops_imm for instr in prog)
+
+    # if the retried sketch got the program again that already failed. the examples can then not tell its constants
+    # apart from the right ones (e.g. after an overflow), and the sketch is given up
+    def _same_retry(self, rank: int, prog: List[Instr], retried: None | Tuple[int, Tuple[int, ...]]) -> bool:
+        return retried is not None and rank == retried[0] and prog == self.retry_prog
+
+    # the sketches in canonical form, with the ranks they have among all sketches. the ranks of checkpoints and of the
+    # shards of dp_gen_parallel stay the same with and without the filter
+    def canonical_filtered(self, sketches: Iterable[Tuple[int, Tuple[int, ...]]]) -> Iterable[Tuple[int, Tuple[int, ...]]]:
+        for rank, p in sketches:
+            if canonical_sketch(p):
+                yield rank, p
+            elif self.profiler is not None:
+                self.profiler.count("pruned_canonical", 1, len(p))
+
+    # first pass for dp_gen: sketches without immediates are run in batches with numpy on the examples, and the ones
+    # that can not match are dropped before they reach check_sketch. the examples are read whenever a batch is run,
+    # sketches dropped for earlier examples stay refuted. sketches whose values might overflow are always kept,
+    # because check_sketch computes them without the 64 bit wrap-around
+    def batch_filtered(self, sketches: Iterable[Tuple[int, Tuple[int, ...]]]) -> Iterable[Tuple[int, Tuple[int, ...]]]:
+        while True:
+            batch = list(itertools.islice(sketches, self.batch_size))
+            if len(batch) == 0:
+                return
+            start = time.perf_counter() if self.profiler is not None else 0.0
+            by_length = {}  # the sketches of cost_gen differ in length
+            for i, (_, p) in enumerate(batch):
+                if all(instr >> 24 >= imm_ops for instr in p):
+                    by_length.setdefault(len(p), []).append(i)
+            dropped = set()
+            for free in by_length.values():
+                examples = self.batch_examples
+                inputs = np.array([inputs for inputs, _ in examples], dtype=np.int64).reshape(len(examples), len(self.args))
+                targets = np.array([to_signed64(output) for _, output in examples], dtype=np.int64)
+                outputs, overflowed = run_batch(np.array([batch[i][1] for i in free], dtype=np.uint32), inputs, overflow=True)
+                keep = (outputs == targets).all(axis=1) | overflowed
+                dropped.update(free[i] for i in np.flatnonzero(~keep))
+                if self.profiler is not None:
+                    self.profiler.count("pruned_batch", int((~keep).sum()), len(batch[free[0]][1]))
+            self.stats["sketches"] += len(dropped)
+            if self.profiler is not None:
+                self.profiler.add_time("batch", time.perf_counter() - start, len(batch[0][1]))
+            yield from (item for i, item in enumerate(batch) if i not in dropped)
+
+    # checks one packed sketch against the examples. returns the program with its constants (or None if there is
+    # none) and if the constants were only sampled by the concrete pre-filter. without prefilter (for a retried
+    # sketch), constants are only taken from the pre-filter if it computed them instead of sampling
+    def check_sketch(self, p: Tuple[int, ...], examples: List[Tuple[List[int], int]], prefilter: bool = True) -> Tuple[None | List[Instr], bool]:
+        profiler = self.profiler
+        if self.prefilter:
+            start = time.perf_counter() if profiler is not None else 0.0
+            consts = self.concrete_check(p, examples, prefilter)
+            if profiler is not None:
+                profiler.add_time("prefilter", time.perf_counter() - start)
+                if consts is not None:
+                    profiler.count("pruned_prefilter" if consts is False else "solved_concrete")
+            if consts is False:
+                return None, False
+            if consts is not None:
+                return decode_sketch(p, self.args, consts), len(consts) > 0
+        start = time.perf_counter() if profiler is not None else 0.0
+        self.s.push()
+        for (inputs, output) in examples:  # note that there needs to always be at least one example
+            try:
+                r = run_packed(p, inputs, self.consts, self.s)
+                self.s.add(r == output)
+            except Exception as ex:  # this means the code was invalid. skip to the next one
                 self.s.pop()
-                return correct_p, min_prog_length
+                if profiler is not None:
+                    profiler.count("invalid")
+                return None, False
+        if profiler is not None:
+            profiler.add_time("encode", time.perf_counter() - start)
+        if self.check(self.s) == sat:
+            start = time.perf_counter() if profiler is not None else 0.0
+            model = self.s.model()
+            correct_p = decode_sketch(p, self.args, {i: model.eval(self.consts[i], model_completion=True).as_signed_long() for i in const_slots(p)})
             self.s.pop()
+            if profiler is not None:
+                profiler.add_time("replace_consts", time.perf_counter() - start)
+            return correct_p, False
+        self.s.pop()
+        return None, False
 
+    # same search as dp_gen, but the sketches are split into shards by their first instruction (cache_p[0]) and
+    # checked by a pool of worker processes. the result is the first matching sketch in the order of dp_gen
+    def dp_gen_parallel(self, examples: List[Tuple[List[int], int]], min_prog_length: int) -> Tuple[List[Instr], int]:
+        self.dp_sketches_packed(min_prog_length)  # fills cache_p
+        if self.par_pos[0] != min_prog_length:
+            rank = self._resume_rank(min_prog_length)
+            if rank < self.dp_count(min_prog_length, 0):
+                shard = self.dp_path(min_prog_length, rank)[0]
+                self.par_pos = (min_prog_length, shard, rank - self._dp_offset(min_prog_length, 0, shard), False)
+            else:
+                self.par_pos = (min_prog_length, len(self.cache_p[0][0]), 0, False)
+        _, first_shard, first_offset, retry = self.par_pos
+        shards = len(self.cache_p[0][0])
+        # everything before the first unfinished shard is refuted, so the position is a rank of the serial order
+        self.batch_examples = examples
+        self.last_min = min_prog_length
+        self.next_rank = self._dp_offset(min_prog_length, 0, first_shard) + first_offset
+        self.write_checkpoint()
+
+        pool = self._get_pool()
+        with self.par_round.get_lock():
+            self.par_round.value += 1
+        self.par_best.value = shards
+        futures = {}
+        limits = None if self.cancel is None else (self.cancel.remaining(), self.cancel.check_timeout, self.cancel.rlimit)
+        for shard in range(first_shard, shards):
+            start = first_offset if shard == first_shard else 0
+            f = pool.submit(_check_shard, self.args, self.worker_settings(), examples, min_prog_length, shard,
+                            start, retry and shard == first_shard, self.par_round.value, limits)
+            futures[f] = shard
+
+        found = {}
+        pending = set(futures)
+        while pending:
+            done, pending = concurrent.futures.wait(pending, timeout=self.poll_interval,
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            if self.cancel is not None and self.cancel.cancelled():
+                self.par_round.value += 1  # stops running workers
+                for f in pending:
+                    f.cancel()
+                raise SynthesisCancelled()
+            for f in done:
+                shard, offset, prog, sampled = f.result()
+                if prog is not None:
+                    found[shard] = (offset, prog, sampled)
+            if found and all(futures[f] > min(found) for f in pending):  # everything before the best shard is done
+                for f in pending:
+                    f.cancel()
+                break
+
+        if found:
+            shard = min(found)
+            offset, prog, sampled = found[shard]
+            if retry and (shard, offset) == (first_shard, first_offset) and prog == self.retry_prog:
+                self.par_pos = (min_prog_length, shard, offset + 1, False)
+                return self.dp_gen_parallel(examples, min_prog_length)
+            keep = self._has_imm(prog)
+            self.par_pos = (min_prog_length, shard, offset if keep else offset + 1, keep)
+            self.retry_prog = prog
+            return prog, min_prog_length
+        if self.max_len is not None and min_prog_length + 1 >= self.max_len:
+            raise SearchExhausted()
         if min_prog_length < 10:
             return self.dp_gen(examples, min_prog_length + 1)
         raise Exception("No posssible program was found!")
 
-    
-    # iterative memoization itself was not an improvement to the recursive dp version. However, this version was adapted to use utilize
-    # multithreading as well as yield
-    def dp_sketches_yield(self, depth: int):
+    def worker_settings(self) -> dict[str, Any]:
+        return {attr: getattr(self, attr) for attr in self.worker_attrs}
 
-        def helper(iter: int, avail_regs: List[Reg]):
+    def _get_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self.pool is None:
+            ctx = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() \
+                else multiprocessing.get_context()
+            self.par_round = ctx.Value('i', 0)
+            self.par_best = ctx.Value('i', 0)
+            self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=ctx, initializer=_init_worker,
+                                                               initargs=(self.par_round, self.par_best))
+        return self.pool
 
-            def compute_iteration(reg_iter: int):
-                if (reg_iter) in self.cache_p.keys():  # might occur if cache was already filled by a previous function call for sketch generation
-                    return
-                new_regs = avail_regs.copy()
-                for i in range(min(reg_iter + 1, len(Reg.const_regs))):
-                    new_regs.append(Reg(Reg.const_regs[i]))
-                for op in self.arith_ops_imm:
-                    for dest in new_regs:
-                        for arg in new_regs[:-1] + [Zero()]:
-                            instr = Instr(op, dest, arg, self.consts[reg_iter + 1])
-                            if dest == new_regs[-1]:
-                                res = [(instr, True)]
-                            else:
-                                res = [(instr, False)]
+    # every z3 check of the generators goes through here, so that the limits of a CancelToken apply to it
+    def check(self, s: Solver) -> CheckSatResult:
+        self.stats["z3_checks"] += 1
+        if self.profiler is not None:
+            start = time.perf_counter()
+            try:
+                r = s.check() if self.cancel is None else self.cancel.check(s)
+            except SynthesisCancelled:
+                self.profiler.check("z3", "cancelled", time.perf_counter() - start)
+                raise
+            self.profiler.check("z3", r, time.perf_counter() - start)
+            return r
+        if self.cancel is None:
+            return s.check()
+        return self.cancel.check(s)
 
-                            self.cache_p[reg_iter] = self.cache_p.get((reg_iter), []) + res
+    # called in the loops of the generators, raises SynthesisCancelled once the token is cancelled or expired
+    def poll(self):
+        if self.cancel is not None and self.cancel.cancelled():
+            raise SynthesisCancelled()
 
-                for op in self.arith_ops:
-                    for dest in new_regs:
-                        for arg1 in new_regs[:-1] + [Zero()]:
-                            for arg2 in new_regs[:-1] + [Zero()]:
-                                # eliminate redundant programs here
-                                if (op == "mul" or op == "add") and repr(arg1) > repr(arg2):
-                                    continue
-                                if (op in ['div', 'rem', 'sub']) and repr(arg1) == repr(arg2):
-                                    continue
-                                instr = Instr(op, dest, arg1, arg2)
-                                if dest == new_regs[-1]:
-                                    res = [(instr, True)]
-                                else:
-                                    res = [(instr, False)]
-                                self.cache_p[reg_iter] += res
-
-            for i in range(iter):
-                compute_iteration(i)
-
-            # inital setup: add all possibilities for instrs of length 1 because they don't follow the same pattern
-            end_list = {}
-            for reg_iter in range(0, iter + 1):
-                new_regs = avail_regs.copy()
-                new_regs.append(Zero())
-                for i in range(min(reg_iter, len(Reg.const_regs))):
-                    new_regs.append(Reg(Reg.const_regs[i]))
-
-                end_list[reg_iter] = []
-                for op in self.arith_ops_imm:
-                    end_list[reg_iter] += [Instr(op, ReturnReg(), arg, self.consts[0]) for arg in new_regs]
-                for op in self.arith_ops:
-                    if op in ['div', 'sub', 'rem']:
-                        end_list[reg_iter] += [Instr(op, ReturnReg(), arg1, arg2) for arg1, arg2 in list(itertools.product(new_regs, new_regs)) if repr(arg1) != repr(arg2)]
-                    else:
-                        end_list[reg_iter] += [Instr(op, ReturnReg(), arg1, arg2) for arg1, arg2 in list(itertools.product(new_regs, new_regs))]
-
-            def build_res(iter: int, reg_iter: int, maxi: int, rest):
-                if iter == maxi:
-                    for instr in end_list[reg_iter]:
-                        yield rest + [instr]
-                    return
-                for instr, b in self.cache_p[reg_iter]:
-                    if b:
-                        yield from build_res(iter + 1, reg_iter + 1, maxi, rest + [instr])
-                    else:   
-                        yield from build_res(iter + 1, reg_iter, maxi, rest + [instr])
+    # counts a sketch that reaches the checks in stats, and by its length in the profiler, and polls the token
+    def tried(self, p: Sequence):
+        self.stats["sketches"] += 1
+        self.poll()
+        if self.profiler is not None:
+            self.profiler.sketch(len(p), self.stats["sketches"])
 
-            result = build_res(0, 0, iter, [])
-            return result
+    # shuts down the worker processes of dp_gen_parallel, if there are any. workers that are still checking a sketch
+    # (e.g. after a cancel) are terminated instead of waited for
+    def close(self):
+        if self.pool is not None:
+            self.par_round.value += 1  # stops running workers
+            processes = list((self.pool._processes or {}).values())  # no public way to terminate them before 3.14
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            for process in processes:
+                process.join()
+            self.pool = None
 
-        possibilities = []
+    # writes the examples and the position of dp_gen to the checkpoint file, if there is one. sketches before the
+    # position are refuted by the examples. the file is replaced at once, so a crash leaves the previous checkpoint
+    def write_checkpoint(self):
+        if self.checkpoint is None or self.last_min < 0:
+            return
+        data = {"args": self.args, "params": self.params(), "length": self.last_min, "rank": self.next_rank,
+                "examples": self.batch_examples}
+        with open(self.checkpoint + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(self.checkpoint + ".tmp", self.checkpoint)
+        self.checkpoint_time = time.monotonic()
+
+    # continues the search of dp_gen from a checkpoint written by write_checkpoint; later checkpoints go to the same
+    # file. returns the examples and the length to pass to dp_gen
+    def resume_checkpoint(self, path: str) -> Tuple[List[Tuple[List[int], int]], int]:
+        with open(path) as f:
+            data = json.load(f)
+        if data["args"] != self.args or data["params"] != self.params():
+            raise Exception("The checkpoint was written for other arguments or parameters!")
+        self.checkpoint = path
+        self.resume_pos = (data["length"], data["rank"])
+        return [(inputs, output) for inputs, output in data["examples"]], data["length"]
+
+    # rank dp_gen starts at for sketches of the given length
+    def _resume_rank(self, length: int) -> int:
+        if self.resume_pos is None or self.resume_pos[0] != length:
+            return 0
+        rank, self.resume_pos = self.resume_pos[1], None
+        return rank
+
+    # fast rejection in front of the solver: packed candidates are run on plain integers for all examples.
+    # returns False if the candidate can not match the examples, the constants (by index) if it matches for one of the
+    # sampled constants or has none, and None if z3 has to decide. for a single immediate, all its values that match the
+    # first example are computed (solve_const, or scan_const where that does not work) and tried instead of the
+    # samples, so z3 is only needed for sketches with more immediates
+    def concrete_check(self, p: Tuple[int, ...], examples: List[Tuple[List[int], int]],
+                       sample: bool = True) -> bool | None | dict[int, int]:
+        slots = const_slots(p)
+        solved = None
+        if self.solve_consts and len(slots) == 1:
+            solved = solve_const(p, examples[0][0], examples[0][1], self.c_min, self.c_max)
+            if solved is None:
+                solved = scan_const(p, examples[0][0], examples[0][1], self.c_min, self.c_max)
+        if solved is not None:
+            candidates = [(c,) for c in solved]
+        elif not sample:
+            return None
+        else:
+            samples = [x for x in self.const_samples if self.c_min <= x <= self.c_max]
+            candidates = itertools.islice(itertools.product(samples, repeat=len(slots)), self.max_samples)
+        for values in candidates:
+            consts = dict(zip(slots, values))
+            matched = True
+            for (inputs, output) in examples:
+                try:
+                    r, dep = run_packed_concrete(p, inputs, consts)
+                except InvalidSample:
+                    matched = False
+                    break
+                except Exception:  # invalid independently of the constants
+                    return False
+                if not dep and r != output:
+                    return False
+                if dep and r != to_signed64(output):
+                    matched = False
+                    break
+            if matched:
+                return consts
+        return False if solved is not None else None
+
+    # iterative memoization itself was not an improvement to the recursive dp version. However, this version was adapted to use utilize
+    # multithreading as well as yield
+    # sketches are generated in the packed encoding of packed_dsl, the tables in cache_p and end_list are arrays of
+    # packed instructions. with first, only the sketches starting with the instruction cache_p[0][first] are generated
+    def dp_sketches_packed(self, depth: int, first: None | int = None, start: int = 0) -> Iterable[Tuple[int, ...]]:
         self.s = Solver()
         self.consts = []
         for i in range(depth + 1):
@@ -310,10 +663,589 @@ class RiscvGen():
             self.s.add(c >= self.c_min)
             self.s.add(c <= self.c_max)
             self.consts += [c]
+        self.dp_tables(depth)
+        if start >= self.dp_count(depth, 0):
+            return iter(())
+        path = self.dp_path(depth, start) if start > 0 else None
+
+        # only the current prefix is kept. path holds the indices of the first sketch to produce, the levels after a
+        # deviation from it start at 0 again
+        def build_res(iter: int, reg_iter: int, maxi: int, rest: Tuple[int, ...], path: None | List[int]):
+            lo = path[iter] if path is not None else 0
+            if iter == maxi:
+                for instr in self.end_p[reg_iter][lo:]:
+                    yield rest + (instr,)
+                return
+            instrs, new_reg = self.cache_p[reg_iter]
+            indices = range(first, first + 1) if iter == 0 and first is not None else range(lo, len(instrs))
+            for i in indices:
+                yield from build_res(iter + 1, reg_iter + new_reg[i], maxi, rest + (instrs[i],),
+                                     path if path is not None and i == lo else None)
+
+        return build_res(0, 0, depth, (), path)
+
+    # fills cache_p and end_p with the instructions needed for sketches of the given depth. with a table_dir, the
+    # tables are read from there if they were stored for this depth already, and stored after they were built
+    def dp_tables(self, depth: int):
         avail_regs = self.arg_regs
-        possibilities = helper(depth, avail_regs)
-        
-        return possibilities
+        missing = any(r not in self.cache_p for r in range(depth)) or any(r not in self.end_p for r in range(depth + 1))
+        if not missing:
+            return
+        path = None
+        if self.table_dir is not None:
+            path = table_path(self.table_dir, len(self.args), self.arith_ops_imm, self.arith_ops)
+            if os.path.exists(path):
+                stored_depth, cache_p, end_p, dp_ones = load_tables(path)
+                for tables, loaded in ((self.cache_p, cache_p), (self.end_p, end_p), (self.dp_ones, dp_ones)):
+                    for r, value in loaded.items():
+                        tables.setdefault(r, value)
+                if stored_depth >= depth:
+                    return
+
+        def compute_iteration(reg_iter: int):
+            if (reg_iter) in self.cache_p.keys():  # might occur if cache was already filled by a previous function call for sketch generation
+                return
+            new_regs = avail_regs.copy()
+            for i in range(min(reg_iter + 1, len(Reg.const_regs))):
+                new_regs.append(Reg(Reg.const_regs[i]))
+            instrs = array('I')
+            new_reg = array('B')  # if the instruction introduces the next temporary register
+            for op in self.arith_ops_imm:
+                for dest in new_regs:
+                    for arg in new_regs[:-1] + [Zero()]:
+                        if _redundant_imm(op, arg):
+                            continue
+                        instrs.append(encode(op, dest, arg, reg_iter + 1))
+                        new_reg.append(dest == new_regs[-1])
+
+            for op in self.arith_ops:
+                for dest in new_regs:
+                    for arg1 in new_regs[:-1] + [Zero()]:
+                        for arg2 in new_regs[:-1] + [Zero()]:
+                            # eliminate redundant programs here
+                            if op in commutative_ops and repr(arg1) > repr(arg2):
+                                continue
+                            if op in same_operand_ops and repr(arg1) == repr(arg2):
+                                continue
+                            instrs.append(encode(op, dest, arg1, arg2))
+                            new_reg.append(dest == new_regs[-1])
+            self.cache_p[reg_iter] = (instrs, new_reg)
+            self.dp_ones[reg_iter] = array('I', itertools.accumulate(new_reg, initial=0))
+
+        for i in range(depth):
+            compute_iteration(i)
+
+        # inital setup: add all possibilities for instrs of length 1 because they don't follow the same pattern
+        for reg_iter in range(0, depth + 1):
+            if reg_iter in self.end_p:
+                continue
+            new_regs = avail_regs.copy()
+            new_regs.append(Zero())
+            for i in range(min(reg_iter, len(Reg.const_regs))):
+                new_regs.append(Reg(Reg.const_regs[i]))
+
+            end = array('I')
+            for op in self.arith_ops_imm:
+                end.extend(encode(op, ReturnReg(), arg, 0) for arg in new_regs if not _redundant_imm(op, arg))
+            for op in self.arith_ops:
+                end.extend(encode(op, ReturnReg(), arg1, arg2) for arg1, arg2 in _last_operands(op, new_regs))
+            self.end_p[reg_iter] = end
+        if path is not None:
+            save_tables(path, self.cache_p, self.end_p, self.dp_ones)
+
+    # number of sketches with `remaining` more instructions before the last one, after reg_iter temporary registers
+    # were introduced. only depends on the number of instructions of cache_p that introduce a register, and the ones
+    # that don't
+    def dp_count(self, remaining: int, reg_iter: int) -> int:
+        if remaining == 0:
+            return len(self.end_p[reg_iter])
+        if (remaining, reg_iter) not in self.dp_counts:
+            ones = self.dp_ones[reg_iter][-1]
+            zeros = len(self.cache_p[reg_iter][0]) - ones
+            self.dp_counts[(remaining, reg_iter)] = (zeros * self.dp_count(remaining - 1, reg_iter) +
+                                                     ones * self.dp_count(remaining - 1, reg_iter + 1))
+        return self.dp_counts[(remaining, reg_iter)]
+
+    # number of sketches of dp_sketches_packed(depth)
+    def dp_sketch_count(self, depth: int) -> int:
+        self.dp_tables(depth)
+        return self.dp_count(depth, 0)
+
+    # rank of the first sketch that starts with the instruction at index i of cache_p[reg_iter], among the sketches
+    # with the same prefix
+    def _dp_offset(self, remaining: int, reg_iter: int, i: int) -> int:
+        ones = self.dp_ones[reg_iter][i]
+        return (i - ones) * self.dp_count(remaining - 1, reg_iter) + ones * self.dp_count(remaining - 1, reg_iter + 1)
+
+    # indices into cache_p (and end_p for the last instruction) of the sketch with the given rank in
+    # dp_sketches_packed(depth)
+    def dp_path(self, depth: int, rank: int) -> List[int]:
+        self.dp_tables(depth)
+        if not 0 <= rank < self.dp_count(depth, 0):
+            raise IndexError("sketch rank out of range")
+        path = []
+        reg_iter = 0
+        for iter in range(depth):
+            remaining = depth - iter
+            lo, hi = 0, len(self.cache_p[reg_iter][0]) - 1
+            while lo < hi:  # last instruction whose first sketch is not after rank
+                mid = (lo + hi + 1) // 2
+                if self._dp_offset(remaining, reg_iter, mid) <= rank:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            rank -= self._dp_offset(remaining, reg_iter, lo)
+            path.append(lo)
+            reg_iter += self.cache_p[reg_iter][1][lo]
+        path.append(rank)
+        return path
+
+    # the sketch with the given rank in dp_sketches_packed(depth), without generating the ones before it
+    def dp_sketch_at(self, depth: int, rank: int) -> Tuple[int, ...]:
+        path = self.dp_path(depth, rank)
+        sketch = []
+        reg_iter = 0
+        for i in path[:-1]:
+            instrs, new_reg = self.cache_p[reg_iter]
+            sketch.append(instrs[i])
+            reg_iter += new_reg[i]
+        sketch.append(self.end_p[reg_iter][path[-1]])
+        return tuple(sketch)
+
+    # inverse of dp_sketch_at
+    def dp_rank(self, sketch: Sequence[int]) -> int:
+        depth = len(sketch) - 1
+        self.dp_tables(depth)
+        rank = 0
+        reg_iter = 0
+        for iter, instr in enumerate(sketch[:-1]):
+            instrs, new_reg = self.cache_p[reg_iter]
+            i = instrs.tolist().index(instr)
+            rank += self._dp_offset(depth - iter, reg_iter, i)
+            reg_iter += new_reg[i]
+        return rank + self.end_p[reg_iter].tolist().index(sketch[-1])
+
+    # the sketches of dp_sketches_packed as lists of instructions, with z3 constants as immediates. only the canonical
+    # ones if canonical is set
+    def dp_sketches_yield(self, depth: int, first: None | int = None) -> Iterable[List[Instr]]:
+        sketches = self.dp_sketches_packed(depth, first)
+        return (decode_sketch(p, self.args, self.consts) for p in sketches if not self.canonical or canonical_sketch(p))
+
+    # branch and bound over the cost of cost_model: the sketches of dp_gen are proposed in the same order, but only
+    # those cheaper than cost_bound. the verified programs are passed to cost_found, which lowers the bound, so the
+    # last program verified is the cheapest one of at most cost_max_len instructions. raises SearchExhausted once
+    # no cheaper sketch is left
+    def cost_gen(self, examples: List[Tuple[List[int], int]], min_prog_length: int) -> Tuple[List[Instr], int]:
+        if self.sketch_gen is None:
+            self.sketch_gen = enumerate(self.cost_sketches())
+            if self.canonical:
+                self.sketch_gen = self.canonical_filtered(self.sketch_gen)
+            if self.batch_size > 0:
+                self.sketch_gen = self.batch_filtered(self.sketch_gen)
+            self.retry_sketch = None
+        self.batch_examples = examples
+        possibilities = self.sketch_gen
+
+        if self.retry_sketch is not None:
+            retried, self.retry_sketch = self.retry_sketch, None
+            possibilities = itertools.chain([retried], possibilities)
+        else:
+            retried = None
+
+        for rank, p in possibilities:
+            self.tried(p)
+            if self.cost_model.packed_cost(p) >= self.cost_bound:  # the bound was lowered after p was batched
+                continue
+            prog, sampled = self.check_sketch(p, examples, retried is None or rank != retried[0])
+            if prog is not None and not self._same_retry(rank, prog, retried):
+                if self._has_imm(prog):
+                    self.retry_sketch = (rank, p)
+                    self.retry_prog = prog
+                self.last_min = len(p) - 1
+                return prog, len(p) - 1
+        raise SearchExhausted()
+
+    # a program proposed by cost_gen was verified, only cheaper ones are searched for from now on
+    def cost_found(self, prog: List[Instr]):
+        self.cost_bound = self.cost_model.cost(prog)
+        if self.cost_max_len is None:
+            self.cost_max_len = len(prog) + self.cost_extra_len
+
+    # the sketches of cost_gen, by length. a prefix is cut off as soon as it can not be completed below the bound
+    def cost_sketches(self) -> Iterable[Tuple[int, ...]]:
+        cheapest = self.cost_model.cheapest()
+        for depth in range(self.max_depth):
+            if cheapest * (depth + 1) >= self.cost_bound or (self.cost_max_len is not None and depth >= self.cost_max_len):
+                return
+            self.dp_sketches_packed(depth)  # builds the tables and the constants
+
+            def build(iter: int, reg_iter: int, cost: int, rest: Tuple[int, ...]):
+                if iter == depth:
+                    table = self.end_p[reg_iter]
+                    for op, lo, hi in self._op_runs("end", reg_iter, table):
+                        if cost + self.cost_model.packed[op] < self.cost_bound:
+                            yield from (rest + (instr,) for instr in table[lo:hi])
+                    return
+                instrs, new_reg = self.cache_p[reg_iter]
+                for op, lo, hi in self._op_runs("cache", reg_iter, instrs):
+                    c = cost + self.cost_model.packed[op]
+                    for i in range(lo, hi):
+                        if c + cheapest * (depth - iter) >= self.cost_bound:
+                            break
+                        yield from build(iter + 1, reg_iter + new_reg[i], c, rest + (instrs[i],))
+
+            yield from build(0, 0, 0, ())
+            self.poll()
+
+    # (opcode, start, end) of the runs of instructions with the same op in a table of dp_tables, which are built
+    # one op after the other
+    def _op_runs(self, kind: str, reg_iter: int, table: array | memoryview) -> List[Tuple[int, int, int]]:
+        if (kind, reg_iter) not in self.cost_runs:
+            opcodes = np.asarray(table, dtype=np.uint32) >> 24
+            starts = [0] + (np.flatnonzero(np.diff(opcodes)) + 1).tolist()
+            ends = starts[1:] + [len(opcodes)]
+            self.cost_runs[(kind, reg_iter)] = [(int(opcodes[lo]), lo, hi) for lo, hi in zip(starts, ends)]
+        return self.cost_runs[(kind, reg_iter)]
+
+    # component-based encoding: all programs of one length are a single z3 query. every instruction has selector
+    # variables for its operation and its operands, which refer to x0, the arguments or the results of earlier
+    # instructions, and the last instruction writes a0. the query is kept between cegis turns, and only the new
+    # examples are added to it
+    def sym_gen(self, examples: List[Tuple[List[int], int]], min_prog_length: int) -> Tuple[List[Instr], int]:
+        length = min_prog_length + 1
+        while length <= min(self.max_depth, len(Reg.const_regs)) + 1:
+            self.poll()
+            if self.sym_state is None or self.sym_state[0] != length:
+                self.sym_state = (length, *self._sym_encode(length), 0)
+            _, s, sel, asserted = self.sym_state
+            for (inputs, output) in examples[asserted:]:
+                s.add(self._sym_run(sel, inputs, s) == output)
+            self.sym_state = (length, s, sel, len(examples))
+            if self.check(s) == sat:
+                return self._sym_decode(sel, s.model()), length - 1
+            length += 1
+        raise Exception("No posssible program was found!")
+
+    # selectors (operation, first operand, second operand, immediate) for every instruction. operand k is x0 for
+    # k = 0, the k-th argument for k <= len(args) and the result of instruction k - len(args) - 1 otherwise
+    def _sym_encode(self, length: int) -> Tuple[Solver, List[Tuple[ArithRef, ArithRef, ArithRef, BitVecRef]]]:
+        s = Solver()
+        ops = self.arith_ops_imm + self.arith_ops
+        sel = []
+        for i in range(length):
+            op, src1, src2 = Int('op' + str(i)), Int('src1_' + str(i)), Int('src2_' + str(i))
+            c = BitVec('imm' + str(i), 64)
+            operands = len(self.args) + 1 + i
+            s.add(op >= 0, op < len(ops), src1 >= 0, src1 < operands, src2 >= 0, src2 < operands)
+            s.add(c >= self.c_min, c <= self.c_max)
+            for k, name in enumerate(ops):
+                if name == 'slli' or name == 'srai':
+                    s.add(Implies(op == k, c > 0))
+                if name in self.arith_ops_imm:
+                    s.add(Implies(op == k, src2 == 0))  # unused, fixed to avoid equivalent models
+                if name == 'lui':
+                    s.add(Implies(op == k, And(src1 == 0, c >= lui_min, c <= lui_max)))
+                if name == 'andi':
+                    s.add(Implies(op == k, src1 != 0))
+                if name in commutative_ops:
+                    s.add(Implies(op == k, src1 <= src2))
+                if name in same_operand_ops:
+                    s.add(Implies(op == k, src1 != src2))
+            sel.append((op, src1, src2, c))
+        return s, sel
+
+    # result of the encoded program on one example, as an expression over the selectors
+    def _sym_run(self, sel: List[Tuple[ArithRef, ArithRef, ArithRef, BitVecRef]], inputs: List[int], s: Solver) -> BitVecRef:
+        ops = self.arith_ops_imm + self.arith_ops
+        values = [BitVecVal(0, 64)] + [BitVecVal(x, 64) for x in inputs]
+
+        def select(index: ArithRef) -> BitVecRef:
+            r = values[-1]
+            for k in range(len(values) - 1):
+                r = If(index == k, values[k], r)
+            return r
+
+        for op, src1, src2, c in sel:
+            left, right = select(src1), select(src2)
+            result = None
+            for k, name in enumerate(ops):
+                if name in self.arith_ops_imm:
+                    value = match_op(name)(left, c)
+                else:
+                    value = match_op(name)(left, right)
+                    if name == 'div' or name == 'rem':
+                        s.add(Implies(op == k, right != 0))
+                result = value if result is None else If(op == k, value, result)
+            values.append(result)
+        return values[-1]
+
+    def _sym_decode(self, sel: List[Tuple[ArithRef, ArithRef, ArithRef, BitVecRef]], m: ModelRef) -> List[Instr]:
+        ops = self.arith_ops_imm + self.arith_ops
+        regs = [Zero()] + self.arg_regs + [Reg(r) for r in Reg.const_regs[:len(sel) - 1]]
+        prog = []
+        for i, (op, src1, src2, c) in enumerate(sel):
+            name = ops[m.eval(op, model_completion=True).as_long()]
+            dest = ReturnReg() if i == len(sel) - 1 else regs[len(self.args) + 1 + i]
+            left = regs[m.eval(src1, model_completion=True).as_long()]
+            if name in self.arith_ops_imm:
+                last = int(m.eval(c, model_completion=True).as_signed_long())
+            else:
+                last = regs[m.eval(src2, model_completion=True).as_long()]
+            prog.append(Instr(name, dest, left, last))
+        return prog
+
+    # bottom-up enumeration with observational equivalence: programs are built as expression trees over the
+    # representatives of smaller programs, and only one representative is kept per vector of outputs on the examples.
+    # the other members of a class are kept as well, so that classes can be split again after a new counterexample.
+    # constants for immediates are taken from oe_consts, except for a last addi/slli/srai whose constant is solved for
+    def oe_gen(self, examples: List[Tuple[List[int], int]], min_prog_length: int) -> Tuple[List[Instr], int]:
+        self._oe_sync([inputs for inputs, _ in examples])
+        target = tuple(to_signed64(output) for _, output in examples)
+        level = max(min_prog_length + 1, 1)
+        while level <= self.max_depth:
+            if target in self.oe_classes and self.oe_classes[target][0][0] <= level:
+                prog = self.term_to_instrs(self.oe_classes[target][0][1])
+                return prog, len(prog) - 1
+            for lvl in range(self.oe_built + 1, level):
+                self._oe_build(lvl, False)
+            if self.oe_built < level:
+                last = self._oe_solve_last(target, level)
+                if last is not None:
+                    prog = self.term_to_instrs(last)
+                    return prog, len(prog) - 1
+                self._oe_build(level, False)
+                continue
+            level += 1
+        raise Exception("No posssible program was found!")
+
+    # evaluates one instruction on vectors of values. returns None if a division by zero occurs
+    def _oe_eval(self, op: str, xs: Tuple[int, ...], ys: Tuple[int, ...] | int) -> None | Tuple[int, ...]:
+        if type(ys) is int:
+            return tuple(s64_op(op, x, ys) for x in xs)
+        if (op == 'div' or op == 'rem') and 0 in ys:
+            return None
+        return tuple(s64_op(op, x, y) for x, y in zip(xs, ys))
+
+    # evaluates a term on a list of inputs, memo maps ids of subterms to their results
+    def _oe_run(self, term, inputs: List[List[int]], memo: dict) -> None | Tuple[int, ...]:
+        if id(term) in memo:
+            return memo[id(term)]
+        if isinstance(term, Zero):
+            r = tuple(0 for _ in inputs)
+        elif isinstance(term, Reg):
+            idx = self.arg_regs.index(term)
+            r = tuple(inp[idx] for inp in inputs)
+        else:
+            op, a, b = term
+            left = self._oe_run(a, inputs, memo)
+            right = b if type(b) is int else self._oe_run(b, inputs, memo)
+            r = None if left is None or right is None else self._oe_eval(op, left, right)
+        memo[id(term)] = r
+        return r
+
+    def _oe_insert(self, cost: int, term, outputs: None | Tuple[int, ...]):
+        self.stats["sketches"] += 1
+        self.poll()
+        if outputs is None:
+            return
+        members = self.oe_classes.get(outputs)
+        if members is None:
+            self.oe_classes[outputs] = [(cost, term)]
+            self.oe_fresh.add(id(term))
+        elif cost < members[0][0]:
+            members.insert(0, (cost, term))
+            self.oe_fresh.add(id(term))
+        else:
+            members.append((cost, term))
+
+    # keeps the classes in line with the examples: the first call creates the leaves, later calls split the
+    # classes on the new inputs and combine the new representatives with everything already built
+    def _oe_sync(self, inputs: List[List[int]]):
+        if self.oe_built < 0:
+            self.oe_inputs = list(inputs)
+            self.oe_classes = {}
+            self.oe_fresh = set()
+            for leaf in self.arg_regs + [Zero()]:
+                self._oe_insert(0, leaf, self._oe_run(leaf, self.oe_inputs, {}))
+            self.oe_built = 0
+            self.oe_fresh = set()
+            return
+        new_inputs = inputs[len(self.oe_inputs):]
+        if len(new_inputs) == 0:
+            return
+        self.oe_inputs += new_inputs
+        memo = {}
+        old_classes = self.oe_classes
+        self.oe_classes = {}
+        for outputs, members in old_classes.items():
+            groups = {}
+            for cost, term in members:
+                new_outputs = self._oe_run(term, new_inputs, memo)
+                if new_outputs is not None:
+                    groups.setdefault(outputs + new_outputs, []).append((cost, term))
+            for key, group in groups.items():
+                group.sort(key=lambda m: m[0])
+                self.oe_classes[key] = group
+                if group[0][1] is not members[0][1]:
+                    self.oe_fresh.add(id(group[0][1]))
+        for lvl in range(1, self.oe_built + 1):
+            self._oe_build(lvl, True)
+        self.oe_fresh = set()
+
+    # adds all programs of the given length built from the current representatives.
+    # with only_fresh, only combinations using at least one new representative are built
+    def _oe_build(self, level: int, only_fresh: bool):
+        reps = {}
+        for outputs, members in self.oe_classes.items():
+            cost, term = members[0]
+            reps.setdefault(cost, []).append((term, outputs, id(term) in self.oe_fresh))
+
+        for term, outputs, fresh in reps.get(level - 1, []):
+            if only_fresh and not fresh:
+                continue
+            for op in self.arith_ops_imm:
+                if _redundant_imm(op, term):
+                    continue
+                for c in self.oe_consts:
+                    if (op == 'slli' or op == 'srai') and not 0 < c < 64:
+                        continue
+                    self._oe_insert(level, (op, term, c), self._oe_eval(op, outputs, c))
+            for op in ["add", "mul", "mulh"]:  # same register as both operands
+                if op == "mulh" and op not in self.arith_ops:
+                    continue
+                self._oe_insert(level, (op, term, term), self._oe_eval(op, outputs, outputs))
+
+        for i in range(level):
+            j = level - 1 - i
+            if j < i:
+                break
+            for idx1, (term1, out1, fresh1) in enumerate(reps.get(i, [])):
+                for idx2, (term2, out2, fresh2) in enumerate(reps.get(j, [])):
+                    if term1 is term2 or (only_fresh and not fresh1 and not fresh2):
+                        continue
+                    for op in self.arith_ops:
+                        # for commutative ops, one order is enough
+                        if op in commutative_ops:
+                            if i == j and idx2 < idx1:
+                                continue
+                            self._oe_insert(level, (op, term1, term2), self._oe_eval(op, out1, out2))
+                        else:
+                            self._oe_insert(level, (op, term1, term2), self._oe_eval(op, out1, out2))
+                            self._oe_insert(level, (op, term2, term1), self._oe_eval(op, out2, out1))
+        self.oe_built = max(self.oe_built, level)
+
+    # tries to reach the target with one more instruction on top of the representatives built so far, without building
+    # the next length. constants of a last addi/slli/srai are solved for instead of taken from oe_consts, and for a
+    # last add/sub/mul the missing operand is computed from the target and looked up
+    def _oe_solve_last(self, target: Tuple[int, ...], level: int):
+        reps = sorted((members[0][0], outputs, members[0][1]) for outputs, members in self.oe_classes.items() if members[0][0] < level)
+        for cost, outputs, term in reps:
+            c = target[0] - outputs[0]
+            if self.c_min <= c <= self.c_max and all(t == to_signed64(x + c) for t, x in zip(target, outputs)):
+                return ("addi", term, c)
+            for op in ['slli', 'srai']:
+                for c in range(1, min(64, self.c_max + 1)):
+                    if all(t == s64_op(op, x, c) for t, x in zip(target, outputs)):
+                        return (op, term, c)
+
+        for cost, outputs, term in reps:
+            needed = {"add": tuple(to_signed64(t - x) for t, x in zip(target, outputs)),
+                      "sub": tuple(to_signed64(t + x) for t, x in zip(target, outputs))}
+            if 0 not in outputs and all(t % x == 0 for t, x in zip(target, outputs)):
+                needed["mul"] = tuple(t // x for t, x in zip(target, outputs))
+            for op, other in needed.items():
+                members = self.oe_classes.get(other)
+                if members is None:
+                    continue
+                other_cost, other_term = members[0]
+                if (other_term is term and cost + 1 <= level) or 1 + cost + other_cost <= level:
+                    if other_term is term and op == "sub":
+                        continue
+                    return (op, other_term, term)
+        return None
+
+    # converts a term of oe_gen to instructions. shared subterms are computed once, temporary registers are reused
+    # after their last use and the final result is written to the return register
+    def term_to_instrs(self, term) -> List[Instr]:
+        if isinstance(term, Reg):
+            return [Instr("addi", ReturnReg(), term, 0)]
+        order = []
+        seen = set()
+
+        def visit(t):
+            if isinstance(t, Reg) or id(t) in seen:
+                return
+            seen.add(id(t))
+            visit(t[1])
+            if type(t[2]) is not int:
+                visit(t[2])
+            order.append(t)
+        visit(term)
+
+        last_use = {}
+        for idx, (_, a, b) in enumerate(order):
+            for child in (a, b):
+                if type(child) is tuple:
+                    last_use[id(child)] = idx
+        free = [Reg(x) for x in reversed(Reg.const_regs)]
+        location = {}
+        result = []
+        for idx, node in enumerate(order):
+            op, a, b = node
+            args = [x if isinstance(x, Reg) or type(x) is int else location[id(x)] for x in (a, b)]
+            for child in {id(x): x for x in (a, b) if type(x) is tuple}.values():
+                if last_use[id(child)] == idx:
+                    free.append(location[id(child)])
+            dest = ReturnReg() if idx == len(order) - 1 else free.pop()
+            location[id(node)] = dest
+            result.append(Instr(op, dest, *args))
+        return result
+
+
+# state of the worker processes of RiscvGen.dp_gen_parallel
+_shared_round = None
+_shared_best = None
+_worker_gens: dict[Tuple[Tuple[str, ...], str], RiscvGen] = {}  # by arguments and settings
+
+def _init_worker(round, best):
+    global _shared_round, _shared_best
+    _shared_round = round
+    _shared_best = best
+
+
+# checks the sketches of one shard, starting at the given offset. stops early if the round is over or a shard
+# before this one already found a program. settings are the worker_settings of the generator of dp_gen_parallel,
+# its class attributes may differ in this process (e.g. without fork). limits are the remaining time, check_timeout
+# and rlimit of its CancelToken; the checks run through a token of their own, so they end at the same deadline
+def _check_shard(args: List[str], settings: dict[str, Any], examples: List[Tuple[List[int], int]], depth: int,
+                 shard: int, start: int, retry: bool, round: int,
+                 limits: None | Tuple[None | float, None | int, None | int] = None) -> Tuple[int, None | int, None | List[Instr], bool]:
+    key = (tuple(args), json.dumps(settings))
+    if key not in _worker_gens:
+        gen = RiscvGen(args)
+        for attr, value in settings.items():
+            setattr(gen, attr, value)
+        gen.cache_p, gen.end_p, gen.dp_ones, gen.dp_counts = gen.table_dicts()  # for the op lists of settings
+        _worker_gens[key] = gen
+    gen = _worker_gens[key]
+    gen.cancel = None if limits is None else CancelToken(*limits)
+    sketches = gen.dp_sketches_packed(depth, shard)
+    try:
+        for offset, p in enumerate(itertools.islice(sketches, start, None), start):
+            if offset % 64 == 0 and (_shared_round.value != round or _shared_best.value < shard):
+                break
+            if gen.canonical and not canonical_sketch(p):
+                continue
+            prog, sampled = gen.check_sketch(p, examples, not (retry and offset == start))
+            if prog is not None:
+                with _shared_best.get_lock():
+                    _shared_best.value = min(_shared_best.value, shard)
+                return shard, offset, prog, sampled
+    except SynthesisCancelled:  # the deadline passed, dp_gen_parallel raises it as well
+        pass
+    finally:
+        gen.cancel = None
+    return shard, None, None, False
 
 
 if __name__ == "__main__":
@@ -322,7 +1254,10 @@ if __name__ == "__main__":
     print(repr(r))
 
     # print("Number of possible program sketches with length 3:", len(list(gen.smart_sketches(2))), sep='\n')
-    print("Number of possible program sketches with length 3:", len(list(gen.dp_sketches_yield(2))), sep='\n')  # 1.014.048 possibilties
+    gen.canonical = False
+    print("Number of possible program sketches with length 3:", len(list(gen.dp_sketches_yield(2))), sep='\n')  # 1.790.208 possibilties
+    gen.canonical = True
+    print("Of them in canonical form:", len(list(gen.dp_sketches_yield(2))), sep='\n')  # 430.194, without dead code and reorderings
     # count = 0
     # for x in gen.dp_sketches_yield(3):  # ~389 million possibilties
     #     count += 1
@@ -330,4 +1265,7 @@ if __name__ == "__main__":
     # print(count)
 
     r = gen.smart_gen([([3, 2], 0), ([6, 1], 1)], 0)
-    print(repr(r))
\ No newline at end of file
+    print(repr(r))
+
+    r = gen.oe_gen([([3, 2], 0), ([6, 1], 1)], 0)
+    print(repr(r))
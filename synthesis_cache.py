@@ -0,0 +1,98 @@
+from riscv_dsl import *
+from typing import List, Tuple
+import sqlite3
+import time
+
+__all__ = ["SynthesisCache", "encode_program", "decode_program"]
+
+
+# one instruction per line, in the same format as the assembly output
+def encode_program(instrs: List[Instr]) -> str:
+    return "\n".join(repr(instr) for instr in instrs)
+
+
+# inverse of encode_program. argument registers aN are bound to the N-th function argument again
+def decode_program(text: str, args: List[str]) -> List[Instr]:
+    def reg(s: str) -> Reg:
+        match s[0], int(s[1:]):
+            case 'a', 0:
+                return ReturnReg()
+            case 'a', num:
+                return Regvar(num, args[num - 1])
+            case 'x', 0:
+                return Zero()
+            case 'x', num:
+                return Reg(num)
+
+    r = []
+    for line in text.splitlines():
+        op, rest = line.split(" ", 1)
+        words = rest.split(", ")
+        if op == 'lui':
+            r += [Instr(op, reg(words[0]), Zero(), lui_signed(int(words[1])))]
+        elif op[-1] == 'i':  # immediate op
+            r += [Instr(op, reg(words[0]), reg(words[1]), int(words[2]))]
+        else:
+            r += [Instr(op, reg(words[0]), reg(words[1]), reg(words[2]))]
+    return r
+
+
+# persistent store of synthesis results in a sqlite database. entries are keyed by the canonical form of the goal
+# expression (python_ast_to_func.canonical_expr) and the generator that was used. every entry also records the
+# parameters of the generator; entries with other parameters are treated as missing and dropped.
+# if there are more than max_entries entries, the least recently used ones are removed
+class SynthesisCache:
+    path: str
+    max_entries: int
+    db: sqlite3.Connection
+
+    def __init__(self, path: str = "synthesis_cache.db", max_entries: int = 1000):
+        self.path = path
+        self.max_entries = max_entries
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS programs ("
+                        "expr TEXT, method TEXT, params TEXT, program TEXT, length INTEGER, time REAL, last_used REAL, "
+                        "PRIMARY KEY (expr, method))")
+        self.db.commit()
+
+    # returns the stored program, its search length and the time its synthesis took
+    def lookup(self, expr: str, method: str, params: str, args: List[str]) -> None | Tuple[List[Instr], int, float]:
+        row = self.db.execute("SELECT params, program, length, time FROM programs WHERE expr = ? AND method = ?",
+                              (expr, method)).fetchone()
+        if row is None:
+            return None
+        if row[0] != params:
+            self.remove(expr, method)
+            return None
+        self.db.execute("UPDATE programs SET last_used = ? WHERE expr = ? AND method = ?", (time.time(), expr, method))
+        self.db.commit()
+        return decode_program(row[1], args), row[2], row[3]
+
+    def store(self, expr: str, method: str, params: str, instrs: List[Instr], length: int, synthesis_time: float):
+        self.db.execute("INSERT OR REPLACE INTO programs VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (expr, method, params, encode_program(instrs), length, synthesis_time, time.time()))
+        self.db.execute("DELETE FROM programs WHERE rowid IN "
+                        "(SELECT rowid FROM programs ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+        self.db.commit()
+
+    def remove(self, expr: str, method: str):
+        self.db.execute("DELETE FROM programs WHERE expr = ? AND method = ?", (expr, method))
+        self.db.commit()
+
+    # removes all entries synthesized with other parameters than the given ones, or all entries if params is None
+    def invalidate(self, params: None | str = None):
+        if params is None:
+            self.db.execute("DELETE FROM programs")
+        else:
+            self.db.execute("DELETE FROM programs WHERE params != ?", (params,))
+        self.db.commit()
+
+    # the goal expressions and programs of all entries
+    def programs(self) -> List[Tuple[str, str]]:
+        return self.db.execute("SELECT expr, program FROM programs").fetchall()
+
+    def __len__(self) -> int:
+        return self.db.execute("SELECT COUNT(*) FROM programs").fetchone()[0]
+
+    def close(self):
+        self.db.close()
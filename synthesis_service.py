@@ -0,0 +1,337 @@
+# asyncio service around the synthesis, for build tools that ask for many programs at once. goals (expressions or
+# .s files, like in batch_synthesis) are submitted as jobs, wait in a queue and are synthesized by a pool of worker
+# processes, one job per process at a time. a goal that is submitted again while it is queued or running is not
+# synthesized twice, the submitters share the job. the results are the entries of the batch manifest, with the
+# program as text. serve accepts requests as JSON lines on a unix socket or a local TCP port, see _request
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import multiprocessing
+import threading
+from typing import Any, AsyncIterator, Iterable, List, Tuple
+from synthesis import RiscvGen
+from cancellation import CancelToken
+from batch_synthesis import _synthesize, _init_worker, prebuild_depth
+
+__all__ = ["Job", "SynthesisService", "methods"]
+
+methods: Tuple[str, ...] = ("cegis_0", "cegis_1", "cegis_2", "cegis_3", "cegis_4", "cegis_cost", "bottom_up")
+
+_cancel_flags: Any = None  # shared with the service: the job in the slot of a flag is cancelled once it is set
+
+
+def _init_service_worker(flags: Any):
+    global _cancel_flags
+    _cancel_flags = flags
+    _init_worker()
+
+
+# runs in a worker process. a thread watches the flag of the slot and cancels the token of the job once it is set,
+# which also interrupts a z3 check that is running
+def _run_job(slot: int, goal: str, method: str, timeout: None | float, poll_interval: float) -> dict[str, Any]:
+    token = CancelToken(timeout)
+    done = threading.Event()
+
+    def watch():
+        while not done.wait(poll_interval):
+            if _cancel_flags[slot]:
+                token.cancel()
+                return
+
+    threading.Thread(target=watch, daemon=True).start()
+    try:
+        result = _synthesize(goal, method, timeout, token)
+    finally:
+        done.set()
+    if _cancel_flags[slot] and result["status"] != "ok":
+        result["status"] = "cancelled"
+    if result["program"] is not None:
+        result["program"] = [repr(instr) for instr in result["program"]]
+    return result
+
+
+class Job:
+    id: int
+    goal: str
+    method: str
+    timeout: None | float
+    status: str  # queued, running, or the status of the result once it is done
+    slot: None | int  # index of the dispatcher running the job
+    result: asyncio.Future  # the entry of the manifest, with the id of the job
+
+    def __init__(self, id: int, goal: str, method: str, timeout: None | float):
+        self.id = id
+        self.goal = goal
+        self.method = method
+        self.timeout = timeout
+        self.status = "queued"
+        self.slot = None
+        self.result = asyncio.get_running_loop().create_future()
+
+    def key(self) -> Tuple[str, str, None | float]:
+        return self.goal, self.method, self.timeout
+
+    def __repr__(self) -> str:
+        return f"Job({self.id}, {self.goal!r}, {self.status})"
+
+
+# use as `async with SynthesisService(workers) as service:`, or call start and close
+class SynthesisService:
+    workers: int
+    method: str  # of the jobs that do not name one
+    timeout: None | float  # seconds, for the jobs that do not have their own
+    poll_interval: float = 0.1  # seconds between checks of the cancel flags in the workers
+    keep_finished: int = 1000  # number of finished jobs whose results can still be looked up by id
+    prebuild_args: Tuple[int, ...] = (1, 2, 3)  # the dp tables for these numbers of arguments are built before the fork
+    jobs: dict[int, Job]
+    in_flight: dict[Tuple[str, str, None | float], Job]  # queued and running jobs, by goal, method and timeout
+    finished: collections.deque  # ids of the finished jobs in jobs, oldest first
+    queue: None | asyncio.Queue
+    flags: Any  # cancel flag of every dispatcher, shared with the workers
+    pool: None | concurrent.futures.ProcessPoolExecutor
+    ctx: Any  # multiprocessing context of the pool
+    share_tables: bool  # RiscvGen.share_tables before start, restored by close
+    dispatchers: List[asyncio.Task]
+    next_id: int
+
+    def __init__(self, workers: int = 1, method: str = "cegis_2", timeout: None | float = None):
+        if method not in methods:
+            raise Exception("Unknown synthesis method " + method)
+        self.workers = workers
+        self.method = method
+        self.timeout = timeout
+        self.jobs = {}
+        self.in_flight = {}
+        self.finished = collections.deque()
+        self.queue = None
+        self.flags = None
+        self.pool = None
+        self.ctx = None
+        self.share_tables = RiscvGen.share_tables
+        self.dispatchers = []
+        self.next_id = 0
+
+    async def start(self):
+        self.share_tables = RiscvGen.share_tables
+        RiscvGen.share_tables = True
+        for n in self.prebuild_args:
+            RiscvGen(["v" + str(i) for i in range(n)]).dp_tables(prebuild_depth)
+        self.ctx = multiprocessing.get_context("fork") if "fork" in multiprocessing.get_all_start_methods() else None
+        self.flags = (self.ctx or multiprocessing).RawArray('b', self.workers)
+        self.pool = self._new_pool()
+        self.queue = asyncio.Queue()
+        self.dispatchers = [asyncio.create_task(self._dispatch(slot)) for slot in range(self.workers)]
+
+    # cancels the queued and running jobs and waits for the workers to stop
+    async def close(self):
+        for job in list(self.in_flight.values()):
+            self.cancel(job.id)
+        for task in self.dispatchers:
+            task.cancel()
+        await asyncio.gather(*self.dispatchers, return_exceptions=True)
+        self.dispatchers = []
+        if self.pool is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self.pool.shutdown)
+            self.pool = None
+        RiscvGen.share_tables = self.share_tables
+
+    def _new_pool(self) -> concurrent.futures.ProcessPoolExecutor:
+        return concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=self.ctx,
+                                                      initializer=_init_service_worker, initargs=(self.flags,))
+
+    async def __aenter__(self) -> "SynthesisService":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    # the job synthesizing goal, a new one unless the same goal is queued or running with the same method and timeout
+    def submit(self, goal: str, method: None | str = None, timeout: None | float = None) -> Job:
+        if self.queue is None:
+            raise Exception("The service was not started")
+        method = self.method if method is None else method
+        if method not in methods:
+            raise Exception("Unknown synthesis method " + method)
+        job = Job(self.next_id, goal.strip(), method, self.timeout if timeout is None else timeout)
+        if job.key() in self.in_flight:
+            return self.in_flight[job.key()]
+        self.next_id += 1
+        self.jobs[job.id] = job
+        self.in_flight[job.key()] = job
+        self.queue.put_nowait(job)
+        return job
+
+    def job(self, job_id: int) -> Job:
+        if job_id not in self.jobs:
+            raise Exception("Unknown job " + str(job_id))
+        return self.jobs[job_id]
+
+    # the result of the job, once it is done. a waiter that is cancelled does not cancel the job
+    async def wait(self, job_id: int) -> dict[str, Any]:
+        return await asyncio.shield(self.job(job_id).result)
+
+    # a queued job is dropped, a running one is stopped by its worker within poll_interval (its result then has the
+    # status cancelled, unless a program was found already). the job is cancelled for every submitter of its goal.
+    # returns False if the job was done already
+    def cancel(self, job_id: int) -> bool:
+        job = self.job(job_id)
+        if job.result.done():
+            return False
+        if job.slot is not None:
+            self.flags[job.slot] = 1
+        else:
+            self._finish(job, self._result(job, "cancelled"))
+        return True
+
+    # the results of the jobs in the order they are done
+    async def as_completed(self, jobs: Iterable[Job]) -> AsyncIterator[dict[str, Any]]:
+        for f in asyncio.as_completed([asyncio.shield(job.result) for job in jobs]):
+            yield await f
+
+    # submits all goals and returns their results as they are done
+    async def synthesize(self, goals: Iterable[str], method: None | str = None,
+                         timeout: None | float = None) -> AsyncIterator[dict[str, Any]]:
+        jobs = [self.submit(goal, method, timeout) for goal in goals]
+        async for result in self.as_completed(jobs):
+            yield result
+
+    def status(self) -> dict[str, Any]:
+        running = sum(job.status == "running" for job in self.in_flight.values())
+        return {"workers": self.workers, "running": running, "queued": len(self.in_flight) - running,
+                "finished": len(self.finished)}
+
+    def _result(self, job: Job, status: str) -> dict[str, Any]:
+        return {"goal": job.goal, "kind": "file" if job.goal.endswith(".s") else "expression", "status": status,
+                "program": None, "length": None, "time": None, "iterations": None, "error": None}
+
+    def _finish(self, job: Job, result: dict[str, Any]):
+        job.status = result["status"]
+        job.slot = None
+        job.result.set_result(result | {"job": job.id})
+        if self.in_flight.get(job.key()) is job:
+            del self.in_flight[job.key()]
+        self.finished.append(job.id)
+        while len(self.finished) > self.keep_finished:
+            del self.jobs[self.finished.popleft()]
+
+    # hands the jobs of the queue to the pool, one at a time. there is a dispatcher per worker process, so a job
+    # starts as soon as it is taken from the queue
+    async def _dispatch(self, slot: int):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            if job.result.done():  # cancelled while it was queued
+                continue
+            job.status = "running"
+            job.slot = slot
+            self.flags[slot] = 0
+            pool = self.pool
+            try:
+                result = await loop.run_in_executor(pool, _run_job, slot, job.goal, job.method, job.timeout,
+                                                    self.poll_interval)
+            except asyncio.CancelledError:
+                self._finish(job, self._result(job, "cancelled"))
+                raise
+            except concurrent.futures.process.BrokenProcessPool as e:
+                # a worker process died, which breaks the pool for good. the jobs that were running in it fail,
+                # the first of their dispatchers replaces the pool for the next jobs
+                result = self._result(job, "error")
+                result["error"] = "worker process died: " + str(e)
+                if self.pool is pool:
+                    pool.shutdown(wait=False, cancel_futures=True)
+                    self.pool = self._new_pool()
+            except Exception as e:
+                result = self._result(job, "error")
+                result["error"] = str(e)
+            self._finish(job, result)
+
+    # serves one JSON object per line on the connection. every request is answered by one line (several for
+    # synthesize) that repeats its "tag", so requests can be sent without waiting for the answers:
+    #   {"op": "submit", "goal": "x * 8 + 5", "method": "cegis_2", "timeout": 60} -> {"job": 0, "status": "queued"}
+    #   {"op": "result", "job": 0} -> the result, once the job is done
+    #   {"op": "cancel", "job": 0} -> {"job": 0, "cancelled": true}
+    #   {"op": "synthesize", "goals": [...]} -> the results as they are done, then {"done": true}
+    #   {"op": "status"} -> number of queued, running and finished jobs
+    # errors are answered with {"error": message}. method and timeout are optional
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        requests = set()
+
+        def send(answer: dict[str, Any]):
+            writer.write((json.dumps(answer) + "\n").encode())
+
+        try:
+            while line := await reader.readline():
+                if line.strip() == b"":
+                    continue
+                task = asyncio.create_task(self._request(line, send))
+                requests.add(task)
+                task.add_done_callback(requests.discard)
+                await writer.drain()
+            await asyncio.gather(*requests)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            for task in requests:
+                task.cancel()
+            writer.close()
+
+    async def _request(self, line: bytes, send):
+        tag = {}
+        try:
+            request = json.loads(line)
+            tag = {"tag": request["tag"]} if "tag" in request else {}
+            match request.get("op"):
+                case "submit":
+                    job = self.submit(request["goal"], request.get("method"), request.get("timeout"))
+                    send({"job": job.id, "status": job.status} | tag)
+                case "result":
+                    send(await self.wait(request["job"]) | tag)
+                case "cancel":
+                    send({"job": request["job"], "cancelled": self.cancel(request["job"])} | tag)
+                case "synthesize":
+                    results = self.synthesize(request["goals"], request.get("method"), request.get("timeout"))
+                    async for result in results:
+                        send(result | tag)
+                    send({"done": True} | tag)
+                case "status":
+                    send(self.status() | tag)
+                case _:
+                    raise Exception("Unknown op " + str(request.get("op")))
+        except KeyError as e:
+            send({"error": "Missing field " + str(e)} | tag)
+        except Exception as e:
+            send({"error": str(e)} | tag)
+
+    # starts serving on the unix socket at path, or on host and port if there is no path
+    async def serve(self, path: None | str = None, host: str = "127.0.0.1", port: int = 8765) -> asyncio.AbstractServer:
+        if path is not None:
+            return await asyncio.start_unix_server(self._handle, path)
+        return await asyncio.start_server(self._handle, host, port)
+
+
+# python synthesis_service.py --socket /tmp/synthesis.sock --workers 8 --timeout 60 (or --port 8765)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthesis of RISC-V programs as a local service")
+    parser.add_argument("--socket", help="unix socket to listen on")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765, help="TCP port to listen on, without --socket")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="number of worker processes")
+    parser.add_argument("--method", default="cegis_2", choices=methods, help="method of jobs that do not name one")
+    parser.add_argument("--timeout", type=float, help="seconds per job, for jobs that do not have their own")
+    cli_args = parser.parse_args()
+
+    async def main():
+        async with SynthesisService(cli_args.workers, cli_args.method, cli_args.timeout) as service:
+            server = await service.serve(cli_args.socket, cli_args.host, cli_args.port)
+            print("Listening on", cli_args.socket or f"{cli_args.host}:{cli_args.port}", flush=True)
+            async with server:
+                await server.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,82 @@
+# on-disk store of the packed dp tables of RiscvGen (cache_p, end_p and dp_ones). a table file holds the tables of
+# one key, i.e. number of arguments and op lists, for all depths up to the one it was written for. the file is
+# mapped read-only and the tables are memoryviews into the mapping, so processes using the same file share its pages
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+from array import array
+from typing import List, Tuple
+from riscv_dsl import Instr, Reg
+
+__all__ = ["table_path", "save_tables", "load_tables"]
+
+magic = b"RVDPTBL1"
+
+
+# the encoding of the tables also depends on the op and register numbering of riscv_dsl
+def table_path(directory: str, num_args: int, arith_ops_imm: List[str], arith_ops: List[str]) -> str:
+    key = json.dumps([num_args, arith_ops_imm, arith_ops, Instr.arith_ops, Reg.const_regs])
+    return os.path.join(directory, f"dp_{num_args}_{hashlib.sha1(key.encode()).hexdigest()[:16]}.tbl")
+
+
+# layout: magic, length of the json header (uint32), the header and the arrays, each aligned to 8 bytes. the header
+# lists name, reg_iter, offset, length and typecode of every array
+def save_tables(path: str, cache_p: dict[int, Tuple[array, array]], end_p: dict[int, array], dp_ones: dict[int, array]):
+    depth = 0
+    while depth in cache_p and depth + 1 in end_p:
+        depth += 1
+    arrays = [("end", 0, end_p[0])]
+    for reg_iter in range(depth):
+        instrs, new_reg = cache_p[reg_iter]
+        arrays += [("instrs", reg_iter, instrs), ("new_reg", reg_iter, new_reg), ("ones", reg_iter, dp_ones[reg_iter]),
+                   ("end", reg_iter + 1, end_p[reg_iter + 1])]
+
+    sections = []
+    offset = 0
+    for name, reg_iter, values in arrays:
+        sections.append([name, reg_iter, offset, len(values), values.format if isinstance(values, memoryview) else values.typecode])
+        offset += -(-len(values) * values.itemsize // 8) * 8
+    header = json.dumps({"depth": depth, "sections": sections}).encode()
+    start = -(-(len(magic) + 4 + len(header)) // 8) * 8
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    # a temporary file of its own, processes writing the same tables at once do not write into each other's files
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(magic + struct.pack("<I", len(header)) + header)
+            for (name, reg_iter, values), section in zip(arrays, sections):
+                f.seek(start + section[2])
+                f.write(values.tobytes())
+            f.truncate(start + offset)
+        os.chmod(tmp, 0o644)  # mkstemp creates the file readable only by its owner
+        os.replace(tmp, path)  # processes that mapped the old file keep reading it
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+# returns the depth the file was written for and the tables, as read-only views into the mapped file
+def load_tables(path: str) -> Tuple[int, dict[int, Tuple[memoryview, memoryview]], dict[int, memoryview], dict[int, memoryview]]:
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    if view[:len(magic)] != magic:
+        raise Exception("Not a table file: " + path)
+    header_len = struct.unpack_from("<I", view, len(magic))[0]
+    header = json.loads(bytes(view[len(magic) + 4:len(magic) + 4 + header_len]))
+    start = -(-(len(magic) + 4 + header_len) // 8) * 8
+
+    parts = {}
+    for name, reg_iter, offset, length, typecode in header["sections"]:
+        itemsize = struct.calcsize(typecode)
+        parts[(name, reg_iter)] = view[start + offset:start + offset + length * itemsize].cast(typecode)
+    depth = header["depth"]
+    cache_p = {r: (parts[("instrs", r)], parts[("new_reg", r)]) for r in range(depth)}
+    end_p = {r: parts[("end", r)] for r in range(depth + 1)}
+    dp_ones = {r: parts[("ones", r)] for r in range(depth)}
+    return depth, cache_p, end_p, dp_ones